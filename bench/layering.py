@@ -0,0 +1,61 @@
+## @file bench/layering.py
+# @brief Benchmark of the atmosphere layerings.
+#
+# Python script comparing the uniform and the adaptive layerings (see lib.amutils.heights): for each number of layers, it runs am over a set of realizations of every month and gives the maximum difference of the brightness temperatures from the uniform reference with many layers.
+# It ends with the fewest layers reproducing the reference within the tolerance, for each layering.
+#
+# Usage: python3 bench/layering.py PARAMSFILE [TOLERANCE] [REFERENCE_N] [FREQ_START FREQ_STOP FREQ_INTERVAL]
+#
+# The file is located under atmi/bench.
+
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from lib import amrunner
+from lib import amutils
+import numpy as np
+
+## Reading the arguments
+########################
+paramsfile = sys.argv[1]
+tol = float(sys.argv[2]) if len(sys.argv) > 2 else 0.1   # K
+Nref = int(sys.argv[3]) if len(sys.argv) > 3 else 300
+freq_start, freq_stop, freq_interval = [float(f) for f in sys.argv[4:7]] if len(sys.argv) > 6 else [10, 300, 0.5]
+Ns = [5, 8, 10, 15, 20, 30, 40, 60, 80, 100, 150]
+
+print('Parameters File\t->\t'+paramsfile)
+print('Tolerance\t->\t'+str(tol)+'K')
+print('Reference\t->\tuniform, '+str(Nref)+' layers')
+print('Frequencies\t->\t'+str(freq_start)+'-'+str(freq_stop)+' GHz, '+str(freq_interval)+' GHz\n')
+########################
+
+## Running am
+#############
+params = amutils.params(paramsfile)
+months = np.repeat(np.arange(1, len(params)+1), 3)
+T0 = np.tile([265., 275., 285.], len(params))   # dry-cold, median and wet-warm realizations
+P0 = np.tile([54000., 55500., 57000.], len(params))
+PWV = np.tile([0.5, 2., 8.], len(params))
+
+def spectra(N, layering):
+    Z, T, P, pwv = amutils.profiles_batch(params, T0, P0, PWV, months, N, layering)
+    texts = [amutils.config_text(freq_start, freq_stop, freq_interval, 2.7, Z[i], T[i], P[i], pwv[i], 'bench') for i in range(len(months))]
+    return amrunner.spectra(texts, desc=layering+' '+str(N)+' ...')[2]
+
+reference = spectra(Nref, 'uniform')
+errors = {}
+for layering in amutils.LAYERINGS:
+    errors[layering] = [np.max(np.abs(spectra(N, layering) - reference)) for N in Ns]
+#############
+
+## Printing the results
+#######################
+print('\nN\t'+'\t'.join(amutils.LAYERINGS)+'\t(max |Tb - Tb_ref| in K)')
+for i, N in enumerate(Ns):
+    print(str(N)+'\t'+'\t'.join('%.4f' % errors[layering][i] for layering in amutils.LAYERINGS))
+print()
+for layering in amutils.LAYERINGS:
+    ok = [N for i, N in enumerate(Ns) if errors[layering][i] <= tol]
+    print(layering+'\t->\t'+(str(ok[0])+' layers within '+str(tol)+' K' if ok else 'tolerance not reached'))
+#######################
@@ -0,0 +1,53 @@
+## @file bench/startup.py
+# @brief Benchmark of the startup of the atmi scripts.
+#
+# Python script timing the imports of each script under src (the statements at the top of the file), each one in a fresh interpreter, and listing the heavy libraries they load.
+# A script only computing (amconfig.py, amrun.py, ...) should not load the plotting libraries, and none of them should load scipy before it is needed.
+#
+# Usage: python3 bench/startup.py [REPEATS] [SCRIPT ...]
+#
+# The file is located under atmi/bench.
+
+import ast
+import os
+import subprocess
+import sys
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+HEAVY = ['matplotlib', 'scipy', 'xarray', 'pandas', 'netCDF4', 'termplotlib', 'tqdm']   # libraries worth knowing about
+
+## This function gives the import statements at the top of a script.
+#
+#  @param path The path to the script.
+#  @return The source of the import statements.
+def imports(path):
+    with open(path) as f:
+        tree = ast.parse(f.read())
+    return '\n'.join(ast.unparse(node) for node in tree.body if isinstance(node, (ast.Import, ast.ImportFrom)))
+
+## This function times the imports of a script in a fresh interpreter.
+#
+#  @param path The path to the script.
+#  @return The seconds taken and the heavy libraries loaded.
+def startup(path):
+    code = 'import sys, time\nt = time.perf_counter()\n'+imports(path)+'\nprint(time.perf_counter() - t)\nprint(",".join(m for m in '+repr(HEAVY)+' if m in sys.modules))'
+    out = subprocess.run([sys.executable, '-c', code], cwd=SRC, capture_output=True, text=True, check=True).stdout.split('\n')
+    return float(out[0]), out[1]
+
+## Reading the arguments
+########################
+repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+scripts = sys.argv[2:] if len(sys.argv) > 2 else sorted(f for f in os.listdir(SRC) if f.endswith('.py'))
+print('Repeats\t->\t'+str(repeats)+' (best time)\n')
+########################
+
+## Timing the scripts
+#####################
+print('Script\t\tSeconds\tLoaded')
+for script in scripts:
+    times, loaded = [], ''
+    for r in range(repeats):
+        t, loaded = startup(os.path.join(SRC, script))
+        times.append(t)
+    print(script+'\t'+('\t' if len(script) < 8 else '')+'%.3f' % min(times)+'\t'+(loaded if loaded else '-'))
+#####################
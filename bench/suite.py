@@ -0,0 +1,205 @@
+## @file bench/suite.py
+# @brief Benchmark suite of the atmi pipeline.
+#
+# Python script timing each stage of the pipeline on synthetic ERA5 datasets (see bench/synthetic.py) and with the stand-in am (bench/am, put first on the PATH), so that it runs anywhere and always on the same data.
+# For each number of hours, starting from January 1st, it times:
+# - extraction: opening the datasets and extracting the days windows of each hour (lib.netCDFutils);
+# - kde: fitting the probability density functions (lib.atmsampling.binned_kde);
+# - copula: the correlated sampling of one realization for each hour (lib.atmsampling.samplings);
+# - profiles: the vertical profiles and the am configurations of the realizations (lib.amutils);
+# - dispatch: running am over the configurations into a store (lib.amrunner, lib.amstore);
+# - instrument: the beam and band integration of the spectra (lib.instrumentObs).
+# The results are saved as JSON, with the environment of the run, so that the runs can be compared over time.
+#
+# Usage: python3 bench/suite.py [RESULTS] [YEARS] [HOURS ...]
+# - RESULTS: the JSON file of the results (bench/results/<date>.json by default).
+# - YEARS: the years of the synthetic datasets (3 by default, and at least 3: the first and the last are left out of the climatology, as by sampling.py).
+# - HOURS: the sizes of the benchmark (24 168 720 by default).
+# The delay of each am run is given by AM_DELAY (seconds), the number of parallel am processes by ATMI_JOBS.
+#
+# The file is located under atmi/bench.
+
+import os
+import sys
+BENCH = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH, '..', 'src'))
+os.environ['PATH'] = BENCH+os.pathsep+os.environ.get('PATH', '')   # the stand-in am
+
+from datetime import datetime
+from lib import amrunner
+from lib import amstore
+from lib import amutils
+from lib import atmsampling
+from lib import instrumentObs
+from lib import netCDFutils
+import importlib
+import json
+import numpy as np
+import platform
+import subprocess
+import synthetic
+import tempfile
+import time
+
+for module in ['scipy.linalg', 'scipy.stats']:
+    importlib.import_module(module)   # loaded by the libraries when needed, here before the timings
+
+N = 30   # layers
+FREQ = (10., 300., 0.5)   # GHz
+PARAMSFILE = os.path.join(BENCH, '..', 'config', 'params_Salta.asc')
+LAT, LON = -24.25, -66.25
+
+## Reading the arguments
+########################
+resultsfile = sys.argv[1] if len(sys.argv) > 1 else os.path.join(BENCH, 'results', datetime.now().strftime('%Y%m%d-%H%M%S')+'.json')
+years = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+sizes = [int(h) for h in sys.argv[3:]] if len(sys.argv) > 3 else [24, 168, 720]
+if years < 3:
+    print('At least 3 years are needed!')
+    sys.exit(1)
+jobs = int(os.environ.get('ATMI_JOBS', '0')) or (os.cpu_count() or 1)
+delay = float(os.environ.get('AM_DELAY', '0'))
+
+print('Results\t\t->\t'+resultsfile)
+print('Years\t\t->\t'+str(years))
+print('Hours\t\t->\t'+', '.join(str(h) for h in sizes))
+print('am Delay\t->\t'+str(delay)+' s')
+print('Jobs\t\t->\t'+str(jobs)+'\n')
+########################
+
+## This class represents the timer of the stages of a benchmark.
+class stages:
+
+    ## The constructor for the class.
+    #
+    #  @param self The object pointer.
+    def __init__(self):
+        ## The seconds taken by each stage.
+        self.seconds = {}
+
+    ## This method times a stage.
+    #
+    #  @param self The object pointer.
+    #  @param name The name of the stage.
+    #  @param function The function running the stage.
+    #  @return The result of the function.
+    def time(self, name, function, *args):
+        start = time.perf_counter()
+        result = function(*args)
+        self.seconds[name] = round(time.perf_counter() - start, 6)
+        print(name+'\t'+('\t' if len(name) < 8 else '')+'%.3f s' % self.seconds[name])
+        return result
+
+## This function extracts the days windows of the given hours from new datasets.
+#
+#  @param datafiles The paths to the datasets.
+#  @param variables The names of the variables.
+#  @param months The months of the hours.
+#  @param days The days of the hours.
+#  @param hours The hours.
+#  @return The values of each variable, with shape (number of hours, window size).
+def extraction(datafiles, variables, months, days, hours):
+    datas = [netCDFutils.data(datafile) for datafile in datafiles]
+    start, stop = np.min([data.start for data in datas]), np.min([data.stop for data in datas])   # as sampling.py
+    indexes = [data.climatology(start + 1, stop - 1, 4) for data in datas]
+    slots = indexes[0].slot(months, days, hours)
+    return [datas[i].window_values(LAT, LON, variables[i], indexes[i], slots) for i in range(len(variables))]
+
+## This function samples one realization for each hour, inducing the correlations.
+#
+#  @param variables The names of the variables.
+#  @param values The values of each variable (see extraction).
+#  @param pdfs The probability density functions of each variable and hour.
+#  @return The realizations, with shape (number of hours, number of variables).
+def copula(variables, values, pdfs):
+    atmospheres = [atmsampling.atmosphere([atmsampling.variable(variables[i], values[i][h], pdf=pdfs[i][h]) for i in range(len(variables))]) for h in range(len(values[0]))]
+    lag = None if len(atmospheres)*len(variables) <= 2232 else 24   # as sampling.py
+    return atmsampling.samplings(atmospheres).correlated_sample(1, lag=lag)[0]
+
+## This function computes the profiles and the configurations of the realizations, writing them in a directory.
+#
+#  @param directory The directory of the configurations.
+#  @param names The names of the realizations.
+#  @param months The months of the realizations.
+#  @param realizations The realizations (see copula).
+#  @return The contents of the configurations.
+def profiles(directory, names, months, realizations):
+    params = amutils.params(PARAMSFILE)
+    T0, P0, PWV = realizations[:, 0], realizations[:, 1], np.abs(realizations[:, 2])
+    Z, T, P, pwv = amutils.profiles_batch(params, T0, P0, PWV, months, N)
+    configs = amutils.configs(directory, 'bench')
+    texts = configs.texts(*FREQ, 2.7, Z, T, P, pwv)
+    configs.add(names, texts)
+    configs.close()
+    return texts
+
+## This function runs am over the configurations, gathering the spectra in a store.
+#
+#  @param directory The directory of the outputs.
+#  @param names The names of the realizations.
+#  @param texts The contents of the configurations.
+#  @return The store.
+def dispatch(directory, names, texts):
+    store = amstore.store(os.path.join(directory, 'bench.cube'), 'w')
+    runner = amrunner.runner(directory, directory, jobs=jobs, store=store)
+    runner.start(len(names))
+    for name, text in zip(names, texts):
+        runner.submit(name, text)
+    runner.join()
+    store.flush()
+    return store
+
+## This function integrates the spectra over the beam and the band of an instrument.
+#
+#  @param store The store of the spectra.
+#  @return The temperatures measured by the instrument.
+def instrument(store):
+    freq, tau, Tb = store.slice(90., 110.)
+    theta = np.linspace(20. - 5*1.5, 20. + 5*1.5, 100)
+    obs = instrumentObs.instrument(theta, instrumentObs.Pn_gaussian(theta, 20., 1.5), freq, np.ones(len(freq)))
+    return obs.observation(Tb - 2.7*tau)
+
+## Running the benchmark
+########################
+with tempfile.TemporaryDirectory() as tmp:
+    print('Generating the synthetic datasets ...')
+    datafiles = synthetic.generate(os.path.join(tmp, 'data'), 2000, 2000 + years - 1, expver=True)
+    variables = list(synthetic.VARIABLES)
+    results = []
+    for size in sizes:
+        print('\n'+str(size)+' hours')
+        dates = np.datetime64('1981-01-01T00') + np.arange(size).astype('timedelta64[h]')   # arbitrary non-leap year
+        months = dates.astype('datetime64[M]').astype(int) % 12 + 1
+        days = (dates.astype('datetime64[D]') - dates.astype('datetime64[M]')).astype(int) + 1
+        hours = (dates - dates.astype('datetime64[D]')).astype(int)
+        names = ['bench_'+str(months[i])+'_'+str(days[i])+'_'+str(hours[i])+'_'+str(i // 8760) for i in range(size)]
+        directory = os.path.join(tmp, str(size))
+        os.makedirs(directory)
+        timer = stages()
+        values = timer.time('extraction', extraction, datafiles, variables, months, days, hours)
+        pdfs = timer.time('kde', lambda: [atmsampling.binned_kde.batch(v) for v in values])
+        realizations = timer.time('copula', copula, variables, values, pdfs)
+        texts = timer.time('profiles', profiles, directory, names, months, realizations)
+        store = timer.time('dispatch', dispatch, directory, names, texts)
+        timer.time('instrument', instrument, store)
+        store.close()
+        results.append({'hours': size, 'seconds': timer.seconds, 'total': round(sum(timer.seconds.values()), 6)})
+########################
+
+## Saving the results
+#####################
+try:
+    commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=BENCH, capture_output=True, text=True).stdout.strip() or None
+except OSError:
+    commit = None
+environment = {'date': str(datetime.now()), 'commit': commit, 'python': platform.python_version(), 'numpy': np.__version__, 'machine': platform.machine(), 'cpus': os.cpu_count(),
+    'jobs': jobs, 'am_delay': delay, 'years': years, 'layers': N, 'frequencies': list(FREQ)}
+os.makedirs(os.path.dirname(os.path.abspath(resultsfile)), exist_ok=True)
+with open(resultsfile, 'w') as f:
+    json.dump({'environment': environment, 'results': results}, f, indent=1)
+
+print('\nHours\t'+'\t'.join(results[0]['seconds'])+'\ttotal')
+for result in results:
+    print(str(result['hours'])+'\t'+'\t'.join('%.3f' % s for s in result['seconds'].values())+'\t%.3f' % result['total'])
+print('\nResults saved in '+resultsfile)
+#####################
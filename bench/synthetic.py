@@ -0,0 +1,71 @@
+## @file bench/synthetic.py
+# @brief Generator of synthetic ERA5 datasets.
+#
+# Python script writing hourly netCDF datasets shaped as the ERA5 downloads read by lib.netCDFutils: one file for each variable (stl1, sp, tcwv), with the time, latitude and longitude coordinates and, optionally, the expver dimension of the ERA5/ERA5T mixed downloads.
+# The values follow daily and seasonal cycles of a high and dry site with random weather, so that the sampling and the profiles behave as with real data.
+#
+# Usage: python3 bench/synthetic.py DIRECTORY START_YEAR FINAL_YEAR [EXPVER]
+#
+# The file is located under atmi/bench.
+
+import numpy as np
+import os
+import sys
+
+VARIABLES = {   # name: (units, mean, seasonal amplitude, daily amplitude, noise)
+    'stl1': ('K', 275., 8., 6., 2.),
+    'sp': ('Pa', 55500., 300., 60., 150.),
+    'tcwv': ('kg m**-2', 3., 2., 0.3, 1.),
+}
+
+## This function writes the synthetic datasets.
+#
+#  @param directory The directory of the datasets.
+#  @param year1 The starting year.
+#  @param year2 The final year (included).
+#  @param latitudes The latitudes of the grid.
+#  @param longitudes The longitudes of the grid.
+#  @param expver If True, the last month is given as ERA5T data (expver=5), the rest as ERA5 data (expver=1).
+#  @param seed The seed of the random weather.
+#  @return The paths to the datasets, in the order of VARIABLES.
+def generate(directory, year1, year2, latitudes=(-24., -24.25, -24.5), longitudes=(-66.5, -66.25, -66.), expver=False, seed=0):
+    import xarray as xr
+    os.makedirs(directory, exist_ok=True)
+    time = np.arange(np.datetime64(str(year1)+'-01-01T00'), np.datetime64(str(year2+1)+'-01-01T00'), np.timedelta64(1, 'h'))
+    day = (time - time.astype('datetime64[D]')).astype(float)/24
+    year = (time - time.astype('datetime64[Y]')).astype('timedelta64[h]').astype(float)/8760
+    rng = np.random.default_rng(seed)
+    shape = (len(time), len(latitudes), len(longitudes))
+    paths = []
+    for name, (units, mean, seasonal, daily, noise) in VARIABLES.items():
+        weather = np.cumsum(rng.normal(0, 1, len(time)))   # slow random walk, removed of its drift every month
+        weather = weather - np.convolve(weather, np.ones(720)/720, mode='same')
+        cycle = mean + seasonal*np.cos(2*np.pi*year) + daily*np.sin(2*np.pi*(day - 0.375)) + noise*weather/max(np.std(weather), 1e-9)
+        values = cycle[:, None, None] + rng.normal(0, noise/10, shape)
+        if name == 'tcwv':
+            values = np.abs(values)
+        values = values.astype(np.float32)
+        dims, coords = ('time', 'latitude', 'longitude'), {'time': time.astype('datetime64[ns]'), 'latitude': list(latitudes), 'longitude': list(longitudes)}
+        if expver:
+            split = np.searchsorted(time, time[-1].astype('datetime64[M]'))
+            era5, era5t = values.copy(), values.copy()
+            era5[split:], era5t[:split] = np.nan, np.nan
+            values = np.stack([era5, era5t], axis=1)
+            dims, coords = ('time', 'expver', 'latitude', 'longitude'), dict(coords, expver=[1, 5])
+        dataset = xr.Dataset({name: (dims, values, {'units': units})}, coords=coords)
+        path = os.path.join(directory, name+'.nc')
+        dataset.to_netcdf(path)
+        paths.append(path)
+    return paths
+
+## Reading the arguments
+########################
+if __name__ == '__main__':
+    if len(sys.argv) < 4:
+        print('Usage: '+sys.argv[0]+' DIRECTORY START_YEAR FINAL_YEAR [EXPVER]')
+        sys.exit(1)
+    directory, year1, year2 = sys.argv[1], int(sys.argv[2]), int(sys.argv[3])
+    expver = len(sys.argv) > 4 and sys.argv[4] == '1'
+    for path in generate(directory, year1, year2, expver=expver):
+        print('Dataset saved in '+path)
+########################
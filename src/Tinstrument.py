@@ -5,13 +5,15 @@
 #
 # The file is located under atmi/src.
 
+from lib import amstore
+from lib import amutils
 from lib import instrumentObs
+from lib import profiling
 from datetime import datetime
 import numpy as np
 import os
 import pandas as pd
 import sys
-from tqdm import tqdm
 
 with open(os.path.expanduser('~')+'/.atmi') as file:
     DIR = file.readline().strip('\n')   # Global path of the project
@@ -42,32 +44,43 @@ theta0, FWHM, freq1, freq2 = [float(theta0), float(FWHM), float(freq1), float(fr
 theta1, theta2 = theta0-5*FWHM, theta0+5*FWHM
 theta = np.linspace(theta1, theta2, 100)
 
-files = []
-for file in os.listdir(DIR+'/am/output'):
-    if file.startswith(spectrumfile):
-        if file.replace(spectrumfile, '').replace('.out', '').replace('_', '').isnumeric():
-            files.append(file)
+cube = DIR+'/am/output/'+spectrumfile+'.cube'
+if os.path.exists(cube+'/index.json'):   # spectra gathered by the am run
+    store = amstore.store(cube)
+    files = [name+'.out' for name in store.names]
+else:
+    store = None
+    files = []
+    for file in os.listdir(DIR+'/am/output'):
+        if file.startswith(spectrumfile):
+            if file.replace(spectrumfile, '').replace('.out', '').replace('_', '').isnumeric():
+                files.append(file)
         
+if len(files) == 0:
+	print('Spectrum files not found!')
+	sys.exit()
+
 print('\nCalculating the measurements of the instrument\t...')
-Tatm, y, m, d, h = [], [], [], [], []
-for i in tqdm(range(len(files)), desc='Loading ...'):
-    file = files[i]
-    df = pd.read_table(DIR+'/am/output/'+file, names=['Freq', 'Abs', 'Tb'], sep=' ')
-    T = np.array(df[(df['Freq'] >= freq1) & (df['Freq'] <= freq2)]['Tb'])
-    freq = np.array(df[(df['Freq'] >= freq1) & (df['Freq'] <= freq2)]['Freq'])
-    alpha = np.array(df[(df['Freq'] >= freq1) & (df['Freq'] <= freq2)]['Abs'])
-    
+report = profiling.report(DIR+'/outputs/instrument/'+spectrumfile+'.Tinstrument')
+with report.stage('reading', items=len(files)):
+    if store is not None:
+        print('Reading the spectra from '+cube)
+        freq, alpha, T = store.slice(freq1, freq2)
+    else:
+        jobs = int(os.environ.get('ATMI_JOBS', '0'))
+        freq, alpha, T = amutils.load_outputs([DIR+'/am/output/'+file for file in files], freq1, freq2, jobs=jobs)
+
+with report.stage('instrument', items=len(files)):
     band = np.zeros(len(freq)) + 1 # top-hat
     Pn = instrumentObs.Pn_gaussian(theta, theta0, FWHM)    # gaussian normalized antenna pattern
     obs = instrumentObs.instrument(theta, Pn, freq, band)
-    Tatm.append(obs.observation(T - 2.7*alpha))
-    mdh = file.replace(spectrumfile, '').replace('.out', '')
-    ymdh = file.replace(spectrumfile, '').replace('.out', '').split('_')
-    
-    if len(ymdh) > 1:
-        y.append(ymdh[0]), m.append(ymdh[1]), d.append(ymdh[2]), h.append(ymdh[3])
-    else:
-        m.append(mdh[0:2]), d.append(mdh[2:4]), h.append(mdh[4:6])
+    Tatm = obs.observation(np.asarray(T, dtype=float) - 2.7*np.asarray(alpha, dtype=float))   # all the spectra at once
+
+dates = pd.Series(files).str.slice(len(spectrumfile)).str.replace('.out', '', regex=False)
+if dates.str.contains('_').all():
+    y, m, d, h = [list(c) for _, c in dates.str.split('_', expand=True).items()]
+else:
+    y, m, d, h = [], list(dates.str.slice(0, 2)), list(dates.str.slice(2, 4)), list(dates.str.slice(4, 6))
 
 ###################################################
 
@@ -87,4 +100,5 @@ with open(DIR+'/outputs/instrument/'+spectrumfile+'.csv', 'a') as f:
 	df.to_csv(f, index=False)
     
 print('Results saved in '+DIR+'/outputs/instrument/'+spectrumfile+'.csv!')
+report.save()
 ####################################
@@ -5,14 +5,19 @@
 #
 # The file is located under atmi/src.
 
+from lib import amcache
+from lib import amemulator
+from lib import ammanifest
 from lib import amutils
+from lib import profiling
 import os
 import pandas as pd
 import sys
-from tqdm import tqdm
 
 with open(os.path.expanduser('~')+'/.atmi') as file:
     DIR = file.readline().strip('\n')   # Global path of the project
+PACK = os.environ.get('ATMI_PACK', '0') == '1'   # single archive for all the configuration files
+LAYERING = os.environ.get('ATMI_LAYERING', 'uniform')   # layering of the atmosphere
 
 ## Reading the configuration file
 #################################
@@ -39,24 +44,24 @@ N, freq_start, freq_stop, freq_interval = [int(N), float(freq_start), float(freq
 
 ## Saving all the configuration files
 #####################################
-df = pd.read_csv(samplingfile, header=1, names=['Month', 'Day', 'Hour', 'T', 'P', 'PWV'])
+report = profiling.report(DIR+'/am/output/'+filename+'.amconfig')
+with report.stage('reading'):
+    df = pd.read_csv(samplingfile, header=1, names=['Month', 'Day', 'Hour', 'T', 'P', 'PWV'])
+
+months, days, hours = [df[c].to_numpy(dtype=int) for c in ['Month', 'Day', 'Hour']]
+names = [filename+'%02d%02d%02d' % (months[i], days[i], hours[i]) for i in range(len(months))]
+with report.stage('profiles', items=len(names)):
+    Z, T, P, pwv = amutils.profiles_batch(amutils.params(paramsfile), df['T'], df['P'], df['PWV'], months, N, LAYERING)
 
-file = open(DIR+'/am/config/'+filename+'.txt', 'w')
 print('\nSaving the configuration files in '+DIR+'/am/config/ ...')
-for i in tqdm(range(len(df.index)), desc='Loading ...'):
-
-    m, d, h = str(int(df.iloc[i]['Month'])), str(int(df.iloc[i]['Day'])), str(int(df.iloc[i]['Hour']))
-    if len(m) == 1:
-        m = '0'+m
-    if len(d) == 1:
-        d = '0'+d
-    if len(h) == 1:
-        h = '0'+h
-    date = m+d+h
-
-    T0, P0, PWV = df.iloc[i]['T'], df.iloc[i]['P'], df.iloc[i]['PWV']
-    Z, T, P, pwv = amutils.profiles(paramsfile, T0, P0, PWV, int(m), N)
-    amutils.config(freq_start, freq_stop, freq_interval, 2.7, Z, T, P, pwv, DIR+'/am/config/'+filename+date)
-    file.write(filename+date+'\n')
-file.close()
+configs = amutils.configs(DIR+'/am/config', filename, pack=PACK)
+with report.stage('configs', items=len(names)):
+    texts = configs.texts(freq_start, freq_stop, freq_interval, 2.7, Z, T, P, pwv, desc='Loading ...')
+with report.stage('resume', items=len(names)):
+    model = amemulator.environment(paramsfile, N, freq_start, freq_stop, freq_interval, LAYERING)
+    left = ammanifest.resume(DIR, filename, names, [amcache.key(text) for text in texts], months, df['T'], df['P'], df['PWV'], model)
+with report.stage('writing', items=int(left.sum())):
+    configs.add([names[i] for i in range(len(names)) if left[i]], [texts[i] for i in range(len(names)) if left[i]])
+    configs.close()
+report.save()
 ####################################
@@ -2,20 +2,26 @@
 # @brief Generator of the am configuration file for the real data (specific dates).
 #
 # Python script necessary to calculate the vertical profiles of the atmospheric real data and write the am configuration file (specific dates only).
+# Many sites (comma separated latitudes, longitudes and parameters files) are extracted with a single read of each dataset, and each one gets its own configurations (<Filename>_<Site>), listed in am/config/<Filename>.sites.
 #
 # The file is located under atmi/src.
 
+from lib import amcache
+from lib import amemulator
+from lib import ammanifest
 from lib import amutils
 from datetime import datetime
 from lib import netCDFutils
+from lib import profiling
 import numpy as np
 import os
 import pandas as pd
 import sys
-from tqdm import tqdm
 
 with open(os.path.expanduser('~')+'/.atmi') as file:
     DIR = file.readline().strip('\n')   # Global path of the project
+PACK = os.environ.get('ATMI_PACK', '0') == '1'   # single archive for all the configuration files
+LAYERING = os.environ.get('ATMI_LAYERING', 'uniform')   # layering of the atmosphere
 
 ## Reading the configuration file
 #################################
@@ -34,14 +40,14 @@ var = var.split(',')
 starting_dates, final_dates = [], []
 for i in range(len(datafiles)):
     print('Datafile\t\t->\t'+datafiles[i])
-    if os.path.exists(datafiles[i]) == False:
+    if len(netCDFutils.paths(datafiles[i])) == 0:
 	    print('Directory not found!')
 	    sys.exit()
 	
-    data = netCDFutils.data(datafiles[i])   # opening dataset
-    names = data.variables()
-    starting_dates.append(data.dataset['time'].values.min())
-    final_dates.append(data.dataset['time'].values.max())
+    meta = netCDFutils.metadata(datafiles[i])   # reading the index of the dataset
+    names = meta['variables']
+    starting_dates.append(np.datetime64(meta['first']))
+    final_dates.append(np.datetime64(meta['last']))
 
     print('Varible\t\t\t->\t'+var[i])
     if names.count(var[i]) == 0:
@@ -71,7 +77,12 @@ if dates.min() < starting_dates.max() or dates.max() > final_dates.min():
 
 print('Latitude\t\t->\t'+lat)
 print('Longitude\t\t->\t'+lon)
-lat, lon = [float(lat), float(lon)]
+try:
+    sites, lats, lons, paramsfiles = netCDFutils.sites(lat, lon, paramsfile)
+except ValueError:
+    print('Sites not valid!')
+    sys.exit()
+filenames = [filename+'_'+site for site in sites] if len(sites) > 1 else [filename]   # outputs of each site
 
 print('N° Layers\t\t->\t'+N)
 N = int(N)
@@ -80,37 +91,61 @@ print('Ending Frequency\t->\t'+freq_stop+'GHz')
 print('Frequency Interval\t->\t'+freq_interval+'GHz')
     
 print('Parameters File\t\t->\t'+paramsfile)
+if len(sites) > 1:
+    print('Sites\t\t\t->\t'+', '.join(sites))
 print('Filename\t\t->\t'+filename+'\n')
 #################################
 
 ## Initializing the realizations
 ################################
-datas = []
-for datafile in datafiles:
-    datas.append(netCDFutils.data(datafile))
+report = profiling.report(DIR+'/am/output/'+filename+'.amdaterun')
+with report.stage('extraction', items=len(dates)*len(sites)):
+    datas = []
+    for datafile in datafiles:
+        datas.append(netCDFutils.load(datafile))
 
-data_loc_time = datas[0].dataset.sel(time=dates, longitude=lon, latitude=lat, method='nearest')
-variables = {'year': pd.to_datetime(data_loc_time['time'].values).year,
-    'month': pd.to_datetime(data_loc_time['time'].values).month,
-    'day': pd.to_datetime(data_loc_time['time'].values).day,
-    'hour': pd.to_datetime(data_loc_time['time'].values).hour
-    }
-for i in range(len(datas)):
-    variables[var[i]] = datas[i].values(lat, lon, dates, var[i])
+    axis = np.sort(datas[0].time.astype('datetime64[h]').astype(np.int64))
+    times = pd.to_datetime(axis[netCDFutils.nearest(axis, dates)].astype('datetime64[h]'))   # nearest times of the dataset
+    for i in range(len(datas)):
+        datas[i].extract(lats, lons, var[i])   # all the sites in a single read
 
-realizations = pd.DataFrame(variables)
+    realizations = []
+    for s in range(len(sites)):
+        variables = {'year': times.year,
+            'month': times.month,
+            'day': times.day,
+            'hour': times.hour
+            }
+        for i in range(len(datas)):
+            variables[var[i]] = datas[i].values(lats[s], lons[s], dates, var[i])
+        realizations.append(pd.DataFrame(variables))
 ################################
 
 ## Saving all the configuration files
 #####################################
-file = open(DIR+'/am/config/'+filename+'.txt', 'w')
 print('\nSaving the configuration files in '+DIR+'/am/config/ ...')
-for i in tqdm(range(len(realizations.index)), desc='Loading ...'):
-    y, m, d, h = int(realizations.iloc[i]['year']), int(realizations.iloc[i]['month']), int(realizations.iloc[i]['day']), int(realizations.iloc[i]['hour'])
-    date = str(y)+'_'+str(m)+'_'+str(d)+'_'+str(h)
-    T0, P0, PWV = realizations.iloc[i]['stl1'], realizations.iloc[i]['sp'], realizations.iloc[i]['tcwv']
-    Z, T, P, pwv = amutils.profiles(paramsfile, T0, P0, PWV, m, N)
-    amutils.config(freq_start, freq_stop, freq_interval, 2.7, Z, T, P, pwv, DIR+'/am/config/'+filename+date)
-    file.write(filename+date+'\n')
-file.close()
+for s in range(len(sites)):
+    years, months, days, hours = [realizations[s][c].to_numpy(dtype=int) for c in ['year', 'month', 'day', 'hour']]
+    names = [filenames[s]+str(years[i])+'_'+str(months[i])+'_'+str(days[i])+'_'+str(hours[i]) for i in range(len(months))]
+    T0, P0, PWV = realizations[s]['stl1'], realizations[s]['sp'], realizations[s]['tcwv']
+    with report.stage('profiles', items=len(names)):
+        Z, T, P, pwv = amutils.profiles_batch(amutils.params(paramsfiles[s]), T0, P0, PWV, months, N, LAYERING)
+
+    configs = amutils.configs(DIR+'/am/config', filenames[s], pack=PACK)
+    with report.stage('configs', items=len(names)):
+        texts = configs.texts(freq_start, freq_stop, freq_interval, 2.7, Z, T, P, pwv, desc='Loading ...')
+    with report.stage('resume', items=len(names)):
+        model = amemulator.environment(paramsfiles[s], N, freq_start, freq_stop, freq_interval, LAYERING)
+        left = ammanifest.resume(DIR, filenames[s], names, [amcache.key(text) for text in texts], months, T0, P0, PWV, model)
+    with report.stage('writing', items=int(left.sum())):
+        configs.add([names[i] for i in range(len(names)) if left[i]], [texts[i] for i in range(len(names)) if left[i]])
+        configs.close()
+
+sitesfile = DIR+'/am/config/'+filename+'.sites'   # configurations of each site, for the am execution
+if len(sites) > 1:
+    with open(sitesfile, 'w') as f:
+        f.write('\n'.join(filenames)+'\n')
+elif os.path.exists(sitesfile):
+    os.remove(sitesfile)
+report.save()
 ####################################
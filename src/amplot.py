@@ -5,6 +5,7 @@
 #
 # The file is located under atmi/src.
 
+from lib import amstore
 from lib import amutils
 import os
 import sys
@@ -14,4 +15,9 @@ with open(os.path.expanduser('~')+'/.atmi') as file:
 
 filename = sys.argv[1]
 print('Plotting on canvas the results ...')
-amutils.am_plot(DIR+'/am/output/'+filename+'.out')
+cube = DIR+'/am/output/'+filename+'.cube'
+store = amstore.store(cube) if os.path.exists(cube+'/index.json') else None
+if store is not None and filename in store.names:
+    amutils.spectrum_plot(store.freq, store.array('Tb')[store.names.index(filename)])
+else:
+    amutils.am_plot(DIR+'/am/output/'+filename+'.out')
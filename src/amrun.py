@@ -0,0 +1,68 @@
+## @file src/amrun.py
+# @brief Parallel executor of am.
+#
+# Python script necessary to run am over all the configuration files listed in am/config/<name>.txt, through a bounded pool of workers.
+# The configurations are read from the archive am/config/<name>.amcpack, if present.
+# The spectra already computed for an identical atmosphere are taken from the cache in am/cache.
+# The configurations are given to am through a pipe and the spectra are read from its standard output; ATMI_FILES=1 keeps the am/output/<realization>.out files, for debugging.
+# The resulting spectra are gathered in the store am/output/<name>.cube as soon as they are computed, after the ones served by the emulator.
+# The state of each realization is recorded in the manifest am/output/<name>.manifest, and the timings in am/output/<name>.amrun.profile.json.
+#
+# The file is located under atmi/src.
+
+from lib import amcache
+from lib import ammanifest
+from lib import amrunner
+from lib import amstore
+from lib import amutils
+from lib import profiling
+import os
+import sys
+
+with open(os.path.expanduser('~')+'/.atmi') as file:
+    DIR = file.readline().strip('\n')   # Global path of the project
+FILES = os.environ.get('ATMI_FILES', '0') == '1'   # am output files kept on disk
+
+## Reading the arguments
+########################
+name = sys.argv[1]
+jobs = int(sys.argv[2]) if len(sys.argv) > 2 else 0
+retries = int(sys.argv[3]) if len(sys.argv) > 3 else 1
+cachesize = float(sys.argv[4]) if len(sys.argv) > 4 else 0   # MB, 0 disables the cache
+
+listfile = DIR+'/am/config/'+name+'.txt'
+if os.path.exists(listfile) == False:
+	print('Directory not found!')
+	sys.exit(1)
+
+with open(listfile) as f:
+	names = [line.strip() for line in f if line.strip() != '']
+########################
+
+## Running am
+#############
+report = profiling.report(DIR+'/am/output/'+name+'.amrun')
+cache = amcache.cache(DIR+'/am/cache', cachesize*2**20) if cachesize > 0 else None
+archive = None
+if os.path.exists(DIR+'/am/config/'+name+'.amcpack'):
+	print('Reading the configurations from '+DIR+'/am/config/'+name+'.amcpack')
+	archive = amutils.archive(DIR+'/am/config/'+name+'.amcpack')
+cube = DIR+'/am/output/'+name+'.cube'
+store = amstore.store(cube, 'a' if os.path.exists(cube+'/index.json') else 'w')   # the emulated spectra may be already there
+stored = set(store.names)   # completed by an interrupted execution
+names = [n for n in names if n not in stored]
+runs = ammanifest.manifest(DIR+'/am/output/'+name+'.manifest')
+runner = amrunner.runner(DIR+'/am/config', DIR+'/am/output', jobs=jobs, retries=retries, logfile=DIR+'/am/output/'+name+'.log', cache=cache, archive=archive, store=store, manifest=runs, files=FILES)
+with report.stage('dispatch', items=len(names)):
+	done, failed = runner.run(names)
+	store.close()
+	runs.close()
+report.latency('am', runner.latencies)
+report.save()
+print('Spectra gathered in '+DIR+'/am/output/'+name+'.cube')
+if archive is not None:
+	archive.close()
+print('Exit status of each run saved in '+DIR+'/am/output/'+name+'.log')
+if failed != 0:
+	sys.exit(1)
+#############
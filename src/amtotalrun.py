@@ -2,24 +2,44 @@
 # @brief Generator of the am configuration file for the real data.
 #
 # Python script necessary to calculate the vertical profiles of the atmospheric real data and write the am configuration file.
+# The data are read in blocks of ATMI_CHUNK hours, so that the memory does not grow with the period.
+# Given the am execution arguments (as amrun.py), the configurations of each block are dispatched to am while the next block is read, through pipes: the .amc and .out files are written only with ATMI_FILES=1.
+# The timings of the stages are saved in am/output/<Filename>.amtotalrun.profile.json.
+# Many sites (comma separated latitudes, longitudes and parameters files) are extracted with a single read of each block, and each one gets its own outputs (<Filename>_<Site>).
+#
+# Usage: amtotalrun.py CONFIG [JOBS RETRIES CACHE_MB]
 #
 # The file is located under atmi/src.
 
+from concurrent.futures import ThreadPoolExecutor
+from lib import amcache
+from lib import amemulator
+from lib import ammanifest
+from lib import amrunner
+from lib import amstore
 from lib import amutils
 from datetime import datetime
 from lib import netCDFutils
+from lib import profiling
 import numpy as np
 import os
 import pandas as pd
 import sys
-from tqdm import tqdm
 
 with open(os.path.expanduser('~')+'/.atmi') as file:
     DIR = file.readline().strip('\n')   # Global path of the project
+PACK = os.environ.get('ATMI_PACK', '0') == '1'   # single archive for all the configuration files
+FILES = os.environ.get('ATMI_FILES', '0') == '1'   # configuration and output files kept on disk while am runs
+LAYERING = os.environ.get('ATMI_LAYERING', 'uniform')   # layering of the atmosphere
+CHUNK = int(os.environ.get('ATMI_CHUNK', '8760'))   # hours of data extracted at once
 
 ## Reading the configuration file
 #################################
 conf_file = sys.argv[1]
+stream = len(sys.argv) > 2   # am runs while the data are read
+jobs = int(sys.argv[2]) if len(sys.argv) > 2 else 0
+retries = int(sys.argv[3]) if len(sys.argv) > 3 else 1
+cachesize = float(sys.argv[4]) if len(sys.argv) > 4 else 0   # MB, 0 disables the cache
 if os.path.exists(conf_file) == False:
 	print('Directory not found!')
 	sys.exit()
@@ -34,14 +54,14 @@ var = var.split(',')
 starting_years, final_years = [], []
 for i in range(len(datafiles)):
     print('Datafile\t\t->\t'+datafiles[i])
-    if os.path.exists(datafiles[i]) == False:
+    if len(netCDFutils.paths(datafiles[i])) == 0:
 	    print('Directory not found!')
 	    sys.exit()
 	
-    data = netCDFutils.data(datafiles[i])   # opening dataset
-    names = data.variables()
-    starting_years.append(data.start)
-    final_years.append(data.stop)
+    meta = netCDFutils.metadata(datafiles[i])   # reading the index of the dataset
+    names = meta['variables']
+    starting_years.append(meta['start'])
+    final_years.append(meta['stop'])
 
     print('Varible\t\t\t->\t'+var[i])
     if names.count(var[i]) == 0:
@@ -63,7 +83,12 @@ if (float(year2) != int(year2)) or (float(year2) < 0) or (float(year2) > final_y
 
 print('Latitude\t\t->\t'+lat)
 print('Longitude\t\t->\t'+lon)
-lat, lon = [float(lat), float(lon)]
+try:
+    sites, lats, lons, paramsfiles = netCDFutils.sites(lat, lon, paramsfile)
+except ValueError:
+    print('Sites not valid!')
+    sys.exit()
+filenames = [filename+'_'+site for site in sites] if len(sites) > 1 else [filename]   # outputs of each site
 
 print('N° Layers\t\t->\t'+N)
 N = int(N)
@@ -72,6 +97,8 @@ print('Ending Frequency\t->\t'+freq_stop+'GHz')
 print('Frequency Interval\t->\t'+freq_interval+'GHz')
     
 print('Parameters File\t\t->\t'+paramsfile)
+if len(sites) > 1:
+    print('Sites\t\t\t->\t'+', '.join(sites))
 print('Filename\t\t->\t'+filename+'\n')
 #################################
 
@@ -79,46 +106,125 @@ print('Filename\t\t->\t'+filename+'\n')
 ################################
 datas = []
 for datafile in datafiles:
-    datas.append(netCDFutils.data(datafile))
+    datas.append(netCDFutils.load(datafile))
     
 date1 = np.datetime64(str(year1)+'-01-01T00')
 date2 = np.datetime64(str(year2)+'-01-01T00')
 
-start = np.array(datas[0].dataset['time'][0])
-stop = np.array(datas[0].dataset['time'][-1])
+start = np.datetime64(netCDFutils.metadata(datafiles[0])['first'])
+stop = np.datetime64(netCDFutils.metadata(datafiles[0])['last'])
 if date1 < start:
     date1 = start
 if date2 > stop:
     date2 = stop
 
 hours = (date2 - date1) // np.timedelta64(1,'h')
+blocks = range(0, hours+1, CHUNK)
 
-dates = []
-for h in range(hours+1):
-    dates.append(date1 + np.timedelta64(h,'h'))
-    
-data_loc_time = datas[0].dataset.sel(time=dates, longitude=lon, latitude=lat, method='nearest')
-variables = {'year': pd.to_datetime(data_loc_time['time'].values).year,
-    'month': pd.to_datetime(data_loc_time['time'].values).month,
-    'day': pd.to_datetime(data_loc_time['time'].values).day,
-    'hour': pd.to_datetime(data_loc_time['time'].values).hour
-    }
-for i in range(len(datas)):
-    variables[var[i]] = datas[i].values(lat, lon, dates, var[i])
-
-realizations = pd.DataFrame(variables)
+## This function extracts a block of consecutive hours from the datasets, for all the sites at once.
+#
+#  @param b The first hour of the block (from the starting date).
+#  @return The dataset times (in hours since 1970-01-01) and the values of each variable, with shape (number of hours, number of sites).
+def block(b):
+    dates = np.datetime64(date1, 'h') + np.arange(b, min(b+CHUNK, hours+1)).astype('timedelta64[h]')
+    times, values = datas[0].block_values(lats, lons, dates, var[0])
+    variables = {var[0]: values}
+    for i in range(1, len(datas)):
+        variables[var[i]] = datas[i].block_values(lats, lons, dates, var[i])[1]
+    return times, variables
 ################################
 
-## Saving all the configuration files
-#####################################
-file = open(DIR+'/am/config/'+filename+'.txt', 'w')
-print('\nSaving the configuration files in '+DIR+'/am/config/ ...')
-for i in tqdm(range(len(realizations.index)), desc='Loading ...'):
-    y, m, d, h = int(realizations.iloc[i]['year']), int(realizations.iloc[i]['month']), int(realizations.iloc[i]['day']), int(realizations.iloc[i]['hour'])
-    date = str(y)+'_'+str(m)+'_'+str(d)+'_'+str(h)
-    T0, P0, PWV = realizations.iloc[i]['stl1'], realizations.iloc[i]['sp'], realizations.iloc[i]['tcwv']
-    Z, T, P, pwv = amutils.profiles(paramsfile, T0, P0, PWV, m, N)
-    amutils.config(freq_start, freq_stop, freq_interval, 2.7, Z, T, P, pwv, DIR+'/am/config/'+filename+date)
-    file.write(filename+date+'\n')
-file.close()
-####################################
+## Saving the configuration files and running am, one block at a time
+#####################################################################
+report = profiling.report(DIR+'/am/output/'+filename+'.amtotalrun')
+params = [amutils.params(p) for p in paramsfiles]
+models = [amemulator.environment(p, N, freq_start, freq_stop, freq_interval, LAYERING) for p in paramsfiles]
+piped = stream and not FILES   # configurations given to am without writing them
+header = str(datetime.now())   # header of the configurations
+stores, stored, runs, configs = [], [], [], []
+for name in filenames:
+    cube = DIR+'/am/output/'+name+'.cube'
+    stores.append(amstore.store(cube, 'a' if os.path.exists(cube+'/index.json') else 'w'))
+    stored.append(set(stores[-1].names))
+    runs.append(ammanifest.manifest(DIR+'/am/output/'+name+'.manifest'))
+    configs.append(amutils.configs(DIR+'/am/config', name, pack=PACK) if not piped else None)   # nothing written on disk when piped
+runner = None
+if stream:
+    cache = amcache.cache(DIR+'/am/cache', cachesize*2**20) if cachesize > 0 else None
+    runner = amrunner.runner(DIR+'/am/config', DIR+'/am/output', jobs=jobs, retries=retries, logfile=DIR+'/am/output/'+filename+'.log', cache=cache, store=stores[0], manifest=runs[0], files=FILES)
+    runner.start()
+
+if piped:
+    print('\nGiving the configurations to am through pipes ('+str(len(blocks))+' blocks of '+str(CHUNK)+' hours) ...')
+else:
+    print('\nSaving the configuration files in '+DIR+'/am/config/ ('+str(len(blocks))+' blocks of '+str(CHUNK)+' hours) ...')
+queued = 0
+completed = [[] for s in sites]   # realizations whose spectrum in the store is valid, for each site
+served = 0
+owner = {}   # site of each realization given to am
+with ThreadPoolExecutor(max_workers=1) as reader:   # the next block is read while the current one runs
+    future = reader.submit(block, blocks[0])
+    for k in range(len(blocks)):
+        with report.stage('extraction') as stage:   # waiting for the reader
+            times, variables = future.result()
+            stage.items = stage.items + len(times)*len(sites)
+        if k+1 < len(blocks):
+            future = reader.submit(block, blocks[k+1])
+        dates = pd.to_datetime(times.astype('datetime64[h]'))
+        years, months, days, hs = [np.asarray(x, dtype=int) for x in [dates.year, dates.month, dates.day, dates.hour]]
+        for s in range(len(sites)):
+            with report.stage('profiles', items=len(times)):
+                names = [filenames[s]+str(years[i])+'_'+str(months[i])+'_'+str(days[i])+'_'+str(hs[i]) for i in range(len(months))]
+                T0, P0, PWV = [np.asarray(variables[v][:, s], dtype=float) for v in ['stl1', 'sp', 'tcwv']]
+                Z, T, P, pwv = amutils.profiles_batch(params[s], T0, P0, PWV, months, N, LAYERING)
+            with report.stage('configs', items=len(times)):
+                if piped:
+                    texts = [amutils.config_text(freq_start, freq_stop, freq_interval, 2.7, Z[i], T[i], P[i], pwv[i], header) for i in range(len(Z))]
+                else:
+                    texts = configs[s].texts(freq_start, freq_stop, freq_interval, 2.7, Z, T, P, pwv)
+                keys = [amcache.key(text) for text in texts]
+                key = dict(zip(names, keys))
+            with report.stage('resume', items=len(times)):
+                left = ~runs[s].done(names, keys, stored[s])
+                completed[s].extend(names[i] for i in np.where(~left)[0])
+                if models[s] is not None:
+                    rows = np.where(left)[0]
+                    ok = models[s].serve(stores[s], [names[i] for i in rows], months[rows], T0[rows], P0[rows], PWV[rows], DIR+'/am/output/'+filenames[s]+'.emulator.csv', append=k > 0,
+                        record=lambda name, tau, Tb, s=s, key=key: runs[s].record(name, key[name], 'emulated', amstore.checksum(tau, Tb)))
+                    left[rows[ok]] = False
+                    completed[s].extend(names[i] for i in rows[ok])
+                    served = served + ok.sum()
+            rows = np.where(left)[0]
+            with report.stage('writing', items=len(rows)):   # waiting for am when too many runs are pending
+                if not piped:
+                    configs[s].add([names[i] for i in rows], [texts[i] for i in rows])
+                queued = queued + len(rows)
+                if runner is not None:
+                    for i in rows:
+                        owner[names[i]] = s
+                        runner.submit(names[i], texts[i], stores[s], runs[s])
+for c in configs:
+    if c is not None:
+        c.close()
+print(str(sum(len(c) for c in completed) - served)+' realizations already completed, '+str(queued)+(' configurations given to am' if piped else ' configuration files saved')+(', '+str(served)+' realizations served by the emulator (error estimates in '+DIR+'/am/output/'+filename+'*.emulator.csv)' if any(m is not None for m in models) else ''))
+
+if runner is not None:
+    with report.stage('dispatch') as stage:   # waiting for the last runs
+        done, failed = runner.join()
+        stage.items = done + failed
+    for name in runner.done:
+        completed[owner[name]].append(name)
+    report.latency('am', runner.latencies)
+with report.stage('compact', items=sum(len(c) for c in completed)):
+    for s in range(len(sites)):
+        stores[s].compact(completed[s])   # drops the spectra of older configurations and of the realizations out of the period
+        stores[s].close()
+        runs[s].close()
+report.save()
+for name in filenames:
+    print('Spectra gathered in '+DIR+'/am/output/'+name+'.cube')
+if runner is not None:
+    print('Exit status of each run saved in '+DIR+'/am/output/'+filename+'.log')
+    if failed != 0:
+        sys.exit(1)
+#####################################################################
@@ -0,0 +1,193 @@
+## @file src/atmid.py
+# @brief Persistent worker of atmi.
+#
+# Python script keeping a long-lived process that runs the atmi scripts on request, so that the libraries are imported once and the datasets, the extracted series and the parameters files stay in memory between requests (see lib.netCDFutils.load and lib.amutils.params).
+# The worker listens on the Unix socket ~/.atmi.sock (or ATMI_SOCKET), reachable only by its owner; the requests are run one at a time, in the order they arrive, and only for the scripts of atmi/src.
+#
+# Usage: atmid.py serve | stop | status | run SCRIPT [ARGS]
+# - serve: start the worker in the foreground.
+# - stop: stop the running worker.
+# - status: tell whether a worker is running, with the number of served requests and the open datasets.
+# - run: run a script through the worker, forwarding its output and its exit status (used by atmi); if the worker is not reachable, it exits with UNREACHABLE, removing the socket left by a dead worker, and atmi runs the script directly.
+#
+# The file is located under atmi/src.
+
+import contextlib
+import json
+import os
+import socket
+import sys
+import threading
+import traceback
+
+SOCKET = os.environ.get('ATMI_SOCKET', os.path.expanduser('~')+'/.atmi.sock')   # path of the worker socket
+SRC = os.path.dirname(os.path.realpath(__file__))   # the scripts the worker runs
+UNREACHABLE = 75   # exit status of run when the worker is not reachable (EX_TEMPFAIL)
+
+## This class represents a stream sending the output of a request to the client.
+class stream:
+
+    ## The constructor for the class.
+    #
+    #  @param self The object pointer.
+    #  @param connection The socket connected to the client.
+    #  @param name The name of the stream: 'out' or 'err'.
+    def __init__(self, connection, name):
+        self.connection = connection
+        self.name = name
+
+    ## This method sends a text to the client.
+    #
+    #  @param self The object pointer.
+    #  @param text The text.
+    def write(self, text):
+        if text:
+            self.connection.sendall((json.dumps({self.name: text})+'\n').encode())
+        return len(text)
+
+    ## This method does nothing, the text being sent as soon as it is written.
+    #
+    #  @param self The object pointer.
+    def flush(self):
+        pass
+
+    ## This method tells that the stream is not a terminal.
+    #
+    #  @param self The object pointer.
+    def isatty(self):
+        return False
+
+## This function runs a script in the worker process, as if it was run by python3.
+#
+#  @param request The request: the script and its arguments ('argv'), the working directory ('cwd') and the ATMI_* environment variables ('env').
+#  @param connection The socket connected to the client.
+#  @return The exit status of the script.
+def execute(request, connection):
+    import runpy
+    argv, cwd, environ = sys.argv, os.getcwd(), dict(os.environ)
+    code = 0
+    script = os.path.realpath(request['argv'][0])
+    if os.path.dirname(script) != SRC or not script.endswith('.py') or not os.path.isfile(script):
+        stream(connection, 'err').write('Script not valid: only the scripts of '+SRC+' are run by the worker!\n')
+        return 1
+    try:
+        sys.argv = request['argv']
+        os.chdir(request['cwd'])
+        for k in [k for k in os.environ if k.startswith('ATMI_')]:
+            del os.environ[k]
+        os.environ.update(request['env'])
+        with contextlib.redirect_stdout(stream(connection, 'out')), contextlib.redirect_stderr(stream(connection, 'err')):
+            try:
+                runpy.run_path(request['argv'][0], run_name='__main__')
+            except SystemExit as e:
+                if isinstance(e.code, int):
+                    code = e.code
+                elif e.code is not None:
+                    print(e.code, file=sys.stderr)
+                    code = 1
+            except Exception:
+                traceback.print_exc()
+                code = 1
+    finally:
+        sys.argv = argv
+        os.chdir(cwd)
+        os.environ.clear()
+        os.environ.update(environ)
+    return code
+
+## This function starts the worker, serving the requests until a stop request.
+def serve():
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from lib import amutils, netCDFutils   # imported once for all the requests
+    if os.path.exists(SOCKET):
+        os.remove(SOCKET)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    mask = os.umask(0o077)   # the socket is created reachable only by its owner
+    try:
+        server.bind(SOCKET)
+    finally:
+        os.umask(mask)
+    os.chmod(SOCKET, 0o600)
+    server.listen()
+    lock = threading.Lock()
+    served = [0]
+    stop = threading.Event()
+
+    def handle(connection):
+        with connection, connection.makefile('r') as f:
+            request = json.loads(f.readline())
+            if request.get('stop'):
+                stop.set()
+                connection.sendall((json.dumps({'exit': 0})+'\n').encode())
+                socket.socket(socket.AF_UNIX, socket.SOCK_STREAM).connect(SOCKET)   # wakes up the accept
+                return
+            if request.get('status'):
+                status = {'pid': os.getpid(), 'served': served[0], 'datasets': sorted(netCDFutils._datasets), 'params': sorted(amutils._params)}
+                connection.sendall((json.dumps({'out': json.dumps(status, indent=1)+'\n'})+'\n').encode())
+                connection.sendall((json.dumps({'exit': 0})+'\n').encode())
+                return
+            with lock:   # the scripts share the process state (arguments, directory, output)
+                try:
+                    code = execute(request, connection)
+                except OSError:   # client gone
+                    return
+                served[0] = served[0] + 1
+            connection.sendall((json.dumps({'exit': code})+'\n').encode())
+
+    print('atmi worker listening on '+SOCKET+' (pid '+str(os.getpid())+')')
+    try:
+        while not stop.is_set():
+            connection, _ = server.accept()
+            if stop.is_set():
+                connection.close()
+                break
+            threading.Thread(target=handle, args=(connection,), daemon=True).start()
+    finally:
+        server.close()
+        if os.path.exists(SOCKET):
+            os.remove(SOCKET)
+    print('atmi worker stopped')
+
+## This function sends a request to the worker, printing its output.
+#
+#  @param request The request.
+#  @param quiet If True, nothing is printed when the worker is not reachable.
+#  @return The exit status, UNREACHABLE if the worker is not reachable.
+def send(request, quiet=False):
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(SOCKET)
+    except OSError as e:
+        client.close()
+        if isinstance(e, ConnectionRefusedError) and os.path.exists(SOCKET):   # left by a worker killed without cleanup
+            os.remove(SOCKET)
+        if not quiet:
+            print('atmi worker not running on '+SOCKET, file=sys.stderr)
+        return UNREACHABLE
+    with client, client.makefile('r') as f:
+        client.sendall((json.dumps(request)+'\n').encode())
+        for line in f:
+            message = json.loads(line)
+            if 'exit' in message:
+                return message['exit']
+            (sys.stdout if 'out' in message else sys.stderr).write(message.get('out', message.get('err')))
+            (sys.stdout if 'out' in message else sys.stderr).flush()
+    return 1   # worker gone
+
+## Reading the arguments
+########################
+if __name__ == '__main__':
+    command = sys.argv[1] if len(sys.argv) > 1 else ''
+    if command == 'serve':
+        serve()
+    elif command == 'stop':
+        sys.exit(send({'stop': True}))
+    elif command == 'status':
+        sys.exit(send({'status': True}))
+    elif command == 'run' and len(sys.argv) > 2:
+        env = {k: v for k, v in os.environ.items() if k.startswith('ATMI_')}
+        sys.exit(send({'argv': [os.path.abspath(sys.argv[2])] + sys.argv[3:], 'cwd': os.getcwd(), 'env': env}, quiet=True))
+    else:
+        print('Usage: '+sys.argv[0]+' serve | stop | status | run SCRIPT [ARGS]')
+        sys.exit(1)
+########################
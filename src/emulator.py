@@ -0,0 +1,98 @@
+## @file src/emulator.py
+# @brief Builder of the emulator of the am spectra.
+#
+# Python script necessary to precompute the am spectra on an adaptive grid over the surface variables (T0, P0, PWV) seen in the data archive, month by month, and save them as a lookup table.
+# The emulator is used by the -t, -r and -d methods when the ATMI_EMULATOR environment variable gives its path.
+#
+# The file is located under atmi/src.
+
+from lib import amemulator
+from lib import netCDFutils
+import numpy as np
+import os
+import sys
+
+with open(os.path.expanduser('~')+'/.atmi') as file:
+    DIR = file.readline().strip('\n')   # Global path of the project
+JOBS = int(os.environ.get('ATMI_JOBS', '0'))   # parallel am processes (0 = all the available cores)
+LAYERING = os.environ.get('ATMI_LAYERING', 'uniform')   # layering of the atmosphere
+
+## Reading the configuration file
+#################################
+conf_file = sys.argv[1]
+if os.path.exists(conf_file) == False:
+	print('Directory not found!')
+	sys.exit()
+
+with open(conf_file) as f:
+	args = f.readlines()
+	args = [arg.rstrip('\n') for arg in args]
+datafiles, var, year1, year2, lat, lon, N, freq_start, freq_stop, freq_interval, paramsfile, tol, filename = args
+datafiles = datafiles.split(',')
+var = var.split(',')
+
+if len(datafiles) != 3 or len(var) != 3:
+    print('Three datafiles and variables (T0, P0, PWV) are needed!')
+    sys.exit()
+
+datas = []
+for i in range(len(datafiles)):
+    print('Datafile\t\t->\t'+datafiles[i])
+    if len(netCDFutils.paths(datafiles[i])) == 0:
+	    print('Directory not found!')
+	    sys.exit()
+
+    print('Varible\t\t\t->\t'+var[i])
+    if netCDFutils.metadata(datafiles[i])['variables'].count(var[i]) == 0:   # reading the index of the dataset
+        print('Variable name not valid!')
+        sys.exit()
+
+    datas.append(netCDFutils.load(datafiles[i]))   # opening dataset
+
+print('Starting Year\t\t->\t'+year1)
+print('Final Year\t\t->\t'+year2)
+if (float(year1) != int(year1)) or (float(year2) != int(year2)) or (int(year1) > int(year2)):
+        print('Years not valid!')
+        sys.exit()
+
+print('Latitude\t\t->\t'+lat)
+print('Longitude\t\t->\t'+lon)
+lat, lon = [float(lat), float(lon)]
+
+print('N° Layers\t\t->\t'+N)
+print('Starting Frequency\t->\t'+freq_start+'GHz')
+print('Ending Frequency\t->\t'+freq_stop+'GHz')
+print('Frequency Interval\t->\t'+freq_interval+'GHz')
+print('Parameters File\t\t->\t'+paramsfile)
+print('Tolerance\t\t->\t'+tol+'K')
+print('Filename\t\t->\t'+filename+'\n')
+
+N, freq_start, freq_stop, freq_interval, tol = [int(N), float(freq_start), float(freq_stop), float(freq_interval), float(tol)]
+#################################
+
+## Finding the ranges of the surface variables
+##############################################
+ranges = {}
+for i in range(len(datas)):
+    hours, values = datas[i].series(lat, lon, var[i])
+    dates = hours.astype('datetime64[h]')
+    years = dates.astype('datetime64[Y]').astype(int) + 1970
+    months = dates.astype('datetime64[M]').astype(int) % 12 + 1
+    keep = (years >= int(year1)) & (years <= int(year2)) & np.isfinite(values)
+    for month in np.unique(months[keep]):
+        v = values[keep & (months == month)]
+        ranges.setdefault(int(month), []).append((float(v.min()), float(v.max())))
+ranges = {month: r for month, r in ranges.items() if len(r) == 3}
+##############################################
+
+## Building the emulator
+########################
+model = amemulator.emulator.build(paramsfile, ranges, N, freq_start, freq_stop, freq_interval, tol, layering=LAYERING, jobs=JOBS)
+for month in sorted(model.tables):
+    table = model.tables[month]
+    print('Month '+str(month)+'\t->\t'+'x'.join(str(len(ax)) for ax in table['axes'])+' nodes, max estimated error '+'%.3f' % np.nanmax(np.concatenate(table['errors']))+' K')
+
+os.makedirs(DIR+'/outputs/emulator', exist_ok=True)
+model.save(DIR+'/outputs/emulator/'+filename+'.npz')
+print('Emulator saved in '+DIR+'/outputs/emulator/'+filename+'.npz!')
+########################
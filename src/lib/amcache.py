@@ -0,0 +1,220 @@
+"""! @brief Defines a persistent cache for the am spectra."""
+##
+# @file src/lib/amcache.py
+# @brief File for the lib.amcache package.
+#
+# The file is located under atmi/src/lib.
+#
+# @package lib.amcache
+# @brief Defines a persistent cache for the am spectra.
+#
+# @section description_amcache Description
+# Defines the content-addressed cache of the am output files, keyed on the normalized content of the am configuration files.
+# - normalize (function)
+# - key (function)
+# - cache (class)
+#
+# @section libraries_amcache Libraries/Modules
+# - hashlib standard library (https://docs.python.org/3/library/hashlib.html)
+#   - Access to sha256 function.
+# - json standard library (https://docs.python.org/3/library/json.html)
+#   - Access to load and dump functions, for the statistics file.
+# - os standard library (https://docs.python.org/3/library/os.html)
+#   - Access to files and directories manipulation functions.
+# - shutil standard library (https://docs.python.org/3/library/shutil.html)
+#   - Access to copyfile function.
+# - threading standard library (https://docs.python.org/3/library/threading.html)
+#   - Access to Lock class.
+#
+# @section notes_amcache Notes
+# - Comments are Doxygen compatible.
+# - The comment lines (as the creation date header) do not take part in the key.
+#
+# @section todo_amcache TODO
+# - None.
+
+import hashlib
+import json
+import os
+import shutil
+import threading
+
+## This function normalizes the content of an am configuration file, removing comment lines, blank lines and trailing spaces.
+#
+#  @param text The content of the am configuration file.
+def normalize(text):
+    lines = [line.rstrip() for line in text.splitlines()]
+    return '\n'.join(line for line in lines if line != '' and not line.startswith('#'))
+
+## This function gives the cache key of an am configuration file.
+#
+#  @param text The content of the am configuration file.
+def key(text):
+    return hashlib.sha256(normalize(text).encode()).hexdigest()
+
+## This class represents the on-disk cache of the am spectra.
+#
+#  The least recently used spectra are evicted when the size of the cache exceeds the limit.
+class cache:
+
+    ## The constructor for the class.
+    #
+    #  @param self The object pointer.
+    #  @param directory The directory of the cache.
+    #  @param maxsize The maximum size of the cache (in bytes).
+    def __init__(self, directory, maxsize):
+        ## The directory of the cache.
+        self.directory = directory
+        ## The maximum size of the cache (in bytes).
+        self.maxsize = maxsize
+        ## The number of cache hits of the current session.
+        self.hits = 0
+        ## The number of cache misses of the current session.
+        self.misses = 0
+        ## The number of spectra evicted in the current session.
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._entries = {}   # key -> [size, last use]
+        os.makedirs(directory, exist_ok=True)
+        for sub in os.listdir(directory):
+            if os.path.isdir(os.path.join(directory, sub)):
+                for file in os.listdir(os.path.join(directory, sub)):
+                    if file.endswith('.out'):
+                        st = os.stat(os.path.join(directory, sub, file))
+                        self._entries[file[:-4]] = [st.st_size, st.st_mtime]
+        ## The total size of the cached spectra (in bytes).
+        self.size = sum(entry[0] for entry in self._entries.values())
+
+    ## This method gives the path of a cached spectrum.
+    #
+    #  @param self The object pointer.
+    #  @param k The cache key.
+    def path(self, k):
+        return os.path.join(self.directory, k[:2], k+'.out')
+
+    ## This method copies a cached spectrum to the output file, if present.
+    #
+    #  @param self The object pointer.
+    #  @param k The cache key.
+    #  @param outfile The path to the am output file.
+    def get(self, k, outfile):
+        return self._fetch(k, lambda path: shutil.copyfile(path, outfile)) is not None
+
+    ## This method gives a cached spectrum, as written by am on its standard output.
+    #
+    #  @param self The object pointer.
+    #  @param k The cache key.
+    #  @return The output of am, or None if not cached.
+    def read(self, k):
+        def read(path):
+            with open(path) as f:
+                return f.read()
+        return self._fetch(k, read)
+
+    ## This method reads a cached spectrum, updating the statistics and the last use.
+    #
+    #  @param self The object pointer.
+    #  @param k The cache key.
+    #  @param function The function reading the cached file, given its path.
+    #  @return The result of the function, or None if not cached.
+    def _fetch(self, k, function):
+        with self._lock:
+            hit = k in self._entries
+            if hit:
+                self.hits = self.hits + 1
+            else:
+                self.misses = self.misses + 1
+        if not hit:
+            return None
+        try:
+            result = function(self.path(k))
+            os.utime(self.path(k))
+        except OSError:   # evicted in the meanwhile
+            with self._lock:
+                self.hits, self.misses = self.hits - 1, self.misses + 1
+            return None
+        with self._lock:
+            if k in self._entries:
+                self._entries[k][1] = os.stat(self.path(k)).st_mtime
+        return result
+
+    ## This method stores a spectrum in the cache, evicting the least recently used ones if needed.
+    #
+    #  @param self The object pointer.
+    #  @param k The cache key.
+    #  @param outfile The path to the am output file.
+    def put(self, k, outfile):
+        self._add(k, os.path.getsize(outfile), lambda tmp: shutil.copyfile(outfile, tmp))
+
+    ## This method stores a spectrum given as written by am on its standard output.
+    #
+    #  @param self The object pointer.
+    #  @param k The cache key.
+    #  @param output The output of am.
+    def write(self, k, output):
+        def write(tmp):
+            with open(tmp, 'w') as f:
+                f.write(output)
+        self._add(k, len(output.encode()), write)
+
+    ## This method adds a spectrum to the cache, evicting the least recently used ones if needed.
+    #
+    #  @param self The object pointer.
+    #  @param k The cache key.
+    #  @param size The size of the spectrum (in bytes).
+    #  @param function The function writing the spectrum, given the path of a temporary file.
+    def _add(self, k, size, function):
+        if size > self.maxsize:
+            return
+        path = self.path(k)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = path+'.'+str(threading.get_ident())+'.tmp'
+        function(tmp)
+        os.replace(tmp, path)
+        with self._lock:
+            if k in self._entries:
+                self.size = self.size - self._entries[k][0]
+            self._entries[k] = [size, os.stat(path).st_mtime]
+            self.size = self.size + size
+            if self.size > self.maxsize:
+                self._evict()
+
+    ## This method evicts the least recently used spectra until the size of the cache is below the limit.
+    #
+    #  @param self The object pointer.
+    def _evict(self):
+        for k in sorted(self._entries, key=lambda k: self._entries[k][1]):
+            if self.size <= self.maxsize:
+                break
+            try:
+                os.remove(self.path(k))
+            except OSError:
+                pass
+            self.size = self.size - self._entries.pop(k)[0]
+            self.evictions = self.evictions + 1
+
+    ## This method gives the cache statistics, cumulated over all the sessions.
+    #
+    #  @param self The object pointer.
+    def stats(self):
+        total = {'hits': 0, 'misses': 0, 'evictions': 0}
+        statsfile = os.path.join(self.directory, 'stats.json')
+        if os.path.exists(statsfile):
+            with open(statsfile) as f:
+                total = json.load(f)
+        total['hits'] = total['hits'] + self.hits
+        total['misses'] = total['misses'] + self.misses
+        total['evictions'] = total['evictions'] + self.evictions
+        total['entries'] = len(self._entries)
+        total['size'] = self.size
+        return total
+
+    ## This method saves the cache statistics and resets the session counters.
+    #
+    #  @param self The object pointer.
+    def close(self):
+        total = self.stats()
+        with open(os.path.join(self.directory, 'stats.json'), 'w') as f:
+            json.dump(total, f)
+        self.hits, self.misses, self.evictions = 0, 0, 0
+        return total
@@ -0,0 +1,278 @@
+"""! @brief Defines the emulator of the am spectra."""
+##
+# @file src/lib/amemulator.py
+# @brief File for the lib.amemulator package.
+#
+# The file is located under atmi/src/lib.
+#
+# @package lib.amemulator
+# @brief Defines the emulator of the am spectra.
+#
+# @section description_amemulator Description
+# Defines the lookup table of am spectra over the surface variables (T0, P0, PWV) of each month, serving new realizations through multilinear interpolation.
+# - emulator (class)
+# - digest (function)
+# - environment (function)
+#
+# @section libraries_amemulator Libraries/Modules
+# - lib.amrunner (\ref lib.amrunner)
+#   - Access to spectra function, for the am runs.
+# - lib.amutils (\ref lib.amutils)
+#   - Access to the vertical profiles and to the am configuration files.
+# - hashlib standard library (https://docs.python.org/3/library/hashlib.html)
+#   - Access to sha256 function, for the parameters file identification.
+# - itertools standard library (https://docs.python.org/3/library/itertools.html)
+#   - Access to product function.
+# - json standard library (https://docs.python.org/3/library/json.html)
+#   - Access to loads and dumps functions, for the emulator metadata.
+# - os standard library (https://docs.python.org/3/library/os.html)
+#   - Access to environ mapping and to files manipulation functions.
+# - numpy (https://numpy.org/doc/stable/)
+#   - Access to many useful functions for array manipulation.
+# - scipy.interpolate (https://docs.scipy.org/doc/scipy/reference/interpolate.html)
+#   - Access to RegularGridInterpolator class.
+#
+# @section notes_amemulator Notes
+# - Comments are Doxygen compatible.
+# - scipy is imported at the first query, so that a run without emulator does not load it.
+# - The grid of each month is refined axis by axis, bisecting the intervals where the midpoint linear interpolation error exceeds the tolerance.
+# - The error estimate of a query is the sum of the interpolation errors measured on the intervals containing it, one for each axis.
+#
+# @section todo_amemulator TODO
+# - None.
+
+from lib import amrunner
+from lib import amutils
+import hashlib
+import itertools
+import json
+import os
+import numpy as np
+
+## This class represents the emulator of the am spectra for a given site, frequency grid and number of layers.
+#
+#  More details.
+class emulator:
+
+    ## The names of the axes of the lookup tables.
+    AXES = ['T0', 'P0', 'PWV']
+
+    ## The constructor for the class.
+    #
+    #  @param self The object pointer.
+    #  @param meta The metadata of the emulator (parameters file hash, number of layers, frequencies, tolerance).
+    #  @param freq The frequencies of the spectra.
+    #  @param tables The lookup table of each month: month -> {'axes', 'errors', 'tau', 'Tb'}.
+    def __init__(self, meta, freq, tables):
+        ## The metadata of the emulator.
+        self.meta = meta
+        ## The frequencies of the spectra.
+        self.freq = freq
+        ## The lookup table of each month.
+        self.tables = tables
+        self._interpolators = {}
+
+    ## This method builds the emulator, running am on an adaptive grid over the given ranges.
+    #
+    #  @param cls The class.
+    #  @param paramsfile The path for the parameters file.
+    #  @param ranges The ranges of the surface variables for each month: month -> [(T0 min, T0 max), (P0 min, P0 max), (PWV min, PWV max)].
+    #  @param N The number of layers for the atmosphere discretization.
+    #  @param freq_start The starting frequency.
+    #  @param freq_stop The ending frequency.
+    #  @param freq_interval The frequency interval for am simulation.
+    #  @param tol The tolerance on the brightness temperature (in K).
+    #  @param layering The layering of the atmosphere (see lib.amutils.heights).
+    #  @param jobs The number of parallel am processes (all the available cores by default).
+    #  @param initial The initial number of nodes of each axis.
+    #  @param max_nodes The maximum number of nodes of the grid of each month.
+    @classmethod
+    def build(cls, paramsfile, ranges, N, freq_start, freq_stop, freq_interval, tol, layering='uniform', jobs=None, initial=3, max_nodes=1000):
+        params = amutils.params(paramsfile)
+        meta = {'params': digest(paramsfile), 'N': N, 'freq': [freq_start, freq_stop, freq_interval], 'T0': 2.7, 'tol': tol, 'layering': layering}
+        freq, tables = None, {}
+        for month in sorted(ranges):
+            cache = {}
+
+            def compute(points):
+                new = [p for p in dict.fromkeys(points) if p not in cache]
+                if len(new) > 0:
+                    X = np.array(new)
+                    Z, T, P, pwv = amutils.profiles_batch(params, X[:, 0], X[:, 1], X[:, 2], np.full(len(X), month), N, layering)
+                    texts = [amutils.config_text(freq_start, freq_stop, freq_interval, 2.7, Z[i], T[i], P[i], pwv[i], 'emulator') for i in range(len(X))]
+                    f, tau, Tb = amrunner.spectra(texts, jobs, desc='Month '+str(month)+' ...')
+                    for i, p in enumerate(new):
+                        cache[p] = (tau[i], Tb[i])
+                    nonlocal freq
+                    freq = f
+                return [cache[p] for p in points]
+
+            axes = [np.linspace(lo, hi if hi > lo else lo + 1, initial) for lo, hi in ranges[month]]
+            errors = [np.full(len(ax)-1, np.inf) for ax in axes]
+            while True:
+                compute(list(itertools.product(*[ax.tolist() for ax in axes])))
+                tests, where = [], []
+                for a in range(3):
+                    lines = [sorted({0, len(ax)//2, len(ax)-1}) for ax in axes]   # check lines through the corners and the center
+                    for i in np.where(np.isinf(errors[a]))[0]:
+                        for nodes in itertools.product(*[lines[b] if b != a else [i] for b in range(3)]):
+                            lo = [axes[b][nodes[b]] for b in range(3)]
+                            hi = list(lo)
+                            hi[a] = axes[a][i+1]
+                            mid = list(lo)
+                            mid[a] = (lo[a] + hi[a])/2
+                            tests.append((tuple(lo), tuple(hi), tuple(mid)))
+                            where.append((a, i))
+                if len(tests) == 0:
+                    break
+                results = compute([p for t in tests for p in t])
+                for a in range(3):
+                    errors[a] = np.where(np.isinf(errors[a]), 0, errors[a])
+                for k, (a, i) in enumerate(where):
+                    lo, hi, mid = results[3*k:3*k+3]
+                    errors[a][i] = max(errors[a][i], np.max(np.abs((lo[1] + hi[1])/2 - mid[1])))
+                size = np.prod([len(ax) for ax in axes])
+                split = [np.where(errors[a] > tol/3)[0] for a in range(3)]
+                if all(len(s) == 0 for s in split) or size*np.prod([1 + len(s)/len(errors[a]) for a, s in enumerate(split)]) > max_nodes:
+                    break
+                for a in range(3):
+                    mids = (axes[a][split[a]] + axes[a][split[a]+1])/2
+                    errors[a] = np.insert(errors[a], split[a]+1, np.inf)
+                    errors[a][split[a]] = np.inf
+                    axes[a] = np.insert(axes[a], split[a]+1, mids)
+            nodes = compute(list(itertools.product(*[ax.tolist() for ax in axes])))
+            shape = tuple(len(ax) for ax in axes)
+            tables[month] = {'axes': axes, 'errors': [np.where(np.isinf(e), np.nan, e) for e in errors],
+                'tau': np.array([n[0] for n in nodes]).reshape(shape + (-1,)),
+                'Tb': np.array([n[1] for n in nodes]).reshape(shape + (-1,))}
+        return cls(meta, freq, tables)
+
+    ## This method checks if the emulator was built for the given configuration.
+    #
+    #  @param self The object pointer.
+    #  @param paramsfile The path for the parameters file.
+    #  @param N The number of layers for the atmosphere discretization.
+    #  @param freq_start The starting frequency.
+    #  @param freq_stop The ending frequency.
+    #  @param freq_interval The frequency interval for am simulation.
+    #  @param layering The layering of the atmosphere (see lib.amutils.heights).
+    def matches(self, paramsfile, N, freq_start, freq_stop, freq_interval, layering='uniform'):
+        return self.meta['params'] == digest(paramsfile) and self.meta['N'] == N and self.meta['freq'] == [freq_start, freq_stop, freq_interval] and self.meta.get('layering', 'uniform') == layering
+
+    ## This method gives the emulated spectra of many realizations of the same month.
+    #
+    #  @param self The object pointer.
+    #  @param month The month of the realizations.
+    #  @param T0 The temperatures at surface.
+    #  @param P0 The pressures at surface.
+    #  @param PWV The PWVs of the atmosphere column.
+    #  @return The opacities and the brightness temperatures, with shape (number of realizations, number of frequencies), the error estimates (infinite outside the grid) and the validity mask (error estimate below the tolerance).
+    def query(self, month, T0, P0, PWV):
+        X = np.column_stack([np.asarray(x, dtype=float).reshape(-1) for x in [T0, P0, PWV]])
+        error = np.full(len(X), np.inf)
+        if month not in self.tables:
+            return np.full((len(X), len(self.freq)), np.nan), np.full((len(X), len(self.freq)), np.nan), error, np.zeros(len(X), dtype=bool)
+        table = self.tables[month]
+        inside = np.ones(len(X), dtype=bool)
+        error[:] = 0
+        for a, ax in enumerate(table['axes']):
+            inside = inside & (X[:, a] >= ax[0]) & (X[:, a] <= ax[-1])
+            i = np.clip(np.searchsorted(ax, X[:, a]) - 1, 0, len(ax) - 2)
+            error = error + np.nan_to_num(table['errors'][a][i], nan=np.inf)
+        error[~inside] = np.inf
+        if month not in self._interpolators:
+            from scipy.interpolate import RegularGridInterpolator
+            values = np.concatenate((table['tau'], table['Tb']), axis=-1)
+            self._interpolators[month] = RegularGridInterpolator(tuple(table['axes']), values, bounds_error=False, fill_value=np.nan)
+        values = self._interpolators[month](X)
+        n = len(self.freq)
+        return values[:, :n], values[:, n:], error, inside & (error <= self.meta['tol'])
+
+    ## This method saves the emulator on a .npz file.
+    #
+    #  @param self The object pointer.
+    #  @param path The path to the emulator file.
+    def save(self, path):
+        arrays = {'meta': np.array(json.dumps(self.meta)), 'freq': self.freq}
+        for month, table in self.tables.items():
+            for a, name in enumerate(emulator.AXES):
+                arrays[str(month)+'_axis_'+name] = table['axes'][a]
+                arrays[str(month)+'_error_'+name] = table['errors'][a]
+            arrays[str(month)+'_tau'] = table['tau']
+            arrays[str(month)+'_Tb'] = table['Tb']
+        np.savez_compressed(path, **arrays)
+
+    ## This method loads the emulator from a .npz file.
+    #
+    #  @param cls The class.
+    #  @param path The path to the emulator file.
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            meta = json.loads(str(f['meta']))
+            months = sorted({int(k.split('_')[0]) for k in f.files if k.endswith('_Tb')})
+            tables = {m: {'axes': [f[str(m)+'_axis_'+name] for name in emulator.AXES],
+                'errors': [f[str(m)+'_error_'+name] for name in emulator.AXES],
+                'tau': f[str(m)+'_tau'], 'Tb': f[str(m)+'_Tb']} for m in months}
+            return cls(meta, f['freq'], tables)
+
+    ## This method serves the realizations inside the grid and within the tolerance, saving their spectra in a store.
+    #
+    #  @param self The object pointer.
+    #  @param store The store of the am spectra (see lib.amstore).
+    #  @param names The names of the realizations.
+    #  @param months The months of the realizations.
+    #  @param T0 The temperatures at surface.
+    #  @param P0 The pressures at surface.
+    #  @param PWV The PWVs of the atmosphere column.
+    #  @param reportfile The path to the file reporting the error estimate of each realization.
+    #  @param append If True, the realizations are added to the report of the previous ones (e.g. for a run served one block at a time).
+    #  @param record The function called with the name, the opacities and the brightness temperatures of each served realization, if any.
+    #  @return The mask of the served realizations; the others need a real am run.
+    def serve(self, store, names, months, T0, P0, PWV, reportfile, append=False, record=None):
+        months = np.asarray(months, dtype=int)
+        T0, P0, PWV = [np.asarray(x, dtype=float) for x in [T0, P0, PWV]]
+        served = np.zeros(len(names), dtype=bool)
+        errors = np.full(len(names), np.inf)
+        for month in np.unique(months):
+            rows = np.where(months == month)[0]
+            for chunk in np.array_split(rows, max(1, len(rows)//10000)):
+                tau, Tb, error, ok = self.query(int(month), T0[chunk], P0[chunk], PWV[chunk])
+                errors[chunk], served[chunk] = error, ok
+                for k in np.where(ok)[0]:
+                    store.append(names[chunk[k]], self.freq, tau[k], Tb[k])
+                    if record is not None:
+                        record(names[chunk[k]], tau[k], Tb[k])
+        with open(reportfile, 'a' if append else 'w') as f:
+            if not append:
+                f.write('Name,Error,Emulated\n')
+            f.write(''.join(names[i]+','+str(errors[i])+','+str(int(served[i]))+'\n' for i in range(len(names))))
+        finite = errors[served & np.isfinite(errors)]
+        print('Emulator: '+str(served.sum())+' realizations served (max estimated error '+('%.3f' % finite.max() if len(finite) > 0 else '-')+' K), '+str(len(names) - served.sum())+' left to am')
+        return served
+
+## This function gives the hash of the content of a file.
+#
+#  @param path The path to the file.
+def digest(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+## This function loads the emulator given by the ATMI_EMULATOR environment variable, if any and if built for the given configuration.
+#
+#  @param paramsfile The path for the parameters file.
+#  @param N The number of layers for the atmosphere discretization.
+#  @param freq_start The starting frequency.
+#  @param freq_stop The ending frequency.
+#  @param freq_interval The frequency interval for am simulation.
+#  @param layering The layering of the atmosphere (see lib.amutils.heights).
+#  @return The emulator, or None.
+def environment(paramsfile, N, freq_start, freq_stop, freq_interval, layering):
+    path = os.environ.get('ATMI_EMULATOR', '')
+    if path == '':
+        return None
+    model = emulator.load(path)
+    if not model.matches(paramsfile, int(N), float(freq_start), float(freq_stop), float(freq_interval), layering):
+        print('Emulator '+path+' built for a different configuration: ignored')
+        return None
+    return model
@@ -0,0 +1,137 @@
+"""! @brief Defines the manifest of the am runs."""
+##
+# @file src/lib/ammanifest.py
+# @brief File for the lib.ammanifest package.
+#
+# The file is located under atmi/src/lib.
+#
+# @package lib.ammanifest
+# @brief Defines the manifest of the am runs.
+#
+# @section description_ammanifest Description
+# Defines the append-only record of the realizations of a run (configuration hash, status and spectrum checksum), through which an interrupted or extended run redoes only the missing realizations.
+# - manifest (class)
+# - resume (function)
+#
+# @section libraries_ammanifest Libraries/Modules
+# - lib.amstore (\ref lib.amstore)
+#   - Access to the store of the am spectra.
+# - json standard library (https://docs.python.org/3/library/json.html)
+#   - Access to loads and dumps functions, for the manifest lines.
+# - numpy (https://numpy.org/doc/stable/)
+#   - Access to many useful functions for array manipulation.
+# - os standard library (https://docs.python.org/3/library/os.html)
+#   - Access to files manipulation functions.
+# - threading standard library (https://docs.python.org/3/library/threading.html)
+#   - Access to Lock class.
+# - time standard library (https://docs.python.org/3/library/time.html)
+#   - Access to time function.
+#
+# @section notes_ammanifest Notes
+# - Comments are Doxygen compatible.
+# - The manifest is a JSON line for each event, and the last line of a realization gives its state; a line cut by an interruption is ignored.
+#
+# @section todo_ammanifest TODO
+# - None.
+
+from lib import amstore
+import json
+import numpy as np
+import os
+import threading
+import time
+
+## This class represents the manifest of a run, saved in am/output/<name>.manifest.
+#
+#  Each line records a realization: its name, the key of its configuration (see lib.amcache.key), its status ('done', 'emulated' or 'failed') and the checksum of its spectrum (see lib.amstore.checksum).
+class manifest:
+
+    ## The statuses of the completed realizations.
+    COMPLETED = ['done', 'emulated']
+
+    ## The constructor for the class.
+    #
+    #  @param self The object pointer.
+    #  @param path The path to the manifest file.
+    def __init__(self, path):
+        ## The path to the manifest file.
+        self.path = path
+        ## The last record of each realization.
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:   # interrupted write
+                        continue
+                    self.entries[entry['name']] = entry
+        self._lock = threading.Lock()
+        self._file = open(path, 'a')
+
+    ## This method records the state of a realization.
+    #
+    #  @param self The object pointer.
+    #  @param name The name of the realization.
+    #  @param key The key of the configuration.
+    #  @param status The status of the realization: 'done', 'emulated' or 'failed'.
+    #  @param output The checksum of the spectrum, if any.
+    def record(self, name, key, status, output=None):
+        entry = {'name': name, 'config': key, 'status': status, 'output': output, 'time': round(time.time(), 3)}
+        with self._lock:
+            self.entries[name] = entry
+            self._file.write(json.dumps(entry)+'\n')
+            self._file.flush()
+
+    ## This method gives which realizations are already completed with the same configuration.
+    #
+    #  @param self The object pointer.
+    #  @param names The names of the realizations.
+    #  @param keys The keys of their configurations.
+    #  @param stored The names of the realizations in the store (the completed ones missing from the store are not trusted).
+    #  @return The mask of the completed realizations.
+    def done(self, names, keys, stored):
+        completed = np.zeros(len(names), dtype=bool)
+        for i, (name, key) in enumerate(zip(names, keys)):
+            entry = self.entries.get(name)
+            completed[i] = entry is not None and entry['status'] in manifest.COMPLETED and entry['config'] == key and name in stored
+        return completed
+
+    ## This method closes the manifest.
+    #
+    #  @param self The object pointer.
+    def close(self):
+        self._file.close()
+
+## This function prepares the store of a run for the given realizations: the ones completed in an earlier execution are kept, the ones within the tolerance of the emulator given by ATMI_EMULATOR (if any) are served, and the others are left to am.
+#
+#  @param directory The global path of the project.
+#  @param filename The name of the run.
+#  @param names The names of the realizations.
+#  @param keys The keys of their configurations (see lib.amcache.key).
+#  @param months The months of the realizations.
+#  @param T0 The temperatures at surface.
+#  @param P0 The pressures at surface.
+#  @param PWV The PWVs of the atmosphere column.
+#  @param model The emulator (see lib.amemulator.environment), if any.
+#  @return The mask of the realizations left to am.
+def resume(directory, filename, names, keys, months, T0, P0, PWV, model=None):
+    cube = directory+'/am/output/'+filename+'.cube'
+    store = amstore.store(cube, 'a' if os.path.exists(cube+'/index.json') else 'w')
+    runs = manifest(directory+'/am/output/'+filename+'.manifest')
+    done = runs.done(names, keys, set(store.names))
+    store.compact([names[i] for i in np.where(done)[0]])
+    left = ~done
+    if done.any():
+        print('Manifest: '+str(done.sum())+' realizations already completed')
+    if model is not None:
+        rows = np.where(left)[0]
+        reportfile = directory+'/am/output/'+filename+'.emulator.csv'
+        key = dict(zip(names, keys))
+        served = model.serve(store, [names[i] for i in rows], np.asarray(months)[rows], np.asarray(T0)[rows], np.asarray(P0)[rows], np.asarray(PWV)[rows], reportfile,
+            record=lambda name, tau, Tb: runs.record(name, key[name], 'emulated', amstore.checksum(tau, Tb)))
+        left[rows[served]] = False
+        print('Error estimate of each realization saved in '+reportfile)
+    runs.close()
+    store.close()
+    return left
@@ -0,0 +1,328 @@
+"""! @brief Gathers some useful tools for the parallel execution of am."""
+##
+# @file src/lib/amrunner.py
+# @brief File for the lib.amrunner package.
+#
+# The file is located under atmi/src/lib.
+#
+# @package lib.amrunner
+# @brief Gathers some useful tools for the parallel execution of am.
+#
+# @section description_amrunner Description
+# Defines the functions and the class necessary to run am over many configuration files through a bounded pool of workers.
+# - execute (function)
+# - execute_text (function)
+# - pipe (function)
+# - parse (function)
+# - spectrum (function)
+# - spectra (function)
+# - runner (class)
+#
+# @section libraries_amrunner Libraries/Modules
+# - lib.amcache (\ref lib.amcache)
+#   - Access to the cache of the am spectra.
+# - lib.amstore (\ref lib.amstore)
+#   - Access to the store of the am spectra.
+# - lib.profiling (\ref lib.profiling)
+#   - Access to percentiles function, for the latencies of the am executions.
+# - concurrent.futures standard library (https://docs.python.org/3/library/concurrent.futures.html)
+#   - Access to ThreadPoolExecutor class.
+# - numpy (https://numpy.org/doc/stable/)
+#   - Access to many useful functions for array manipulation.
+# - os standard library (https://docs.python.org/3/library/os.html)
+#   - Access to cpu_count function.
+# - subprocess standard library (https://docs.python.org/3/library/subprocess.html)
+#   - Access to run function, for the am execution.
+# - threading standard library (https://docs.python.org/3/library/threading.html)
+#   - Access to Lock and Semaphore classes.
+# - time standard library (https://docs.python.org/3/library/time.html)
+#   - Access to perf_counter function.
+# - tqdm (https://tqdm.github.io/)
+#   - Access to progress bars.
+#
+# @section notes_amrunner Notes
+# - Comments are Doxygen compatible.
+# - The am processes release the interpreter, so a pool of threads is enough to keep all the workers busy.
+# - With a store, the configurations are given to am through its standard input and the spectra are parsed from its standard output, without the .amc and .out files (kept with files=True, for debugging).
+#
+# @section todo_amrunner TODO
+# - None.
+
+from concurrent.futures import ThreadPoolExecutor
+from lib import amcache
+from lib import amstore
+from lib import profiling
+import numpy as np
+import os
+import subprocess
+import threading
+import time
+from tqdm import tqdm
+
+## This function runs am on a single configuration file.
+#
+#  @param amcfile The path to the am configuration file.
+#  @param outfile The path to the am output file.
+def execute(amcfile, outfile):
+    with open(outfile, 'w') as out:
+        proc = subprocess.run(['am', amcfile], stdout=out, stderr=subprocess.PIPE, text=True)
+    return proc.returncode, proc.stderr
+
+## This function runs am on the content of a configuration file, given through the standard input.
+#
+#  @param text The content of the am configuration file.
+#  @param outfile The path to the am output file.
+def execute_text(text, outfile):
+    with open(outfile, 'w') as out:
+        proc = subprocess.run(['am', '-'], input=text, stdout=out, stderr=subprocess.PIPE, text=True)
+    return proc.returncode, proc.stderr
+
+## This function runs am on the content of a configuration file through pipes, without any file.
+#
+#  @param text The content of the am configuration file.
+#  @return The exit status, the standard output and the standard error of am.
+def pipe(text):
+    proc = subprocess.run(['am', '-'], input=text, capture_output=True, text=True)
+    return proc.returncode, proc.stdout, proc.stderr
+
+## This function parses a spectrum written by am.
+#
+#  @param output The output of am.
+#  @return The frequencies, the opacities and the brightness temperatures.
+def parse(output):
+    data = np.array(output.split(), dtype=float).reshape(-1, 3)
+    return data[:, 0], data[:, 1], data[:, 2]
+
+## This function runs am on the content of a configuration file, reading the spectrum from the standard output.
+#
+#  @param text The content of the am configuration file.
+#  @return The frequencies, the opacities and the brightness temperatures.
+def spectrum(text):
+    code, output, err = pipe(text)
+    if code != 0:
+        lines = err.strip().splitlines()
+        raise RuntimeError('am failed with exit status '+str(code)+(': '+lines[-1] if lines else ''))
+    return parse(output)
+
+## This function runs am on the contents of many configuration files, through a pool of workers.
+#
+#  @param texts The contents of the am configuration files.
+#  @param jobs The number of parallel am processes (all the available cores by default).
+#  @param desc The description of the progress bar.
+#  @return The frequencies, the opacities and the brightness temperatures, these last with shape (number of configurations, number of frequencies).
+def spectra(texts, jobs=None, desc='Running am ...'):
+    with ThreadPoolExecutor(max_workers=jobs if jobs else (os.cpu_count() or 1)) as pool:
+        results = list(tqdm(pool.map(spectrum, texts), total=len(texts), desc=desc, unit='run'))
+    if len(results) == 0:
+        return np.empty(0), np.empty((0, 0)), np.empty((0, 0))
+    return results[0][0], np.array([r[1] for r in results]), np.array([r[2] for r in results])
+
+## This class runs am over many configuration files through a bounded pool of workers.
+#
+#  The jobs can be submitted one at a time while the workers are already running, or all together with the run method.
+class runner:
+
+    ## The constructor for the class.
+    #
+    #  @param self The object pointer.
+    #  @param configdir The directory of the am configuration files.
+    #  @param outputdir The directory of the am output files.
+    #  @param jobs The number of parallel am processes (all the available cores by default).
+    #  @param retries The number of further attempts for a failed am execution.
+    #  @param logfile The path to the file logging the exit status of each job.
+    #  @param cache The cache of the am spectra (see lib.amcache), if any.
+    #  @param archive The archive of the am configurations (see lib.amutils.archive), if the configurations are not in separate files.
+    #  @param store The store ingesting the am spectra as they are computed (see lib.amstore), if any.
+    #  @param manifest The manifest recording the state of each job (see lib.ammanifest), if any.
+    #  @param files If True, the am output files are written even with a store, and the configuration files are given to am by path.
+    def __init__(self, configdir, outputdir, jobs=None, retries=1, logfile=None, cache=None, archive=None, store=None, manifest=None, files=False):
+        ## The directory of the am configuration files.
+        self.configdir = configdir
+        ## The directory of the am output files.
+        self.outputdir = outputdir
+        ## The number of parallel am processes.
+        self.jobs = jobs if jobs else (os.cpu_count() or 1)
+        ## The number of further attempts for a failed am execution.
+        self.retries = retries
+        ## The path to the file logging the exit status of each job.
+        self.logfile = logfile
+        ## The cache of the am spectra.
+        self.cache = cache
+        ## The archive of the am configurations.
+        self.archive = archive
+        ## The store ingesting the am spectra.
+        self.store = store
+        ## The manifest recording the state of each job.
+        self.manifest = manifest
+        ## Whether the am output files are written (always without a store).
+        self.files = files or store is None
+        ## The names of the jobs terminated successfully.
+        self.done = []
+        ## The names of the failed jobs.
+        self.failed = []
+        ## The duration of each am execution (seconds).
+        self.latencies = []
+        self._lock = threading.Lock()
+        self._slots = threading.Semaphore(2*self.jobs)   # bounds the number of pending jobs
+        self._pool = None
+        self._log = None
+        self._bar = None
+        self._start = None
+
+    ## This method starts the pool of workers.
+    #
+    #  @param self The object pointer.
+    #  @param total The number of expected jobs, if known.
+    def start(self, total=None):
+        self._pool = ThreadPoolExecutor(max_workers=self.jobs)
+        if self.logfile is not None:
+            self._log = open(self.logfile, 'w')
+        self._bar = tqdm(total=total, desc='Running am ...', unit='run')
+        self._start = time.perf_counter()
+
+    ## This method queues one configuration file for the execution, waiting if too many jobs are pending.
+    #
+    #  @param self The object pointer.
+    #  @param name The name of the configuration file (without extension).
+    #  @param text The content of the configuration file, if already in memory (it is then given to am through the standard input).
+    #  @param store The store of the job, if not the one of the runner (e.g. one store for each site).
+    #  @param manifest The manifest of the job, if not the one of the runner.
+    def submit(self, name, text=None, store=None, manifest=None):
+        self._slots.acquire()
+        future = self._pool.submit(self._job, name, text, store, manifest)
+        future.add_done_callback(lambda f: self._slots.release())
+
+    ## This method waits for all the queued jobs and stops the pool of workers.
+    #
+    #  @param self The object pointer.
+    def join(self):
+        self._pool.shutdown(wait=True)
+        self._bar.close()
+        if self._log is not None:
+            self._log.close()
+        elapsed = time.perf_counter() - self._start
+        n = len(self.done) + len(self.failed)
+        print('am runs: '+str(len(self.done))+' succeeded, '+str(len(self.failed))+' failed in '+'%.1f' % elapsed+' s ('+'%.2f' % (n/elapsed if elapsed > 0 else 0)+' runs/s with '+str(self.jobs)+' workers)')
+        if len(self.latencies) > 0:
+            latency = profiling.percentiles(self.latencies)
+            print('am latency: '+', '.join(k+' '+'%.3f' % latency[k]+' s' for k in ['p50', 'p90', 'p99', 'max']))
+        if self.cache is not None:
+            hits, misses = self.cache.hits, self.cache.misses
+            total = self.cache.close()
+            print('am cache: '+str(hits)+' hits, '+str(misses)+' misses ('+str(total['hits'])+' hits, '+str(total['misses'])+' misses overall, '+str(total['entries'])+' spectra, '+'%.1f' % (total['size']/2**20)+' MB)')
+        return len(self.done), len(self.failed)
+
+    ## This method runs am over all the given configuration files.
+    #
+    #  @param self The object pointer.
+    #  @param names The names of the configuration files (without extension).
+    def run(self, names):
+        self.start(len(names))
+        for name in names:
+            self.submit(name)
+        return self.join()
+
+    ## This method executes a single job, retrying it in case of failure.
+    #
+    #  @param self The object pointer.
+    #  @param name The name of the configuration file (without extension).
+    #  @param text The content of the configuration file, if already in memory.
+    #  @param store The store of the job, if not the one of the runner.
+    #  @param manifest The manifest of the job, if not the one of the runner.
+    def _job(self, name, text=None, store=None, manifest=None):
+        store = self.store if store is None else store
+        manifest = self.manifest if manifest is None else manifest
+        t0 = time.perf_counter()
+        try:
+            self._execute(name, text, store, manifest)
+        except Exception as e:   # e.g. a missing configuration, an unreadable spectrum or a store of another grid: the job fails instead of being lost
+            self._record(name, -1, 1, time.perf_counter()-t0, type(e).__name__+': '+str(e), manifest=manifest)
+
+    ## This method executes a single job, retrying the am execution in case of failure.
+    #
+    #  @param self The object pointer.
+    #  @param name The name of the configuration file (without extension).
+    #  @param text The content of the configuration file, if already in memory.
+    #  @param store The store of the job, if any.
+    #  @param manifest The manifest of the job, if any.
+    def _execute(self, name, text, store, manifest):
+        amcfile = os.path.join(self.configdir, name+'.amc')
+        outfile = os.path.join(self.outputdir, name+'.out')
+        t0 = time.perf_counter()
+        if text is None and self.archive is not None:
+            text = self.archive.read(name)
+        if text is None and (not self.files or self.cache is not None or manifest is not None):
+            with open(amcfile) as f:
+                text = f.read()
+        k = None
+        if self.cache is not None or manifest is not None:
+            k = amcache.key(text)
+        if self.cache is not None:
+            cached = self.cache.get(k, outfile) if self.files else self.cache.read(k)
+            if cached:
+                output = self._ingest(name, store, outfile) if self.files else self._ingest(name, store, output=cached)
+                self._record(name, 0, 0, time.perf_counter()-t0, '', k, output, manifest)
+                return
+        for attempt in range(self.retries+1):
+            t1 = time.perf_counter()
+            try:
+                if not self.files:
+                    code, out, err = pipe(text)
+                elif text is not None:
+                    code, err = execute_text(text, outfile)
+                else:
+                    code, err = execute(amcfile, outfile)
+            except OSError as e:
+                code, err = -1, str(e)
+            with self._lock:
+                self.latencies.append(time.perf_counter()-t1)
+            if code == 0:
+                break
+        if code == 0 and self.cache is not None:
+            if self.files:
+                self.cache.put(k, outfile)
+            else:
+                self.cache.write(k, out)
+        output = None
+        if code == 0:
+            output = self._ingest(name, store, outfile) if self.files else self._ingest(name, store, output=out)
+        self._record(name, code, attempt+1, time.perf_counter()-t0, err, k, output, manifest)
+
+    ## This method adds the spectrum of a job to the store, if any.
+    #
+    #  @param self The object pointer.
+    #  @param name The name of the configuration file.
+    #  @param store The store of the job, if any.
+    #  @param outfile The path to the am output file.
+    #  @param output The output of am, if not written in a file.
+    #  @return The checksum of the spectrum, if ingested.
+    def _ingest(self, name, store, outfile=None, output=None):
+        if store is not None:
+            freq, tau, Tb = amstore.read_spectrum(outfile) if output is None else parse(output)
+            with self._lock:
+                store.append(name, freq, tau, Tb)
+            return amstore.checksum(tau, Tb)
+
+    ## This method records the exit status of a job.
+    #
+    #  @param self The object pointer.
+    #  @param name The name of the configuration file.
+    #  @param code The exit status of the last am execution.
+    #  @param attempts The number of executions (0 for the spectra taken from the cache).
+    #  @param seconds The time spent on the job.
+    #  @param err The standard error of the last am execution.
+    #  @param key The key of the configuration, if computed.
+    #  @param output The checksum of the spectrum, if ingested.
+    #  @param manifest The manifest of the job, if any.
+    def _record(self, name, code, attempts, seconds, err, key=None, output=None, manifest=None):
+        message = ''
+        if code != 0:
+            lines = err.strip().splitlines()
+            message = lines[-1] if lines else ''
+        with self._lock:
+            (self.done if code == 0 else self.failed).append(name)
+            if self._log is not None:
+                self._log.write(name+'\t'+str(code)+'\t'+str(attempts)+'\t'+'%.3f' % seconds+'\t'+message+'\n')
+            self._bar.update(1)
+        if manifest is not None:
+            manifest.record(name, key, 'done' if code == 0 else 'failed', output)
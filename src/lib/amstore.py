@@ -0,0 +1,218 @@
+"""! @brief Defines the consolidated store of the am spectra."""
+##
+# @file src/lib/amstore.py
+# @brief File for the lib.amstore package.
+#
+# The file is located under atmi/src/lib.
+#
+# @package lib.amstore
+# @brief Defines the consolidated store of the am spectra.
+#
+# @section description_amstore Description
+# Defines the spectral cube (realization x frequency) gathering the brightness temperatures and the opacities resulting from the am runs.
+# - read_spectrum (function)
+# - checksum (function)
+# - store (class)
+#
+# @section libraries_amstore Libraries/Modules
+# - hashlib standard library (https://docs.python.org/3/library/hashlib.html)
+#   - Access to sha256 function, for the checksum of the spectra.
+# - json standard library (https://docs.python.org/3/library/json.html)
+#   - Access to load and dump functions, for the index of the store.
+# - numpy (https://numpy.org/doc/stable/)
+#   - Access to many useful functions for array manipulation.
+#   - Access to memmap class.
+# - os standard library (https://docs.python.org/3/library/os.html)
+#   - Access to files and directories manipulation functions.
+# - pandas (https://pandas.pydata.org/docs/reference/index.html)
+#   - Access to read_csv function.
+# - threading standard library (https://docs.python.org/3/library/threading.html)
+#   - Access to RLock class.
+#
+# @section notes_amstore Notes
+# - Comments are Doxygen compatible.
+# - pandas is imported by read_spectrum only, the store itself needing numpy alone.
+# - The spectra are stored as float32 binary arrays, one row for each realization, together with a JSON index.
+#
+# @section todo_amstore TODO
+# - None.
+
+import hashlib
+import json
+import numpy as np
+import os
+import threading
+
+## This function reads an am output file.
+#
+#  @param output_file The path to the am output file.
+#  @return The frequencies, the opacities and the brightness temperatures.
+def read_spectrum(output_file):
+    import pandas as pd
+    df = pd.read_csv(output_file, names=['Freq', 'Abs', 'Tb'], sep=' ', dtype=float)
+    return df['Freq'].to_numpy(), df['Abs'].to_numpy(), df['Tb'].to_numpy()
+
+## This function gives the checksum of a spectrum, as saved in the store.
+#
+#  @param tau The opacities.
+#  @param Tb The brightness temperatures.
+def checksum(tau, Tb):
+    return hashlib.sha256(np.asarray(Tb, dtype=np.float32).tobytes() + np.asarray(tau, dtype=np.float32).tobytes()).hexdigest()
+
+## This class represents the store of the am spectra of a run, with a realization axis and a frequency axis.
+#
+#  The store is a directory holding the frequency grid (freq.npy), the brightness temperatures (Tb.f32), the opacities (tau.f32) and the index of the realizations (index.json).
+class store:
+
+    ## The number of appended spectra after which the index is saved.
+    FLUSH = 1000
+
+    ## The constructor for the class.
+    #
+    #  @param self The object pointer.
+    #  @param path The path to the store directory.
+    #  @param mode 'w' to create a new store (overwriting an old one), 'a' to append to an existing one, 'r' to read it.
+    def __init__(self, path, mode='r'):
+        ## The path to the store directory.
+        self.path = path
+        ## The mode of the store.
+        self.mode = mode
+        ## The frequency grid.
+        self.freq = None
+        ## The names of the realizations.
+        self.names = []
+        if mode == 'w':
+            os.makedirs(path, exist_ok=True)
+            for file in ['freq.npy', 'Tb.f32', 'tau.f32', 'index.json']:
+                if os.path.exists(os.path.join(path, file)):
+                    os.remove(os.path.join(path, file))
+        else:
+            with open(os.path.join(path, 'index.json')) as f:
+                self.names = json.load(f)['names']
+            if os.path.exists(os.path.join(path, 'freq.npy')):
+                self.freq = np.load(os.path.join(path, 'freq.npy'))
+        self._pending = 0
+        self._files = None
+        self._lock = threading.RLock()   # the spectra may be appended by many threads
+        if mode == 'a':
+            self._truncate()
+
+    ## This method gives the number of realizations in the store.
+    #
+    #  @param self The object pointer.
+    def __len__(self):
+        return len(self.names)
+
+    ## This method appends the spectrum of a realization.
+    #
+    #  @param self The object pointer.
+    #  @param name The name of the realization.
+    #  @param freq The frequencies.
+    #  @param tau The opacities.
+    #  @param Tb The brightness temperatures.
+    def append(self, name, freq, tau, Tb):
+        with self._lock:
+            if self.freq is None:
+                self.freq = np.asarray(freq, dtype=float)
+                np.save(os.path.join(self.path, 'freq.npy'), self.freq)
+            elif not np.array_equal(self.freq, freq):
+                raise ValueError(name+' has a different frequency grid from the store '+self.path)
+            if self._files is None:
+                self._files = [open(os.path.join(self.path, 'Tb.f32'), 'ab'), open(os.path.join(self.path, 'tau.f32'), 'ab')]
+            self._files[0].write(np.asarray(Tb, dtype=np.float32).tobytes())
+            self._files[1].write(np.asarray(tau, dtype=np.float32).tobytes())
+            self.names.append(name)
+            self._pending = self._pending + 1
+            if self._pending >= store.FLUSH:
+                self.flush()
+
+    ## This method appends the spectrum of a realization from its am output file.
+    #
+    #  @param self The object pointer.
+    #  @param name The name of the realization.
+    #  @param output_file The path to the am output file.
+    def ingest(self, name, output_file):
+        self.append(name, *read_spectrum(output_file))
+
+    ## This method saves the appended spectra and the index.
+    #
+    #  @param self The object pointer.
+    def flush(self):
+        with self._lock:
+            if self._files is not None:
+                for f in self._files:
+                    f.flush()
+            with open(os.path.join(self.path, 'index.json.tmp'), 'w') as f:
+                json.dump({'names': self.names, 'nfreq': 0 if self.freq is None else len(self.freq)}, f)
+            os.replace(os.path.join(self.path, 'index.json.tmp'), os.path.join(self.path, 'index.json'))
+            self._pending = 0
+
+    ## This method closes the store.
+    #
+    #  @param self The object pointer.
+    def close(self):
+        if self.mode != 'r':
+            self.flush()
+        if self._files is not None:
+            for f in self._files:
+                f.close()
+            self._files = None
+
+    ## This method gives the memory-mapped array of a variable.
+    #
+    #  @param self The object pointer.
+    #  @param var The variable: 'Tb' or 'tau'.
+    def array(self, var):
+        if len(self.names) == 0:
+            return np.empty((0, 0 if self.freq is None else len(self.freq)), dtype=np.float32)
+        return np.memmap(os.path.join(self.path, var+'.f32'), dtype=np.float32, mode='r', shape=(len(self.names), len(self.freq)))
+
+    ## This method gives a frequency slice of the store across all the realizations, without reading the rest of the data.
+    #
+    #  @param self The object pointer.
+    #  @param freq1 The starting frequency.
+    #  @param freq2 The ending frequency.
+    #  @return The frequencies, the opacities and the brightness temperatures, these last with shape (number of realizations, number of frequencies).
+    def slice(self, freq1, freq2):
+        cols = np.where((self.freq >= freq1) & (self.freq <= freq2))[0]
+        s = slice(cols[0], cols[-1]+1) if len(cols) > 0 else slice(0, 0)
+        return self.freq[s], self.array('tau')[:, s], self.array('Tb')[:, s]
+
+    ## This method keeps only the given realizations, dropping the others and the older spectra of the realizations appended more than once.
+    #
+    #  @param self The object pointer.
+    #  @param names The names of the realizations to keep.
+    def compact(self, names):
+        with self._lock:
+            self.flush()
+            keep = set(names)
+            last = {name: i for i, name in enumerate(self.names) if name in keep}
+            rows = np.array(sorted(last.values()), dtype=int)
+            if len(rows) == len(self.names):
+                return
+            if self._files is not None:
+                for f in self._files:
+                    f.close()
+                self._files = None
+            if self.freq is not None:
+                for var in ['Tb', 'tau']:
+                    data = self.array(var)
+                    with open(os.path.join(self.path, var+'.f32.tmp'), 'wb') as f:
+                        for chunk in np.array_split(rows, max(1, len(rows)//store.FLUSH)):
+                            f.write(np.ascontiguousarray(data[chunk]).tobytes())
+                    del data
+                    os.replace(os.path.join(self.path, var+'.f32.tmp'), os.path.join(self.path, var+'.f32'))
+            self.names = [self.names[i] for i in rows]
+            self.flush()
+
+    ## This method drops the data written after the last saved index (e.g. by an interrupted run).
+    #
+    #  @param self The object pointer.
+    def _truncate(self):
+        if self.freq is None:
+            return
+        size = len(self.names)*len(self.freq)*4
+        for var in ['Tb', 'tau']:
+            file = os.path.join(self.path, var+'.f32')
+            if os.path.exists(file) and os.path.getsize(file) > size:
+                os.truncate(file, size)
@@ -10,22 +10,43 @@
 #
 # @section description_amutils Description
 # Defines the functions necessary to calculate the vertical profiles and to write and save the am configuration files.
+# - params (function)
+# - heights (function)
+# - profiles_batch (function)
 # - profiles (function)
+# - config_text (function)
 # - config (function)
+# - save_configs (function)
+# - configs (class)
+# - archive (class)
+# - load_outputs (function)
 # - am_plot (function)
+# - spectrum_plot (function)
 #
 # @section libraries_amutils Libraries/Modules
+# - lib.profiling (\ref lib.profiling)
+#   - Access to profiled function, for the opt-in profiling of the hot functions.
+# - concurrent.futures standard library (https://docs.python.org/3/library/concurrent.futures.html)
+#   - Access to ThreadPoolExecutor class, for the parallel loading of the am output files.
 # - datetime standard library (https://docs.python.org/3/library/datetime.html)
 #   - Access to datetime function.
+# - json standard library (https://docs.python.org/3/library/json.html)
+#   - Access to loads and dumps functions, for the archive offset table.
 # - matplotlib.pyplot (https://matplotlib.org/3.5.3/api/_as_gen/matplotlib.pyplot.html)
 #   - Access to plot functions.
 # - numpy (https://numpy.org/doc/stable/)
 #   - Access to many useful functions for array manipulation.
+# - os standard library (https://docs.python.org/3/library/os.html)
+#   - Access to pread function, for the archive reading.
+#   - Access to stat function, for the parameters cache.
 # - pandas (https://pandas.pydata.org/docs/reference/index.html)
-#   - Access to read_table function.
+#   - Access to read_table and read_csv functions.
+# - tqdm (https://tqdm.github.io/)
+#   - Access to progress bars.
 #
 # @section notes_amutils Notes
 # - Comments are Doxygen compatible.
+# - matplotlib and pandas are imported by the functions using them, so that the scripts not plotting nor reading am outputs start faster.
 #
 # @section todo_amutils TODO
 # - None.
@@ -34,34 +55,123 @@
 # - Created by Luca Cintura on 20/03/2023.
 # - Modified by Luca Cintura on 20/03/2023.
 
+from lib import profiling
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-import matplotlib.pyplot as plt
+import json
 import numpy as np
-import pandas as pd
+import os
+from tqdm import tqdm
 
-## This function calculates the value of the temperature, pressure and PWV through 30 Km of atmosphere using vertical profiles functions.
+## The parameters files read in the process: absolute path -> (modification time, parameters).
+_params = {}
+
+## This function reads the parameters of the vertical profiles for each month, reusing the ones already read in the process if the file did not change.
 #
 #  @param paramsfile The path for the parameters file.
-#  @param T0 The temperature at surface.
-#  @param P0 The pressure at surface.
-#  @param PWV The PWV of the atmosphere column.
-#  @param month The month, in order to chose the correct vertical profiles.
+def params(paramsfile):
+	path = os.path.abspath(paramsfile)
+	mtime = os.stat(path).st_mtime
+	if path not in _params or _params[path][0] != mtime:
+		values = np.atleast_2d(np.loadtxt(path, skiprows=4))
+		values.flags.writeable = False   # shared by all the callers
+		_params[path] = (mtime, values)
+	return _params[path][1]
+
+## The available layerings of the atmosphere.
+LAYERINGS = ['uniform', 'adaptive']
+
+## This function gives the heights (above the site) of the layer boundaries through 30 Km of atmosphere.
+#
+#  The uniform layering divides the 30 Km in equal parts. The adaptive layering gives each layer an equal increment of the mean between the PWV fraction and the pressure fraction below its base, so that the layers are thin where the water vapour and the air are, and thick in the dry upper atmosphere.
+#
+#  @param Hp The pressure scale heights, with shape (number of realizations, 1).
+#  @param Hw The PWV scale heights, with shape (number of realizations, 1).
+#  @param N The number of layers for the atmosphere discretization.
+#  @param layering The layering of the atmosphere: 'uniform' or 'adaptive'.
+#  @return The heights of the layer bases above the site, with shape (number of realizations, N).
+def heights(Hp, Hw, N, layering='uniform'):
+	if layering == 'uniform':
+		return np.broadcast_to(np.linspace(0, 30, num=N), (len(Hp), N))
+	if layering != 'adaptive':
+		raise ValueError('Layering not valid: '+str(layering))
+	z = np.linspace(0, 30, num=3001)
+	scales, inverse = np.unique(np.concatenate((Hp, Hw), axis=1), axis=0, return_inverse=True)   # one layering for each month
+	dz = np.empty((len(scales), N))
+	for i, (hp, hw) in enumerate(scales):
+		u = (-np.expm1(-z/hw)/-np.expm1(-30/hw) - np.expm1(-z/hp)/-np.expm1(-30/hp))/2
+		dz[i] = np.interp(np.linspace(0, 1, num=N), u, z)
+	return dz[inverse.reshape(-1)]
+
+## This function calculates the value of the temperature, pressure and PWV through 30 Km of atmosphere using vertical profiles functions, for many realizations at once.
+#
+#  With the adaptive layering, the PWV of each layer is the integral of the PWV profile between its base and the base of the layer above.
+#
+#  @param params The parameters of the vertical profiles for each month (see params).
+#  @param T0 The temperatures at surface.
+#  @param P0 The pressures at surface.
+#  @param PWV The PWVs of the atmosphere column.
+#  @param month The months, in order to chose the correct vertical profiles.
 #  @param N The number of layers for the atmosphere discretization.
-def profiles(paramsfile, T0, P0, PWV, month, N):
-	params = np.loadtxt(paramsfile, skiprows=4)
-	Ht, a1, a2, b1, b2, Hp, Hw, hT0, hP0, hW0, hsite = params[int(month-1)]
-	Z = hsite + np.linspace(0, 30, num=N)
+#  @param layering The layering of the atmosphere: 'uniform' or 'adaptive' (see heights).
+#  @return The heights, temperatures, pressures and PWVs of the layers, each one with shape (number of realizations, N).
+@profiling.profiled
+def profiles_batch(params, T0, P0, PWV, month, N, layering='uniform'):
+	T0, P0, PWV = [np.asarray(x, dtype=float).reshape(-1, 1) for x in [T0, P0, PWV]]
+	Ht, a1, a2, b1, b2, Hp, Hw, hT0, hP0, hW0, hsite = params[np.asarray(month, dtype=int).reshape(-1)-1].T[:, :, None]
+	Z = hsite + heights(Hp, Hw, N, layering)
 	T0 = T0 - a1*hT0**2 - b1*hT0
 	P0 = P0*np.exp(hP0/Hp)
-	PWV0 = np.abs(PWV) * np.exp(hW0/Hw) /np.sum(np.exp(-(Z-hsite)/Hw))
+	if layering == 'uniform':
+		PWV0 = np.abs(PWV) * np.exp(hW0/Hw) /np.sum(np.exp(-(Z-hsite)/Hw), axis=1, keepdims=True)
 	c2 = a1*Ht**2+b1*Ht+T0
 	T1 = a1*Z**2+b1*Z+T0
 	T2 = a2*(Z-Ht)**2+b2*(Z-Ht)+c2
-	T = np.concatenate((T1[np.where(Z<Ht)[0]], T2[np.where(Z>=Ht)[0]]))
+	T = np.where(Z<Ht, T1, T2)
 	P = P0*np.exp(-Z/Hp)
-	pwv = PWV0*np.exp(-Z/Hw)
+	if layering == 'uniform':
+		pwv = PWV0*np.exp(-Z/Hw)
+	else:
+		w = np.exp(-(Z-hsite)/Hw)
+		w[:, :-1] = w[:, :-1] - w[:, 1:]   # the top layer takes the whole column above it
+		pwv = np.abs(PWV) * np.exp((hW0-hsite)/Hw) * w/np.sum(w, axis=1, keepdims=True)
 	return Z, T, P, pwv
 
+## This function calculates the value of the temperature, pressure and PWV through 30 Km of atmosphere using vertical profiles functions.
+#
+#  @param paramsfile The path for the parameters file.
+#  @param T0 The temperature at surface.
+#  @param P0 The pressure at surface.
+#  @param PWV The PWV of the atmosphere column.
+#  @param month The month, in order to chose the correct vertical profiles.
+#  @param N The number of layers for the atmosphere discretization.
+#  @param layering The layering of the atmosphere: 'uniform' or 'adaptive' (see heights).
+@profiling.profiled
+def profiles(paramsfile, T0, P0, PWV, month, N, layering='uniform'):
+	Z, T, P, pwv = profiles_batch(params(paramsfile), T0, P0, PWV, month, N, layering)
+	return Z[0], T[0], P[0], pwv[0]
+
+## The template of an atmospheric layer in the am configuration file.
+LAYER = 'layer\nPbase {} Pa\t# z = {} Km\nTbase {} K\ncolumn dry_air vmr\ncolumn h2o {} mm_pwv\n\n'
+
+## This function gives the content of the configuration file to run am.
+#
+#  @param freq_start The starting frequency.
+#  @param freq_stop The ending frequency.
+#  @param freq_interval The frequency interval for am simulation.
+#  @param T0 The background temperature.
+#  @param Z The index for each one of the atmospheric layers.
+#  @param T The temperature for each one of the atmospheric layers.
+#  @param P The pressure for each one of the atmospheric layers.
+#  @param pwv The PWV for each one of the atmospheric layers.
+#  @param header The header comment (the current date by default).
+def config_text(freq_start, freq_stop, freq_interval, T0, Z, T, P, pwv, header=None):
+	if header is None:
+		header = str(datetime.now())
+	head = '# '+header+'\n\nf '+str(freq_start)+' GHz '+str(freq_stop)+' GHz '+str(freq_interval)+' GHz\n\nT0 '+str(T0)+' K\n\n'
+	layers = map(LAYER.format, np.asarray(P)[::-1].tolist(), np.asarray(Z)[::-1].tolist(), np.asarray(T)[::-1].tolist(), np.asarray(pwv)[::-1].tolist())
+	return head+''.join(layers)
+
 ## This function creates the configuration file to run am.
 #
 #  @param freq_start The starting frequency.
@@ -74,30 +184,226 @@ def profiles(paramsfile, T0, P0, PWV, month, N):
 #  @param pwv The PWV for each one of the atmospheric layers.
 #  @param filename The path for the configuration file.
 def config(freq_start, freq_stop, freq_interval, T0, Z, T, P, pwv, filename):
-	file = open(filename+'.amc', 'w')
-	file.write('# '+str(datetime.now())+'\n\n')
-	file.write('f '+str(freq_start)+' GHz '+str(freq_stop)+' GHz '+str(freq_interval)+' GHz\n\n')
-	file.write('T0 '+str(T0)+' K\n\n')
-	for i in range(len(Z)):
-		j = len(Z)-i-1
-		file.write('layer\n')
-		file.write('Pbase '+str(P[j])+' Pa\t# z = '+str(Z[j])+' Km\n')
-		file.write('Tbase '+str(T[j])+' K\n')
-		file.write('column dry_air vmr\n')
-		file.write('column h2o '+str(pwv[j])+' mm_pwv\n\n')
-	file.close()
-	
+	with open(filename+'.amc', 'w') as file:
+		file.write(config_text(freq_start, freq_stop, freq_interval, T0, Z, T, P, pwv))
+
+## This function creates the configuration files to run am for many realizations, together with the list of their names.
+#
+#  @param directory The directory for the configuration files.
+#  @param filename The name of the list of the configuration files.
+#  @param names The name of each configuration file.
+#  @param freq_start The starting frequency.
+#  @param freq_stop The ending frequency.
+#  @param freq_interval The frequency interval for am simulation.
+#  @param T0 The background temperature.
+#  @param Z The index for each one of the atmospheric layers, with shape (number of realizations, number of layers).
+#  @param T The temperature for each one of the atmospheric layers, with shape (number of realizations, number of layers).
+#  @param P The pressure for each one of the atmospheric layers, with shape (number of realizations, number of layers).
+#  @param pwv The PWV for each one of the atmospheric layers, with shape (number of realizations, number of layers).
+#  @param pack If True, all the configurations are saved in the single archive filename.amcpack instead of one file each.
+def save_configs(directory, filename, names, freq_start, freq_stop, freq_interval, T0, Z, T, P, pwv, pack=False):
+	out = configs(directory, filename, pack)
+	out.write(names, freq_start, freq_stop, freq_interval, T0, Z, T, P, pwv, desc='Loading ...')
+	out.close()
+
+## This class represents the set of the configuration files of a run, written one block of realizations at a time.
+#
+#  The list of the names is extended after each block, so that it always refers to configurations already written.
+class configs:
+
+	## The constructor for the class.
+	#
+	#  @param self The object pointer.
+	#  @param directory The directory for the configuration files.
+	#  @param filename The name of the list of the configuration files.
+	#  @param pack If True, all the configurations are saved in the single archive filename.amcpack instead of one file each.
+	def __init__(self, directory, filename, pack=False):
+		## The directory for the configuration files.
+		self.directory = directory
+		## The number of written configurations.
+		self.count = 0
+		self._header = str(datetime.now())
+		packfile = os.path.join(directory, filename+'.amcpack')
+		self._archive = None
+		if pack:
+			self._archive = archive(packfile, 'w')
+		elif os.path.exists(packfile):   # stale archive of a previous run
+			os.remove(packfile)
+		self._list = open(os.path.join(directory, filename+'.txt'), 'w')
+
+	## This method gives the contents of the configuration files of a block of realizations, with the header of the run.
+	#
+	#  @param self The object pointer.
+	#  @param freq_start The starting frequency.
+	#  @param freq_stop The ending frequency.
+	#  @param freq_interval The frequency interval for am simulation.
+	#  @param T0 The background temperature.
+	#  @param Z The index for each one of the atmospheric layers, with shape (number of realizations, number of layers).
+	#  @param T The temperature for each one of the atmospheric layers, with shape (number of realizations, number of layers).
+	#  @param P The pressure for each one of the atmospheric layers, with shape (number of realizations, number of layers).
+	#  @param pwv The PWV for each one of the atmospheric layers, with shape (number of realizations, number of layers).
+	#  @param desc The description of the progress bar (no progress bar by default).
+	def texts(self, freq_start, freq_stop, freq_interval, T0, Z, T, P, pwv, desc=None):
+		return [config_text(freq_start, freq_stop, freq_interval, T0, Z[i], T[i], P[i], pwv[i], self._header) for i in tqdm(range(len(Z)), desc=desc, disable=desc is None)]
+
+	## This method writes the given configurations.
+	#
+	#  @param self The object pointer.
+	#  @param names The name of each configuration file.
+	#  @param texts The content of each configuration file.
+	def add(self, names, texts):
+		for name, text in zip(names, texts):
+			if self._archive is not None:
+				self._archive.write(name, text)
+			else:
+				with open(os.path.join(self.directory, name+'.amc'), 'w') as file:
+					file.write(text)
+		self._list.write(''.join(name+'\n' for name in names))
+		self._list.flush()
+		self.count = self.count + len(names)
+
+	## This method writes the configurations of a block of realizations.
+	#
+	#  @param self The object pointer.
+	#  @param names The name of each configuration file.
+	#  @param freq_start The starting frequency.
+	#  @param freq_stop The ending frequency.
+	#  @param freq_interval The frequency interval for am simulation.
+	#  @param T0 The background temperature.
+	#  @param Z The index for each one of the atmospheric layers, with shape (number of realizations, number of layers).
+	#  @param T The temperature for each one of the atmospheric layers, with shape (number of realizations, number of layers).
+	#  @param P The pressure for each one of the atmospheric layers, with shape (number of realizations, number of layers).
+	#  @param pwv The PWV for each one of the atmospheric layers, with shape (number of realizations, number of layers).
+	#  @param desc The description of the progress bar (no progress bar by default).
+	#  @return The contents of the configuration files.
+	def write(self, names, freq_start, freq_stop, freq_interval, T0, Z, T, P, pwv, desc=None):
+		texts = self.texts(freq_start, freq_stop, freq_interval, T0, Z, T, P, pwv, desc)
+		self.add(names, texts)
+		return texts
+
+	## This method closes the list of the names and the archive, if any.
+	#
+	#  @param self The object pointer.
+	def close(self):
+		self._list.close()
+		if self._archive is not None:
+			self._archive.close()
+
+## This class represents an indexed archive of am configuration files.
+#
+#  The configurations are concatenated in a single blob, followed by the JSON offset table and by a trailer giving the position of the table.
+class archive:
+
+	## The identifier closing each archive.
+	MAGIC = b'AMCPACK1'
+
+	## The constructor for the class.
+	#
+	#  @param self The object pointer.
+	#  @param path The path for the archive.
+	#  @param mode 'w' to write a new archive, 'r' to read an existing one.
+	def __init__(self, path, mode='r'):
+		## The path for the archive.
+		self.path = path
+		## The mode of the archive.
+		self.mode = mode
+		## The offset table: name -> (offset, length).
+		self.index = {}
+		if mode == 'w':
+			self._file = open(path, 'wb')
+			self._offset = 0
+		else:
+			self._fd = os.open(path, os.O_RDONLY)
+			size = os.fstat(self._fd).st_size
+			trailer = os.pread(self._fd, 16, size-16)
+			if trailer[8:] != archive.MAGIC:
+				raise ValueError(path+' is not an am configuration archive')
+			start = int.from_bytes(trailer[:8], 'little')
+			self.index = {k: tuple(v) for k, v in json.loads(os.pread(self._fd, size-16-start, start)).items()}
+
+	## This method appends a configuration to the archive.
+	#
+	#  @param self The object pointer.
+	#  @param name The name of the configuration.
+	#  @param text The content of the configuration.
+	def write(self, name, text):
+		data = text.encode()
+		self._file.write(data)
+		self.index[name] = (self._offset, len(data))
+		self._offset = self._offset + len(data)
+
+	## This method gives the content of a configuration (it can be called from many threads).
+	#
+	#  @param self The object pointer.
+	#  @param name The name of the configuration.
+	def read(self, name):
+		offset, length = self.index[name]
+		return os.pread(self._fd, length, offset).decode()
+
+	## This method gives the names of the configurations in the archive.
+	#
+	#  @param self The object pointer.
+	def names(self):
+		return list(self.index.keys())
+
+	## This method closes the archive, writing the offset table if needed.
+	#
+	#  @param self The object pointer.
+	def close(self):
+		if self.mode == 'w':
+			self._file.write(json.dumps(self.index).encode())
+			self._file.write(self._offset.to_bytes(8, 'little')+archive.MAGIC)
+			self._file.close()
+		else:
+			os.close(self._fd)
+
+## This function loads the am output files, keeping only the frequencies in a given range.
+#
+#  The frequency grid is taken from the first file, and only the rows in the range are parsed from each file, in parallel.
+#
+#  @param files The paths to the am output files, all with the same frequency grid.
+#  @param freq1 The starting frequency.
+#  @param freq2 The ending frequency.
+#  @param jobs The number of parallel readers (all the available cores by default).
+#  @return The frequencies, the opacities and the brightness temperatures, these last with shape (number of files, number of frequencies).
+def load_outputs(files, freq1, freq2, jobs=None):
+	import pandas as pd
+	ref = pd.read_csv(files[0], names=['Freq', 'Abs', 'Tb'], sep=' ', usecols=[0])['Freq'].to_numpy()
+	rows = np.where((ref >= freq1) & (ref <= freq2))[0]
+	freq = ref[rows]
+	skip, nrows = (rows[0], len(rows)) if len(rows) > 0 else (0, 0)
+	tau = np.empty((len(files), len(freq)))
+	Tb = np.empty((len(files), len(freq)))
+	def load(i):
+		df = pd.read_csv(files[i], names=['Freq', 'Abs', 'Tb'], sep=' ', skiprows=skip, nrows=nrows, dtype=float)
+		if not np.array_equal(df['Freq'].to_numpy(), freq):
+			raise ValueError(files[i]+' has a different frequency grid from '+files[0])
+		tau[i], Tb[i] = df['Abs'].to_numpy(), df['Tb'].to_numpy()
+	with ThreadPoolExecutor(max_workers=jobs if jobs else (os.cpu_count() or 1)) as pool:
+		list(tqdm(pool.map(load, range(len(files))), total=len(files), desc='Loading ...'))
+	return freq, tau, Tb
+
 ## This function plots the resulting brightness temperatures resulting from am.
 #
 #  @param output_file The path to the am output file.
 def am_plot(output_file):
+	import pandas as pd
 	atm = pd.read_table(output_file, names=['Freq', 'Line', 'Tb'], sep=' ')
-	plt.plot(atm['Freq'], atm['Tb'])
-	plt.xlim(atm['Freq'].min(), atm['Freq'].max())
-	plt.ylim(0, atm['Tb'].max()+10)
+	spectrum_plot(atm['Freq'], atm['Tb'])
+
+## This function plots a brightness temperature spectrum.
+#
+#  @param freq The frequencies.
+#  @param Tb The brightness temperatures.
+def spectrum_plot(freq, Tb):
+	import matplotlib.pyplot as plt
+	freq, Tb = np.asarray(freq), np.asarray(Tb)
+	plt.plot(freq, Tb)
+	plt.xlim(freq.min(), freq.max())
+	plt.ylim(0, Tb.max()+10)
 	plt.grid()
 	plt.xlabel('Frequency [GHz]')
 	plt.ylabel(r'$T_{atm} [K_{RJ}]$')
-	plt.xticks(np.arange(atm['Freq'].min(),atm['Freq'].max()+1,10))
-	plt.yticks(np.arange(0,atm['Tb'].max()+10,25))
+	plt.xticks(np.arange(freq.min(),freq.max()+1,10))
+	plt.yticks(np.arange(0,Tb.max()+10,25))
 	plt.show()
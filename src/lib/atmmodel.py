@@ -0,0 +1,233 @@
+"""! @brief Defines the climatology model of a site."""
+##
+# @file src/lib/atmmodel.py
+# @brief File for the lib.atmmodel package.
+#
+# The file is located under atmi/src/lib.
+#
+# @package lib.atmmodel
+# @brief Defines the climatology model of a site.
+#
+# @section description_atmmodel Description
+# Defines the model of the atmosphere of a site, trained once from the data archive: the probability density function of each variable at each hour of the year (slot) and the correlation structure of the slots, so that the samplings are drawn without the archive.
+# - model (class)
+# - samplings (class)
+#
+# @section libraries_atmmodel Libraries/Modules
+# - lib.atmsampling (\ref lib.atmsampling)
+#   - Access to binned_kde, variable, atmosphere and samplings classes.
+# - lib.netCDFutils (\ref lib.netCDFutils)
+#   - Access to slots function.
+# - json standard library (https://docs.python.org/3/library/json.html)
+#   - Access to loads and dumps functions, for the model metadata.
+# - numpy (https://numpy.org/doc/stable/)
+#   - Access to many useful functions for array manipulation.
+#
+# @section notes_atmmodel Notes
+# - Comments are Doxygen compatible.
+# - The window values of each slot are kept, since the covariances of any span of slots are computed from them; the densities are kept on a grid of GRID points. The values, the densities and the factors are float32.
+# - GRID (128) is coarser than the grid of the densities fitted from the archive (binned_kde.GRID, 1024), so that the model takes about 24 MB for three variables instead of about 110 MB: the quantiles drawn from a model differ from the archive ones by less than 1% of the standard deviation of the window (0.5% typically, on ERA5 data).
+# - The factors of the banded copula with the full lag (LAG hours) are computed at the training, so that the long samplings skip their covariances; the dense copula of the short samplings is still computed at each draw.
+# - The model is saved as an uncompressed .npz file, so that loading it takes a few milliseconds.
+#
+# @section todo_atmmodel TODO
+# - None.
+
+from lib import atmsampling
+from lib import netCDFutils
+import json
+import numpy as np
+
+## This class represents the climatology model of a site.
+#
+#  For each slot (hour of the year) it keeps the window values and the density of each variable, and the factors of the banded copula, and it gives the realizations of any span of slots ready for the correlated sampling.
+class model:
+
+    ## The number of points of the grid of the densities.
+    GRID = 128
+
+    ## The lag (in hours) of the banded copula factors computed at the training.
+    LAG = 24
+
+    ## The constructor for the class.
+    #
+    #  @param self The object pointer.
+    #  @param meta The metadata of the model (variables, site, years, semi-window, lag).
+    #  @param values The window values of each slot and variable, with shape (8760, number of variables, window size); NaN for the missing values.
+    #  @param lo The first point of the grid of each density, with shape (8760, number of variables).
+    #  @param dx The step of the grid of each density, with shape (8760, number of variables).
+    #  @param density The densities on their grids, with shape (8760, number of variables, GRID).
+    #  @param A The regression matrices of the banded copula of each slot (see lib.atmsampling.samplings.banded_factor), NaN for the first LAG slots.
+    #  @param L The square roots of the conditional covariances of the banded copula of each slot.
+    def __init__(self, meta, values, lo, dx, density, A, L):
+        ## The metadata of the model.
+        self.meta = meta
+        ## The window values of each slot and variable.
+        self.values = values
+        ## The first point of the grid of each density.
+        self.lo = lo
+        ## The step of the grid of each density.
+        self.dx = dx
+        ## The densities on their grids.
+        self.density = density
+        ## The regression matrices of the banded copula of each slot.
+        self.A = A
+        ## The square roots of the conditional covariances of the banded copula of each slot.
+        self.L = L
+
+    ## This method trains the model of a site from the datasets of its variables.
+    #
+    #  @param cls The class.
+    #  @param datas The datasets of the variables (see lib.netCDFutils.data).
+    #  @param names The names of the variables.
+    #  @param latitude The latitude of the site.
+    #  @param longitude The longitude of the site.
+    #  @param start The starting year of the windows.
+    #  @param stop The final year of the windows.
+    #  @param interval The number of days of the semi-window.
+    #  @param size The number of points of the grid of the densities.
+    #  @param lag The lag (in hours) of the banded copula factors.
+    @classmethod
+    def train(cls, datas, names, latitude, longitude, start, stop, interval=4, size=GRID, lag=LAG):
+        indexes = [data.climatology(start, stop, interval) for data in datas]
+        values = np.stack([np.ma.filled(datas[i].window_values(latitude, longitude, names[i], indexes[i]).astype(np.float32), np.nan) for i in range(len(names))], axis=1)
+        lo, dx, density = np.empty(values.shape[:2]), np.empty(values.shape[:2]), np.empty(values.shape[:2]+(size,), dtype=np.float32)
+        for i in range(len(names)):
+            pdfs = atmsampling.binned_kde.batch(values[:, i], size)
+            lo[:, i] = [pdf.grid[0] for pdf in pdfs]
+            dx[:, i] = [pdf.grid[1] - pdf.grid[0] for pdf in pdfs]
+            density[:, i] = [pdf.density for pdf in pdfs]
+        meta = {'variables': list(names), 'latitude': latitude, 'longitude': longitude, 'start': int(start), 'stop': int(stop), 'interval': interval, 'lag': lag}
+        site = cls(meta, values, lo, dx, density, None, None)
+        atm = site.realizations(np.arange(len(values)))
+        b = len(names)
+        A, L = np.full((len(values), b, lag*b), np.nan, dtype=np.float32), np.full((len(values), b, b), np.nan, dtype=np.float32)
+        for t in range(lag, len(values)):
+            A[t], L[t] = atm.banded_factor(t, lag)
+        site.A, site.L = A, L
+        return site
+
+    ## This method gives the names of the variables of the model.
+    #
+    #  @param self The object pointer.
+    def variables(self):
+        return list(self.meta['variables'])
+
+    ## This method gives the slots of the given dates.
+    #
+    #  @param self The object pointer.
+    #  @param months The months.
+    #  @param days The days.
+    #  @param hours The hours.
+    def slot(self, months, days, hours):
+        return netCDFutils.slots(months, days, hours)
+
+    ## This method gives the window values of a variable at a slot.
+    #
+    #  @param self The object pointer.
+    #  @param name The name of the variable.
+    #  @param slot The slot.
+    def window_values(self, name, slot):
+        return np.ma.masked_invalid(self.values[slot, self.meta['variables'].index(name)].astype(float))
+
+    ## This method gives the probability density function of a variable at a slot.
+    #
+    #  @param self The object pointer.
+    #  @param name The name of the variable.
+    #  @param slot The slot.
+    def pdf(self, name, slot):
+        i = self.meta['variables'].index(name)
+        density = self.density[slot, i].astype(float)
+        return atmsampling.binned_kde(self.lo[slot, i] + self.dx[slot, i]*np.arange(len(density)), density)
+
+    ## This method gives the variable of a slot, with its probability density function.
+    #
+    #  @param self The object pointer.
+    #  @param name The name of the variable.
+    #  @param slot The slot.
+    def variable(self, name, slot):
+        return atmsampling.variable(name, self.window_values(name, slot), pdf=self.pdf(name, slot))
+
+    ## This method gives the realizations of the given slots, ready for the correlated sampling.
+    #
+    #  The factors of the banded copula computed at the training are used when the slots are consecutive and the variables are the ones of the model, in the same order.
+    #
+    #  @param self The object pointer.
+    #  @param slots The slots of the realizations.
+    #  @param names The names of the variables (all the ones of the model by default).
+    def realizations(self, slots, names=None):
+        names = self.variables() if names is None else list(names)
+        slots = np.asarray(slots, dtype=int)
+        columns = [self.meta['variables'].index(name) for name in names]
+        factors = None
+        if self.A is not None and names == self.variables() and np.all(np.diff(slots) == 1):
+            factors = (self.meta['lag'], self.A[slots].astype(float), self.L[slots].astype(float))
+        density = self.density[slots][:, columns].astype(float)
+        grids = self.lo[slots][:, columns, None] + self.dx[slots][:, columns, None]*np.arange(density.shape[2])
+        return samplings(self.values[slots][:, columns].astype(float), grids, density, factors=factors)
+
+    ## This method saves the model on a .npz file.
+    #
+    #  @param self The object pointer.
+    #  @param path The path to the model file.
+    def save(self, path):
+        np.savez(path, meta=np.array(json.dumps(self.meta)), values=self.values, lo=self.lo, dx=self.dx, density=self.density, A=self.A, L=self.L)
+
+    ## This method loads the model from a .npz file.
+    #
+    #  @param cls The class.
+    #  @param path The path to the model file.
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            return cls(json.loads(str(f['meta'])), f['values'], f['lo'], f['dx'], f['density'], f['A'], f['L'])
+
+## This class gathers the realizations of consecutive slots of a model, built from its arrays instead of one object for each variable and slot.
+#
+#  The samplings are drawn as by lib.atmsampling.samplings, with the same random numbers, from the densities of the model (on its coarser grid, see model.GRID).
+class samplings(atmsampling.samplings):
+
+    ## The constructor for the class.
+    #
+    #  @param self The object pointer.
+    #  @param values The window values of each realization and variable, with shape (number of realizations, number of variables, window size); NaN for the missing values.
+    #  @param grids The grids of the densities, with shape (number of realizations, number of variables, grid size).
+    #  @param density The densities on their grids.
+    #  @param factors The factors of the banded copula already computed, if any (see lib.atmsampling.samplings).
+    def __init__(self, values, grids, density, factors=None):
+        ## The different realizations describing the atmosphere (not built).
+        self.atmospheres = None
+        ## The values for each variable of each realization.
+        self.values = values
+        valid = np.ma.masked_invalid(values)
+        ## The mean value for each variable of each realization.
+        self.means = np.ma.filled(valid.mean(axis=2), np.nan)
+        ## The standard deviation for each variable of each realization.
+        self.stdevs = np.ma.filled(valid.std(axis=2), np.nan)
+        ## The factors of the banded copula already computed, if any.
+        self.factors = factors
+        ## The grids of the densities.
+        self.grids = grids
+        cdf = np.concatenate((np.zeros(density.shape[:2]+(1,)), np.cumsum((density[:, :, 1:] + density[:, :, :-1])/2 * np.diff(grids, axis=2), axis=2)), axis=2)
+        ## The cumulative distributions on the grids.
+        self.cdfs = cdf/cdf[:, :, -1:]
+
+    ## This method samples indipendently one realization for each slot, using the pdfs of their variables.
+    #
+    #  @param self The object pointer.
+    #  @param N The number of desired samplings.
+    def sample(self, N):
+        a, b = self.means.shape
+        return self.quantiles(np.random.random((a, b, N)))   # the same numbers as one draw for each variable of each slot
+
+    ## This method gives the values of each variable of each slot for the given probabilities, using their pdfs.
+    #
+    #  @param self The object pointer.
+    #  @param u The probabilities, with shape (number of realizations, number of variables, N).
+    def quantiles(self, u):
+        a, b, N = u.shape
+        sample = np.empty((a, N, b))
+        for t in range(a):
+            for i in range(b):
+                sample[t, :, i] = np.interp(u[t, i], self.cdfs[t, i], self.grids[t, i])
+        return sample
@@ -10,17 +10,30 @@
 #
 # @section description_atmsampling Description
 # Defines the base and end user classes for the sampling of generic atmosphere's realizations.
+# - binned_kde
 # - variable (base class)
 # - atmosphere
 # - sampling
 #
 # @section libraries_atmsampling Libraries/Modules
+# - lib.profiling (\ref lib.profiling)
+#   - Access to profiled function, for the opt-in profiling of the hot functions.
+# - concurrent.futures standard library (https://docs.python.org/3/library/concurrent.futures.html)
+#   - Access to ProcessPoolExecutor class, for the chunks of the seeded samplings.
+# - multiprocessing standard library (https://docs.python.org/3/library/multiprocessing.html)
+#   - Access to get_context function, for the processes started from a thread (e.g. by the atmi worker).
 # - matplotlib.pyplot (https://matplotlib.org/3.5.3/api/_as_gen/matplotlib.pyplot.html)
 #   - Access to plot functions.
 # - numpy (https://numpy.org/doc/stable/)
 #   - Access to many useful functions for array manipulation.
+#   - Access to SeedSequence class and default_rng function, for the random streams of the seeded samplings.
+# - os standard library (https://docs.python.org/3/library/os.html)
+#   - Access to cpu_count function.
+# - threading standard library (https://docs.python.org/3/library/threading.html)
+#   - Access to current_thread and main_thread functions.
 # - scipy.linalg (https://docs.scipy.org/doc/scipy/reference/linalg.html)
 #   - Access to eigh function, for the eigenvalues and eigenvectors determination.
+#   - Access to pinvh function, for the conditional covariances of the banded copula.
 # - scipy.stats (https://docs.scipy.org/doc/scipy/reference/stats.html) 
 #   - Access to gaussian_kde function.
 #   - Access to norm function.
@@ -29,6 +42,8 @@
 #
 # @section notes_atmsampling Notes
 # - Comments are Doxygen compatible.
+# - matplotlib, termplotlib and scipy are imported by the functions using them, so that importing the module does not load them.
+# - The seeded samplings give each realization its own random stream, spawned from the seed, and draw them in blocks of BLOCK realizations: the result is the same whatever the number of processes and the size of the chunks.
 #
 # @section todo_atmsampling TODO
 # - None.
@@ -37,11 +52,116 @@
 # - Created by Luca Cintura on 20/03/2023.
 # - Modified by Luca Cintura on 20/03/2023.
 
-import matplotlib.pyplot as plt
+from lib import profiling
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
 import numpy as np
-from scipy.linalg import eigh
-from scipy.stats import gaussian_kde, norm
-import termplotlib as tpl
+import os
+import threading
+
+_worker = None   # samplings, root seed, lag and correlation operator of a process of the pool
+
+## This class represents a probability density function estimated with a binned KDE.
+#
+#  The data are linearly binned on a regular grid and convolved with the gaussian kernel through FFT, so the evaluation costs O(grid log grid) instead of O(points x data). The bandwidth follows the Scott's rule, as gaussian_kde.
+class binned_kde:
+
+    ## The default number of points of the grid.
+    GRID = 1024
+
+    ## The constructor for the class.
+    #
+    #  @param self The object pointer.
+    #  @param grid The regular grid of the density.
+    #  @param density The density on the grid.
+    def __init__(self, grid, density):
+        ## The regular grid of the density.
+        self.grid = grid
+        ## The density on the grid.
+        self.density = density
+        cdf = np.concatenate(([0], np.cumsum((density[1:] + density[:-1])/2 * np.diff(grid))))
+        ## The cumulative distribution on the grid.
+        self.cdf = cdf/cdf[-1]
+
+    ## This method estimates the density of a set of values.
+    #
+    #  @param cls The class.
+    #  @param values The values of the variable.
+    #  @param size The number of points of the grid.
+    @classmethod
+    def fit(cls, values, size=GRID):
+        return cls.batch(np.ma.atleast_2d(values), size)[0]
+
+    ## This method estimates at once the densities of many sets of values (e.g. the same variable at all the hours of a sampling).
+    #
+    #  @param cls The class.
+    #  @param values The values of the variables, with shape (number of sets, number of values); the invalid values are ignored.
+    #  @param size The number of points of the grid.
+    @classmethod
+    @profiling.profiled
+    def batch(cls, values, size=GRID):
+        values = np.ma.masked_invalid(np.ma.atleast_2d(values))
+        valid = ~np.ma.getmaskarray(values)
+        x = np.ma.filled(values.astype(float), 0)
+        n = valid.sum(axis=1)
+        mean = (x*valid).sum(axis=1)/np.maximum(n, 1)
+        std = np.sqrt(((x - mean[:, None])**2*valid).sum(axis=1)/np.maximum(n - 1, 1))
+        bw = std*np.maximum(n, 1)**(-1/5)
+        bw = np.where(bw > 0, bw, 1e-6*np.maximum(np.abs(mean), 1))   # constant values
+        lo = np.ma.filled(values.min(axis=1), 0) - 4*bw
+        hi = np.ma.filled(values.max(axis=1), 0) + 4*bw
+        dx = (hi - lo)/(size - 1)
+        # linear binning
+        pos = np.clip((x - lo[:, None])/dx[:, None], 0, size - 1)
+        left = np.minimum(np.floor(pos).astype(int), size - 2)
+        frac = pos - left
+        rows = np.arange(len(x))[:, None]*size
+        counts = np.zeros(len(x)*size)
+        np.add.at(counts, (rows + left)[valid], (1 - frac)[valid])
+        np.add.at(counts, (rows + left + 1)[valid], frac[valid])
+        counts = counts.reshape(len(x), size)
+        # gaussian convolution through FFT (zero padded to avoid the wrap around)
+        k = np.fft.rfftfreq(2*size)
+        kernel = np.exp(-0.5*(2*np.pi*k[None, :]*(bw/dx)[:, None])**2)
+        density = np.fft.irfft(np.fft.rfft(counts, 2*size, axis=1)*kernel, 2*size, axis=1)[:, :size]
+        density = np.clip(density, 0, None)/(np.maximum(n, 1)*dx)[:, None]
+        grids = lo[:, None] + dx[:, None]*np.arange(size)
+        return [cls(grids[i], density[i]) for i in range(len(x))]
+
+    ## This method evaluates the density.
+    #
+    #  @param self The object pointer.
+    #  @param x The points where to evaluate the density.
+    def evaluate(self, x):
+        return np.interp(x, self.grid, self.density, left=0, right=0)
+
+    ## This method evaluates the density.
+    #
+    #  @param self The object pointer.
+    #  @param x The points where to evaluate the density.
+    def __call__(self, x):
+        return self.evaluate(x)
+
+    ## This method samples some values from the density through the inverse of the cumulative distribution.
+    #
+    #  @param self The object pointer.
+    #  @param N The number of desired samplings.
+    #  @param seed The seed or the numpy random generator (the global one by default).
+    def resample(self, N, seed=None):
+        if isinstance(seed, np.random.Generator):
+            u = seed.random(N)
+        elif seed is None:
+            u = np.random.random(N)
+        else:
+            u = np.random.default_rng(seed).random(N)
+        return self.quantile(u)[None, :]
+
+    ## This method gives the values of the given probabilities, through the inverse of the cumulative distribution.
+    #
+    #  @param self The object pointer.
+    #  @param u The probabilities.
+    def quantile(self, u):
+        return np.interp(u, self.cdf, self.grid)
 	
 ## This class represents the generic atmospheric variable.
 #
@@ -53,13 +173,22 @@ class variable:
     #  @param self The object pointer.
     #  @param name The name of the variable.
     #  @param values The values assumed by the variable.
-    def __init__(self, name, values):
+    #  @param backend The KDE used for the probability density function: 'binned' (binned_kde) or 'scipy' (exact gaussian_kde, as a reference).
+    #  @param pdf The probability density function, if already estimated (e.g. with binned_kde.batch).
+    def __init__(self, name, values, backend='binned', pdf=None):
         ## The name of the variable.
         self.name = name
         ## The values defining the variable statistics.
         self.values = np.ma.masked_invalid(values)
         ## The probability density function calculated using KDE.
-        self.pdf = gaussian_kde(self.values) 
+        if pdf is not None:
+            self.pdf = pdf
+        elif backend == 'scipy':
+            from scipy.stats import gaussian_kde
+            self.pdf = gaussian_kde(self.values)
+        else:
+            self.pdf = binned_kde.fit(self.values)
+        self._inverse = None   # cumulative distribution of the scipy backend, computed when first needed (see quantile)
      
     ## This method samples one value for the variable, using his pdf.
     #
@@ -67,11 +196,27 @@ class variable:
     #  @param N The number of desired samplings.
     def sample(self, N):
         return self.pdf.resample(N)[0]
+
+    ## This method gives the values of the variable for the given probabilities, using his pdf.
+    #
+    #  With the scipy backend, the cumulative distribution is integrated once from the exact density, evaluated on a grid of binned_kde.GRID points reaching 5 bandwidths beyond the values.
+    #
+    #  @param self The object pointer.
+    #  @param u The probabilities.
+    def quantile(self, u):
+        if isinstance(self.pdf, binned_kde):
+            return self.pdf.quantile(u)
+        if self._inverse is None:
+            h = np.sqrt(self.pdf.covariance[0, 0])   # bandwidth of the kernel
+            grid = np.linspace(self.values.min() - 5*h, self.values.max() + 5*h, binned_kde.GRID)
+            self._inverse = binned_kde(grid, self.pdf(grid))
+        return self._inverse.quantile(u)
         
     ## This method plots the variable pdf on a canvas.
     #
     #  @param self The object pointer.
     def plot_pdf(self):
+        import matplotlib.pyplot as plt
         x = np.linspace(self.values.min(), self.values.max(), 1000)
         y = self.pdf(x)
         plt.plot(x, y, c='r')
@@ -83,6 +228,7 @@ class variable:
     #
     #  @param self The object pointer.
     def termplot_pdf(self):
+        import termplotlib as tpl
         x = np.linspace(self.values.min(), self.values.max(), 1000)
         y = self.pdf(x)
         fig = tpl.figure()
@@ -131,15 +277,28 @@ class atmosphere:
 #  More details.
 class samplings:
 
+    ## The number of realizations drawn together by the seeded samplings.
+    BLOCK = 256
+
+    ## The default number of realizations of each chunk of the seeded samplings.
+    CHUNK = 4096
+
     ## The constructor for the class.
     #
     #  @param self The object pointer.
     #  @param atmospheres The different realizations describing the atmosphere.
-    def __init__(self, atmospheres):
+    #  @param factors The factors of the banded copula already computed (e.g. by a site model, see lib.atmmodel), as (lag, A, L) with A and L the ones of each realization (see banded_factor), used for the realizations with the full lag.
+    def __init__(self, atmospheres, factors=None):
         ## The different realizations describing the atmosphere.
         self.atmospheres = atmospheres
         ## The values for each variable of each realization.
         self.values = np.array([atm.values for atm in atmospheres])
+        ## The mean value for each variable of each realization.
+        self.means = np.array([atm.means for atm in atmospheres])
+        ## The standard deviation for each variable of each realization.
+        self.stdevs = np.array([atm.stdevs for atm in atmospheres])
+        ## The factors of the banded copula already computed, if any.
+        self.factors = factors
      
     ## This method samples indipendently one realization for each one of the atmospheres, using the pdfs of their variables.
     #
@@ -150,6 +309,18 @@ class samplings:
         for atm in self.atmospheres:
             sample.append(atm.sample(N))
         return np.array(sample)
+
+    ## This method gives the values of each variable of each realization for the given probabilities, using their pdfs.
+    #
+    #  @param self The object pointer.
+    #  @param u The probabilities, with shape (number of realizations, number of variables, N).
+    #  @return The values, with shape (number of realizations, N, number of variables), as sample.
+    def quantiles(self, u):
+        sample = np.empty((u.shape[0], u.shape[2], u.shape[1]))
+        for t in range(len(self.atmospheres)):
+            for i in range(len(self.atmospheres[t].variables)):
+                sample[t, :, i] = self.atmospheres[t].variables[i].quantile(u[t, i])
+        return sample
      
     ## This method calculates the covariance matrix for all the variables.
     #
@@ -162,21 +333,88 @@ class samplings:
     #
     #  @param self The object pointer.
     def copula(self):
+        from scipy.linalg import eigh
         cov = self.covariance()
         evals, evecs = eigh(cov)
         return np.matmul(evecs, np.diag(np.sqrt(evals.clip(min=0))))
       
+    ## This method induces the correlations on independent standardized samplings, through a banded (Markov) model of the temporal covariance.
+    #
+    #  Each hour is drawn conditionally on the previous lag hours only, using the covariance of that block: memory and time grow linearly with the number of hours, instead of the dense copula.
+    #
+    #  @param self The object pointer.
+    #  @param sample The independent standardized samplings, with shape (number of hours * number of variables, N).
+    #  @param lag The maximum lag (in hours) of the temporal correlation.
+    #  @param factors The factors of each realization (see banded_factors), if already computed.
+    def banded_correlate(self, sample, lag, factors=None):
+        a, b, c = np.shape(self.values)
+        N = np.shape(sample)[1]
+        z = np.reshape(sample, (a, b, N))
+        y = np.empty((a, b, N))
+        for t in range(a):
+            p = max(0, t - lag)
+            k = (t - p)*b
+            if factors is not None:
+                A, L = factors[t]
+            elif self.factors is not None and self.factors[0] == lag and t >= lag:
+                A, L = self.factors[1][t], self.factors[2][t]
+            else:
+                A, L = self.banded_factor(t, lag)
+            mean = 0
+            if k > 0:
+                mean = np.matmul(A, np.reshape(y[p:t], (k, N)))
+            y[t] = mean + np.matmul(L, z[t])
+        return np.reshape(y, (a*b, N))
+
+    ## This method gives the factors of the banded copula for a realization: the regression on the previous lag realizations and the square root of the conditional covariance.
+    #
+    #  @param self The object pointer.
+    #  @param t The position of the realization.
+    #  @param lag The maximum lag (in hours) of the temporal correlation.
+    #  @return The regression matrix, with shape (number of variables, number of previous values), and the square root of the conditional covariance.
+    def banded_factor(self, t, lag):
+        from scipy.linalg import eigh, pinvh
+        a, b, c = np.shape(self.values)
+        p = max(0, t - lag)
+        k = (t - p)*b
+        cov = np.atleast_2d(np.cov(np.reshape(self.values[p:t+1], ((t + 1 - p)*b, c))))
+        cond = cov[k:, k:]
+        A = np.zeros((b, 0))
+        if k > 0:
+            A = np.matmul(cov[k:, :k], pinvh(cov[:k, :k]))
+            cond = cond - np.matmul(A, cov[:k, k:])
+        evals, evecs = eigh(cond)
+        return A, evecs*np.sqrt(evals.clip(min=0))
+
+    ## This method gives the factors of the banded copula for all the realizations, taking the ones already computed when possible.
+    #
+    #  @param self The object pointer.
+    #  @param lag The maximum lag (in hours) of the temporal correlation.
+    #  @return The regression matrix and the square root of the conditional covariance of each realization (see banded_factor).
+    def banded_factors(self, lag):
+        factors = []
+        for t in range(len(self.values)):
+            if self.factors is not None and self.factors[0] == lag and t >= lag:
+                factors.append((self.factors[1][t], self.factors[2][t]))
+            else:
+                factors.append(self.banded_factor(t, lag))
+        return factors
+
     ## This method samples one realization for each one of the atmospheres, inducing the correlations. It assumes gaussian probability.
     #
     #  @param self The object pointer.
     #  @param N The number of desired samplings.
-    def correlated_sample_gaussian(self, N):
-        nvar = np.sum([len(atmosphere.variables) for atmosphere in self.atmospheres])
-        natm = len(self.atmospheres)
-        means = np.reshape(np.array([atmosphere.means for atmosphere in self.atmospheres]), (nvar, 1))
+    #  @param lag The maximum lag (in hours) of the banded temporal correlation (see banded_correlate); the dense copula is used if None.
+    def correlated_sample_gaussian(self, N, lag=None):
+        natm, nvar = len(self.means), np.size(self.means)
+        from scipy.stats import norm
+        means = np.reshape(self.means, (nvar, 1))
         sample = norm.rvs(size = (nvar, N))
-        C = self.copula()
-        sampling = (np.dot(C, sample) + means).T
+        if lag is None:
+            C = self.copula()
+            sampling = (np.dot(C, sample) + means).T
+        else:
+            sampling = (self.banded_correlate(sample, lag) + means).T
         a, b = np.shape(sampling)
         return np.reshape(sampling, (a, natm, b//natm))
         
@@ -184,15 +422,92 @@ class samplings:
     #
     #  @param self The object pointer.
     #  @param N The number of desired samplings.
-    def correlated_sample(self, N):
-        nvar = np.sum([len(atmosphere.variables) for atmosphere in self.atmospheres])
-        natm = len(self.atmospheres)
-        means = np.reshape(np.array([atmosphere.means for atmosphere in self.atmospheres]), (nvar, 1))
-        stds = np.reshape(np.array([atmosphere.stdevs for atmosphere in self.atmospheres]), (nvar, 1))
+    #  @param lag The maximum lag (in hours) of the banded temporal correlation (see banded_correlate); the dense copula is used if None.
+    #  @param seed The seed (an integer or a numpy SeedSequence) of the samplings, drawn in chunks (see seeded_sample); the global numpy random generator is used, at once, if None.
+    #  @param chunk The number of realizations of each chunk, with a seed.
+    #  @param jobs The number of processes drawing the chunks, with a seed (0 = all the available cores).
+    @profiling.profiled
+    def correlated_sample(self, N, lag=None, seed=None, chunk=CHUNK, jobs=1):
+        if seed is not None:
+            return self.seeded_sample(N, lag, seed, chunk, jobs)
+        natm, nvar = len(self.means), np.size(self.means)
+        means = np.reshape(self.means, (nvar, 1))
+        stds = np.reshape(self.stdevs, (nvar, 1))
         sample = np.array([s.T for s in self.sample(N)])
         a, b, c = np.shape(sample)
         sample = (np.reshape(sample, (a*b, c)) - means)/stds
-        C = self.copula()
-        sampling = (np.dot(C, sample) + means).T
+        if lag is None:
+            C = self.copula()
+            sampling = (np.dot(C, sample) + means).T
+        else:
+            sampling = (self.banded_correlate(sample, lag) + means).T
         a, b = np.shape(sampling)
         return np.reshape(sampling, (a, natm, b//natm))
+
+    ## This method samples one realization for each one of the atmospheres, inducing the correlations, in chunks drawn by a pool of processes. It not assumes gaussian probability.
+    #
+    #  The samplings are numbered, and each one draws its probabilities from its own stream, spawned from the seed: the result depends only on the seed and on N, and not on the chunks or the processes.
+    #
+    #  @param self The object pointer.
+    #  @param N The number of desired samplings.
+    #  @param lag The maximum lag (in hours) of the banded temporal correlation (see banded_correlate); the dense copula is used if None.
+    #  @param seed The seed, an integer or a numpy SeedSequence.
+    #  @param chunk The number of realizations of each chunk, rounded up to a multiple of BLOCK.
+    #  @param jobs The number of processes (0 = all the available cores).
+    def seeded_sample(self, N, lag, seed, chunk=CHUNK, jobs=1):
+        root = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+        operator = self.copula() if lag is None else self.banded_factors(lag)   # computed once for all the chunks
+        chunk = -(-max(chunk, 1) // self.BLOCK)*self.BLOCK
+        bounds = [(n, min(n + chunk, N)) for n in range(0, N, chunk)]
+        jobs = min(jobs if jobs else (os.cpu_count() or 1), len(bounds))
+        if jobs <= 1:
+            parts = [self.chunk_sample(n1, n2, root, lag, operator) for n1, n2 in bounds]
+        else:
+            context = None if threading.current_thread() is threading.main_thread() else multiprocessing.get_context('spawn')   # forking a threaded process is unsafe
+            with ProcessPoolExecutor(max_workers=jobs, mp_context=context, initializer=_init, initargs=(self, root, lag, operator)) as pool:
+                parts = list(pool.map(_chunk, bounds))
+        natm, nvar = len(self.means), np.size(self.means)
+        return np.concatenate(parts) if len(parts) > 0 else np.empty((0, natm, nvar//natm))
+
+    ## This method draws a chunk of the seeded samplings (see seeded_sample), a block of BLOCK realizations at a time.
+    #
+    #  @param self The object pointer.
+    #  @param start The number of the first sampling of the chunk, a multiple of BLOCK.
+    #  @param stop The number of the sampling after the last one of the chunk.
+    #  @param root The SeedSequence of the samplings.
+    #  @param lag The maximum lag (in hours) of the banded temporal correlation; the dense copula is used if None.
+    #  @param operator The copula matrix, or the factors of the banded copula (see banded_factors).
+    #  @return The samplings, with shape (stop - start, number of realizations, number of variables).
+    def chunk_sample(self, start, stop, root, lag, operator):
+        natm, nvar = len(self.means), np.size(self.means)
+        means = np.reshape(self.means, (nvar, 1))
+        stds = np.reshape(self.stdevs, (nvar, 1))
+        parts = []
+        for n1 in range(start, stop, self.BLOCK):
+            n2 = min(n1 + self.BLOCK, stop)
+            streams = [np.random.default_rng(np.random.SeedSequence(root.entropy, spawn_key=root.spawn_key + (n,), pool_size=root.pool_size)) for n in range(n1, n2)]   # as root.spawn, the n-th child
+            u = np.stack([rng.random((natm, nvar//natm)) for rng in streams], axis=2)
+            sample = (np.reshape(np.transpose(self.quantiles(u), (0, 2, 1)), (nvar, n2 - n1)) - means)/stds
+            if lag is None:
+                sampling = np.dot(operator, sample)
+            else:
+                sampling = self.banded_correlate(sample, lag, operator)
+            parts.append(np.reshape((sampling + means).T, (n2 - n1, natm, nvar//natm)))
+        return np.concatenate(parts) if len(parts) > 0 else np.empty((0, natm, nvar//natm))
+
+## This function initializes a process of the pool of the seeded samplings.
+#
+#  @param sampling The samplings.
+#  @param root The SeedSequence of the samplings.
+#  @param lag The maximum lag (in hours) of the banded temporal correlation.
+#  @param operator The copula matrix, or the factors of the banded copula.
+def _init(sampling, root, lag, operator):
+    global _worker
+    _worker = (sampling, root, lag, operator)
+
+## This function draws a chunk of the seeded samplings in a process of the pool.
+#
+#  @param bounds The numbers of the first sampling of the chunk and of the one after the last.
+def _chunk(bounds):
+    sampling, root, lag, operator = _worker
+    return sampling.chunk_sample(bounds[0], bounds[1], root, lag, operator)
@@ -14,8 +14,11 @@
 # - azimuth (function)
 # - Tazimuth (function)
 # - Pn_gaussian (function)
+# - trapezoid_weights (function)
 #
 # @section libraries_instrumentObs Libraries/Modules
+# - lib.profiling (\ref lib.profiling)
+#   - Access to profiled function, for the opt-in profiling of the hot functions.
 # - numpy (https://numpy.org/doc/stable/)
 #   - Access to many useful functions for array manipulation.
 # - scipy.stats (https://docs.scipy.org/doc/scipy/reference/stats.html)
@@ -23,6 +26,7 @@
 #
 # @section notes_instrumentObs Notes
 # - Comments are Doxygen compatible.
+# - scipy is imported by Pn_gaussian only.
 #
 # @section todo_instrumentObs TODO
 # - None.
@@ -31,8 +35,8 @@
 # - Created by Luca Cintura on 10/05/2023.
 # - Modified by Luca Cintura on 10/05/2023.
 
+from lib import profiling
 import numpy as np
-import scipy.stats as st
 
 ## This function calculates the atmospheric variable depending on the azimuth.
 #
@@ -48,9 +52,24 @@ def Tazimuth(T0, theta):
 #  @param mean The pointing of the antenna.
 #  @param FWHM The FWHM of the antenna.
 def Pn_gaussian(theta, mean, FWHM):
+    import scipy.stats as st
     gaussian = st.multivariate_normal(mean, FWHM/(2*np.sqrt(2*np.log(2))))
     return gaussian.pdf(theta)/gaussian.pdf(mean)
     
+## This function calculates the weights of the trapezoid integration of a function times a weight function, normalized to the integral of the weight function.
+#
+#  The integral of f(x)w(x) divided by the integral of w(x) is the dot product between the weights and f.
+#
+#  @param x The integration points.
+#  @param w The weight function at the integration points.
+def trapezoid_weights(x, w):
+    x, w = np.asarray(x, dtype=float), np.asarray(w, dtype=float)
+    c = (w[1:] + w[:-1])/2 * np.diff(x)   # mean of w times the step, for each interval
+    weights = np.zeros(len(x))
+    weights[:-1] = weights[:-1] + c/2
+    weights[1:] = weights[1:] + c/2
+    return weights/np.sum(c)
+
 ## This class can consider the instrument characteristics for the observation.
 #
 #  More details.
@@ -58,6 +77,8 @@ class instrument:
 
     ## The constructor for the class.
     #
+    #  The normalized trapezoid weights of the beam and of the band are computed once, so that the observation reduces to dot products.
+    #
     #  @param self The object pointer.
     #  @param theta The azimuth angles.
     #  @param Pn The normalized pattern of the antenna.
@@ -66,38 +87,31 @@ class instrument:
     def __init__(self, theta, Pn, freq, band):
         self.pattern = {'theta':theta, 'Pn':Pn}
         self.fband = {'freq':freq, 'band':band}
+        ## The normalized trapezoid weights of the antenna pattern.
+        self.wpattern = trapezoid_weights(theta, Pn)
+        ## The normalized trapezoid weights of the band function.
+        self.wband = trapezoid_weights(freq, band)
+        ## The ratio between the antenna temperature and the brightness temperature at the azimuth.
+        self.beam = np.dot(self.wpattern, Tazimuth(1, np.asarray(theta, dtype=float)))
 
     ## This method calculates the antenna temperature for a given brightness temperature at the azimuth.
     #
     #  @param self The object pointer.
     #  @param T0 The brightness temperature at the azimuth.
     def Tantenna(self, T0):
-        theta, Pn = self.pattern['theta'], self.pattern['Pn']
-        Tb = Tazimuth(T0, theta)
-        A1, A2 = 0, 0
-        for i in range(len(Pn)-1):
-            A1 = A1 + np.mean(Tb[i:i+2]) * np.mean(Pn[i:i+2]) * (theta[i+1] - theta[i])
-            A2 = A2 + np.mean(Pn[i:i+2]) * (theta[i+1] - theta[i])
-        return A1/A2
+        return self.beam*np.asarray(T0)
 
     ## This method integrates in the band function of the isntrument.
     #
     #  @param self The object pointer.
-    #  @param Ta The antenna temperature at the frequencies of the instrument.
+    #  @param Ta The antenna temperature at the frequencies of the instrument (the last axis runs over the frequencies).
     def bandinteg(self, Ta):
-        freq, band = self.fband['freq'], self.fband['band']
-        A1, A2 = 0, 0
-        for i in range(len(freq)-1):
-            A1 = A1 + np.mean(Ta[i:i+2]) * np.mean(band[i:i+2]) * (freq[i+1] - freq[i])
-            A2 = A2 + np.mean(band[i:i+2]) * (freq[i+1] - freq[i])
-        return A1/A2
+        return np.dot(np.asarray(Ta), self.wband)
 
     ## This method calculates the antenna temperature for a given brightness temperature at the azimuth.
     #
     #  @param self The object pointer.
-    #  @param T0 The brightness temperature at the azimuth.
+    #  @param T0 The brightness temperature at the azimuth, for each frequency; a 2-D array (number of spectra, number of frequencies) integrates many spectra at once.
+    @profiling.profiled
     def observation(self, T0):
-        Ta = []
-        for T in T0:
-            Ta.append(self.Tantenna(T))
-        return self.bandinteg(Ta)
+        return self.bandinteg(self.Tantenna(T0))
@@ -9,21 +9,41 @@
 # @brief Gathers some useful functions for netCDF data manipulation.
 #
 # @section description_netCDFutils Description
-# Defines the user class for the manipulation of generic netCDF dataset and a function for time dates selection.
+# Defines the user class for the manipulation of generic netCDF dataset, the index of the days windows and some functions for time dates selection.
 # - data (class)
+# - climatology (class)
+# - windows (function)
 # - window (function)
+# - slots (function)
+# - nearest (function)
+# - paths (function)
+# - sites (function)
+# - metadata (function)
+# - load (function)
 #
 # @section libraries_netCDFutils Libraries/Modules
+# - lib.profiling (\ref lib.profiling)
+#   - Access to profiled function, for the opt-in profiling of the hot functions.
+# - glob standard library (https://docs.python.org/3/library/glob.html)
+#   - Access to glob function, for the datasets split in many files.
+# - hashlib standard library (https://docs.python.org/3/library/hashlib.html)
+#   - Access to sha256 function, for the names of the metadata indexes.
+# - json standard library (https://docs.python.org/3/library/json.html)
+#   - Access to load and dump functions, for the metadata indexes.
 # - numpy (https://numpy.org/doc/stable/)
 #   - Access to many useful functions for array manipulation.
 #   - Access to datetime64 and timedelta64.
+# - os standard library (https://docs.python.org/3/library/os.html)
+#   - Access to stat function, for the datasets cache.
 # - xarray (https://docs.xarray.dev/en/stable/)
 #   - Access to netCDF dataset manipulation functions.
-# - pandas (https://pandas.pydata.org/docs/reference/index.html)
-#   - Access to to_datetime class.
 #
 # @section notes_netCDFutils Notes
 # - Comments are Doxygen compatible.
+# - xarray is imported when the first dataset is opened.
+# - The metadata of each dataset are indexed in ~/.cache/atmi/index (or ATMI_INDEX), so that the scripts check the configurations without opening the datasets.
+# - The series of many sites are extracted in a single read of each file (or time block), so that a study of many sites costs about the I/O of one.
+# - A dataset may be split in many files along the time (e.g. yearly or monthly downloads): the files are opened lazily and only the ones overlapping the requested times are read, so that the memory does not grow with the archive.
 #
 # @section todo_netCDFutils TODO
 # - None.
@@ -32,9 +52,31 @@
 # - Created by Luca Cintura on 20/03/2023.
 # - Modified by Luca Cintura on 20/03/2023.
 
+from lib import profiling
+import glob
+import hashlib
+import json
 import numpy as np
-import pandas as pd
-import xarray as xr
+import os
+
+## This function gives the dates in a window of some days around many specific dates, for each year.
+#
+#  The dates are built from the first hour of each month, so the leap years are taken into account.
+#
+#  @param start The starting year.
+#  @param stop The final year.
+#  @param months The months of the specific dates.
+#  @param days The days of the specific dates.
+#  @param hours The hours of the specific dates.
+#  @param interval The number of days of the semi-window.
+#  @return The dates, with shape (number of specific dates, number of years * (2*interval+1)), sorted by year and then by day.
+def windows(start, stop, months, days, hours, interval):
+	months, days, hours = [np.atleast_1d(np.asarray(x, dtype=int)) for x in [months, days, hours]]
+	years = np.arange(start, stop+1, 1)
+	first = ((years[None, :]-1970)*12 + months[:, None]-1).astype('datetime64[M]').astype('datetime64[h]')
+	d0 = first + ((days[:, None]-1)*24 + hours[:, None]).astype('timedelta64[h]')
+	offsets = (np.arange(-interval, interval+1, 1)*24).astype('timedelta64[h]')
+	return (d0[:, :, None] + offsets).reshape(len(months), -1)
 
 ## This function gives the days in a window of some days around a specific date.
 #
@@ -45,31 +87,188 @@ import xarray as xr
 #  @param hour The hour of the specific date.
 #  @param interval The number of days of the semi-window.
 def window(start, stop, month, day, hour, interval):
-	years = np.arange(start, stop+1, 1)
-	days = np.arange(-interval, interval+1, 1)
-	W = []
-	for year in years:
-		d0 = np.datetime64(str(year)+'-'+str(month)+'-'+str(day)+'T'+str(hour))
-		for d in days:
-			W.append(d0 + np.timedelta64(d, 'D').astype('timedelta64[h]'))
-	return W
-	
+	return windows(start, stop, month, day, hour, interval)[0]
+
+## This class represents the index of the days windows around each hour of the year (month, day, hour), over the years of a dataset.
+#
+#  The slots are the 8760 hours of a non-leap year.
+class climatology:
+
+    ## The constructor for the class.
+    #
+    #  @param self The object pointer.
+    #  @param hours The times of the dataset (in hours since 1970-01-01), sorted.
+    #  @param start The starting year.
+    #  @param stop The final year.
+    #  @param interval The number of days of the semi-window.
+    def __init__(self, hours, start, stop, interval):
+        ref = np.arange('1981-01-01T00', '1982-01-01T00', dtype='datetime64[h]')   # arbitrary non-leap year
+        ## The month of each slot.
+        self.months = ref.astype('datetime64[M]').astype(int) % 12 + 1
+        ## The day of each slot.
+        self.days = (ref.astype('datetime64[D]') - ref.astype('datetime64[M]')).astype(int) + 1
+        ## The hour of each slot.
+        self.hours = (ref - ref.astype('datetime64[D]')).astype(int)
+        ## The semi-window (in days).
+        self.interval = interval
+        ## The positions in the dataset of the window of each slot, with shape (8760, number of years * (2*interval+1)).
+        self.index = nearest(hours, windows(start, stop, self.months, self.days, self.hours, interval))
+
+    ## This method gives the slots of the given dates.
+    #
+    #  @param self The object pointer.
+    #  @param months The months.
+    #  @param days The days.
+    #  @param hours The hours.
+    def slot(self, months, days, hours):
+        return slots(months, days, hours)
+
+## This function gives the slots (hours of a non-leap year, see climatology) of the given dates.
+#
+#  @param months The months.
+#  @param days The days.
+#  @param hours The hours.
+def slots(months, days, hours):
+	months, days, hours = [np.asarray(x, dtype=int) for x in [months, days, hours]]
+	first = (months-1).astype('datetime64[M]') + np.timedelta64(11*12, 'M')   # months of 1981
+	return (first.astype('datetime64[D]') - np.datetime64('1981-01-01')).astype(int)*24 + (days-1)*24 + hours
+
+## This function gives the positions of some dates in a sorted time axis (nearest neighbour).
+#
+#  @param hours The times of the axis (in hours since 1970-01-01), sorted.
+#  @param dates The desired dates.
+def nearest(hours, dates):
+	dates = np.asarray(dates, dtype='datetime64[h]').astype(np.int64)
+	right = np.clip(np.searchsorted(hours, dates), 1, len(hours)-1)
+	left = right - 1
+	return np.where(dates - hours[left] <= hours[right] - dates, left, right)
+
+## This function gives the files of a netCDF dataset.
+#
+#  @param datafile The path to the netCDF dataset, a glob pattern matching its files (e.g. era5/stl1_*.nc) or a list of paths.
+#  @return The absolute paths to the existing files, sorted.
+def paths(datafile):
+    if isinstance(datafile, (list, tuple)):
+        return sorted(os.path.abspath(p) for p in datafile if os.path.exists(p))
+    if any(c in datafile for c in '*?['):
+        return sorted(os.path.abspath(p) for p in glob.glob(datafile))
+    return [os.path.abspath(datafile)] if os.path.exists(datafile) else []
+
+## This function gives the sites of a configuration, given as comma separated lists.
+#
+#  The sites are named after their parameters files (params_<Site>.asc), when each site has its own, and are numbered otherwise (site1, site2, ...).
+#
+#  @param latitude The latitudes of the sites (comma separated).
+#  @param longitude The longitudes of the sites (comma separated).
+#  @param paramsfile The parameters files of the sites (comma separated, a single one for all the sites), if any.
+#  @return The names, the latitudes, the longitudes and the parameters files (None if not given) of the sites.
+def sites(latitude, longitude, paramsfile=None):
+    latitudes = [float(x) for x in str(latitude).split(',')]
+    longitudes = [float(x) for x in str(longitude).split(',')]
+    paramsfiles = paramsfile.split(',') if paramsfile is not None else [None]
+    if len(paramsfiles) == 1:
+        paramsfiles = paramsfiles*len(latitudes)
+    if len(longitudes) != len(latitudes) or len(paramsfiles) != len(latitudes):
+        raise ValueError('The sites need as many latitudes, longitudes and parameters files')
+    names = [os.path.splitext(os.path.basename(p))[0].replace('params_', '', 1) if p is not None else '' for p in paramsfiles]
+    if len(set(names)) != len(names) or '' in names:
+        names = ['site'+str(i+1) for i in range(len(latitudes))]
+    return names, latitudes, longitudes, paramsfiles
+
+## The directory of the metadata indexes.
+INDEX = os.environ.get('ATMI_INDEX', os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache')), 'atmi', 'index'))
+
+## This function gives the metadata of a netCDF dataset, from its index if up to date.
+#
+#  The index is built at the first call, opening the dataset, and then rebuilt only when the files (paths, modification times or sizes) change.
+#
+#  @param datafile The path to the netCDF dataset, a glob pattern matching its files or a list of paths.
+#  @return The metadata: the files ('files', with modification time and size), the variables ('variables'), their units ('units'), the first and last times ('first' and 'last'), the number of times ('count'), the time spacing in hours ('spacing'), the grid ('latitude' and 'longitude'), the presence of the expver dimension ('expver') and the starting and final years ('start' and 'stop').
+def metadata(datafile):
+    files = [[p, os.stat(p).st_mtime, os.stat(p).st_size] for p in paths(datafile)]
+    if len(files) == 0:
+        raise FileNotFoundError('No netCDF file found for '+str(datafile))
+    key = ','.join(p for p, _, _ in files) if isinstance(datafile, (list, tuple)) else os.path.abspath(datafile)
+    indexfile = os.path.join(INDEX, hashlib.sha256(key.encode()).hexdigest()[:32]+'.json')
+    try:
+        with open(indexfile) as f:
+            meta = json.load(f)
+        if meta['files'] == files:
+            return meta
+    except (OSError, ValueError, KeyError):
+        pass
+    import xarray as xr
+    times, variables, units, expver = [], [], {}, False
+    for p, _, _ in files:
+        with xr.open_dataset(p) as part:
+            times.append(part['time'].values.astype('datetime64[h]'))
+            for v in part.data_vars:
+                if v not in variables:
+                    variables.append(v)
+                    units[v] = part[v].attrs.get('units', '')
+            expver = expver or 'expver' in part.dims
+            if p == files[0][0]:
+                latitude, longitude = part['latitude'].values.tolist(), part['longitude'].values.tolist()
+    times = np.unique(np.concatenate(times))
+    spacing = np.diff(times.astype(np.int64))
+    meta = {'files': files, 'variables': variables, 'units': units, 'first': str(times[0]), 'last': str(times[-1]), 'count': len(times), 'spacing': int(spacing.min()) if len(spacing) > 0 else 0,
+        'latitude': latitude, 'longitude': longitude, 'expver': expver, 'start': int(times[0].astype('datetime64[Y]').astype(int)) + 1970, 'stop': int(times[-1].astype('datetime64[Y]').astype(int)) + 1970}
+    try:
+        os.makedirs(INDEX, exist_ok=True)
+        with open(indexfile+'.'+str(os.getpid())+'.tmp', 'w') as f:
+            json.dump(meta, f)
+        os.replace(indexfile+'.'+str(os.getpid())+'.tmp', indexfile)
+    except OSError:   # read-only cache, the metadata are computed again next time
+        pass
+    return meta
+
+## The datasets opened in the process: absolute path or pattern -> (modification times, data).
+_datasets = {}
+
+## This function opens a netCDF dataset, reusing the one already opened in the process if its files did not change.
+#
+#  The extracted series and the climatologies are kept with the dataset, so that they are shared by all the scripts run in the same process (e.g. by the atmi daemon, see atmid.py).
+#
+#  @param datafile The path to the netCDF dataset, a glob pattern matching its files or a list of paths.
+def load(datafile):
+    key = ','.join(paths(datafile)) if isinstance(datafile, (list, tuple)) else os.path.abspath(datafile)
+    stamp = tuple((p, os.stat(p).st_mtime) for p in paths(datafile))
+    if key not in _datasets or _datasets[key][0] != stamp:
+        _datasets[key] = (stamp, data(datafile))
+    return _datasets[key][1]
+
 ## This class gathers some xarray utility tools.
 #
-#  More details.
+#  The dataset may be split in many files along the time: they are seen as a single dataset, each file being a chunk read only when the requested times overlap it.
 class data:
 
     ## The constructor for the class.
     #
     #  @param self The object pointer.
-    #  @param datafile The path to the netCDF dataset.
+    #  @param datafile The path to the netCDF dataset, a glob pattern matching its files or a list of paths.
     def __init__(self, datafile):
-        ## The dataset containing the data.
-        self.dataset = xr.open_dataset(datafile)
+        import xarray as xr
+        files = paths(datafile)
+        if len(files) == 0:
+            raise FileNotFoundError('No netCDF file found for '+str(datafile))
+        parts = [xr.open_dataset(f) for f in files]   # lazy, only the coordinates are read
+        times = [part['time'].values for part in parts]
+        order = np.argsort([t.min() for t in times], kind='stable')
+        ## The files of the dataset, sorted by time.
+        self.files = [files[i] for i in order]
+        ## The datasets of the files, sorted by time.
+        self.parts = [parts[i] for i in order]
+        ## The dataset of the first file (variables, units and grid).
+        self.dataset = self.parts[0]
+        ## The times of the dataset, all the files together.
+        self.time = np.concatenate([times[i] for i in order])
+        self._ranges = [(times[i].min(), times[i].max()) for i in order]
         ## The starting year of the dataset.
-        self.start = pd.to_datetime(np.array(self.dataset['time'][0])).year
+        self.start = int(self.time.min().astype('datetime64[Y]').astype(int)) + 1970
         ## The final year of the dataset.
-        self.stop = pd.to_datetime(np.array(self.dataset['time'][-1])).year
+        self.stop = int(self.time.max().astype('datetime64[Y]').astype(int)) + 1970
+        self._series = {}   # (latitude, longitude, name) -> (times, values)
+        self._climatologies = {}   # (start, stop, interval) -> climatology
       
     ## This method gives the name of all the variables of the dataset.
     #
@@ -83,6 +282,103 @@ class data:
     def units(self):
         return list(self.dataset[v].attrs['units'] for v in self.variables())
 
+    ## This method gives the time series of a variable at fixed coordinates (latitude, longitude), sorted by time.
+    #
+    #  The series is extracted once from the dataset and then kept on the object. The ERA5T data (expver=5) fill the gaps of the ERA5 data (expver=1).
+    #
+    #  @param self The object pointer.
+    #  @param latitude The fixed latitude.
+    #  @param longitude The fixed longitude.
+    #  @param name The name of the desired variable.
+    #  @return The times (in hours since 1970-01-01) and the values of the variable.
+    def series(self, latitude, longitude, name):
+        key = (latitude, longitude, name)
+        if key not in self._series:
+            self._series[key] = self._point(latitude, longitude, name)
+        return self._series[key]
+
+    ## This method extracts the time series of a variable at many sites, reading the dataset once for all of them.
+    #
+    #  The series are then kept on the object, as the ones given by series.
+    #
+    #  @param self The object pointer.
+    #  @param latitudes The latitudes of the sites.
+    #  @param longitudes The longitudes of the sites.
+    #  @param name The name of the desired variable.
+    def extract(self, latitudes, longitudes, name):
+        missing = [(lat, lon) for lat, lon in dict.fromkeys(zip(latitudes, longitudes)) if (lat, lon, name) not in self._series]
+        if len(missing) == 0:
+            return
+        hours, values = self._points([lat for lat, _ in missing], [lon for _, lon in missing], name)
+        for s, (lat, lon) in enumerate(missing):
+            self._series[(lat, lon, name)] = (hours, np.ascontiguousarray(values[:, s]))
+
+    ## This method gives the values of a variable at fixed coordinates (latitude, longitude) for a block of dates, reading only the time range of the block.
+    #
+    #  Unlike series, nothing is kept on the object, so that long periods can be read one block at a time.
+    #
+    #  Given many sites (lists of latitudes and longitudes), the block is read once for all of them.
+    #
+    #  @param self The object pointer.
+    #  @param latitude The fixed latitude (or the latitudes of the sites).
+    #  @param longitude The fixed longitude (or the longitudes of the sites).
+    #  @param dates The desired dates, sorted.
+    #  @param name The name of the desired variable.
+    #  @return The nearest times of the dataset (in hours since 1970-01-01) and the values of the variable (with shape (number of dates, number of sites) for many sites).
+    @profiling.profiled
+    def block_values(self, latitude, longitude, dates, name):
+        dates = np.asarray(dates, dtype='datetime64[h]')
+        hours, values = self._points(np.atleast_1d(latitude), np.atleast_1d(longitude), name, slice(dates[0]-np.timedelta64(1, 'h'), dates[-1]+np.timedelta64(1, 'h')))
+        positions = nearest(hours, dates)
+        values = np.ma.masked_invalid(values[positions])
+        return hours[positions], values[:, 0] if np.ndim(latitude) == 0 else values
+
+    ## This method extracts the time series of a variable at fixed coordinates (latitude, longitude), sorted by time.
+    #
+    #  @param self The object pointer.
+    #  @param latitude The fixed latitude.
+    #  @param longitude The fixed longitude.
+    #  @param name The name of the desired variable.
+    #  @param time The time range to read (all the dataset by default).
+    def _point(self, latitude, longitude, name, time=None):
+        hours, values = self._points([latitude], [longitude], name, time)
+        return hours, np.ascontiguousarray(values[:, 0])
+
+    ## This method extracts the time series of a variable at many sites, sorted by time, with a single read of each file.
+    #
+    #  @param self The object pointer.
+    #  @param latitudes The latitudes of the sites.
+    #  @param longitudes The longitudes of the sites.
+    #  @param name The name of the desired variable.
+    #  @param time The time range to read (all the dataset by default).
+    #  @return The times (in hours since 1970-01-01) and the values, with shape (number of times, number of sites).
+    def _points(self, latitudes, longitudes, name, time=None):
+        import xarray as xr
+        latitudes = xr.DataArray(np.asarray(latitudes, dtype=float), dims='site')
+        longitudes = xr.DataArray(np.asarray(longitudes, dtype=float), dims='site')
+        hours, values = [], []
+        for part, (first, last) in zip(self.parts, self._ranges):
+            if time is not None and (last < np.datetime64(time.start) or first > np.datetime64(time.stop)):
+                continue   # file out of the requested times, not read
+            point = part[name].sel(longitude=longitudes, latitude=latitudes, method='nearest')
+            if time is not None:
+                if not point.indexes['time'].is_monotonic_increasing:
+                    point = point.sortby('time')   # archive times may be out of order, and a label slice needs them sorted
+                point = point.sel(time=time)
+            if 'expver' in point.dims:
+                expvers = list(point['expver'].values)
+                expvers.sort(key=lambda e: e != 1)   # ERA5 first
+                merged = point.sel(expver=expvers[0])
+                for e in expvers[1:]:
+                    merged = merged.combine_first(point.sel(expver=e))
+                point = merged
+            hours.append(point['time'].values.astype('datetime64[h]').astype(np.int64))
+            values.append(point.transpose('time', 'site').values)
+        hours = np.concatenate(hours) if hours else np.empty(0, dtype=np.int64)
+        values = np.concatenate(values) if values else np.empty((0, len(latitudes)))
+        order = np.argsort(hours, kind='stable')
+        return np.ascontiguousarray(hours[order]), np.ascontiguousarray(values[order])
+
     ## This method gives filters the dataset values through a days window, at fixed coordinates (latitude, longitude).
     #
     #  @param self The object pointer.
@@ -90,10 +386,35 @@ class data:
     #  @param longitude The fixed longitude.
     #  @param window The days window to filter the data.
     #  @param name The name of the desired variable.
+    @profiling.profiled
     def values(self, latitude, longitude, window, name):
-        data = self.dataset
-        if list(data.coords).count('expver') != 0:
-            data = data.sel(expver=1)
-        data = data.sortby(data['time'])
-        data_loc_time = data.sel(time=window, longitude=longitude, latitude=latitude, method='nearest')
-        return np.ma.masked_invalid(data_loc_time[name].values)
+        hours, values = self.series(latitude, longitude, name)
+        return np.ma.masked_invalid(values[nearest(hours, window)])
+
+    ## This method gives the index of the days windows around each hour of the year, built once for each set of arguments.
+    #
+    #  @param self The object pointer.
+    #  @param start The starting year.
+    #  @param stop The final year.
+    #  @param interval The number of days of the semi-window.
+    def climatology(self, start, stop, interval):
+        key = (start, stop, interval)
+        if key not in self._climatologies:
+            hours = np.sort(self.time.astype('datetime64[h]').astype(np.int64))
+            self._climatologies[key] = climatology(hours, start, stop, interval)
+        return self._climatologies[key]
+
+    ## This method gives the dataset values in the days windows of the given slots, at fixed coordinates (latitude, longitude).
+    #
+    #  @param self The object pointer.
+    #  @param latitude The fixed latitude.
+    #  @param longitude The fixed longitude.
+    #  @param name The name of the desired variable.
+    #  @param index The index of the days windows (see climatology).
+    #  @param slots The slots of the year (all the 8760 hours by default).
+    #  @return The values, with shape (number of slots, window size).
+    @profiling.profiled
+    def window_values(self, latitude, longitude, name, index, slots=None):
+        hours, values = self.series(latitude, longitude, name)
+        positions = index.index if slots is None else index.index[slots]
+        return np.ma.masked_invalid(values[positions])
@@ -0,0 +1,222 @@
+"""! @brief Defines the instrumentation of the atmi scripts."""
+##
+# @file src/lib/profiling.py
+# @brief File for the lib.profiling package.
+#
+# The file is located under atmi/src/lib.
+#
+# @package lib.profiling
+# @brief Defines the instrumentation of the atmi scripts.
+#
+# @section description_profiling Description
+# Defines the report of the stages of a script (wall time, CPU time, peak RSS, processed items, bytes read and written), the latency percentiles of the am calls and the opt-in profiling of the hot functions.
+# - usage (function)
+# - percentiles (function)
+# - profiled (function)
+# - stage (class)
+# - report (class)
+#
+# @section libraries_profiling Libraries/Modules
+# - cProfile standard library (https://docs.python.org/3/library/profile.html)
+#   - Access to Profile class.
+# - datetime standard library (https://docs.python.org/3/library/datetime.html)
+#   - Access to datetime function.
+# - functools standard library (https://docs.python.org/3/library/functools.html)
+#   - Access to wraps function.
+# - json standard library (https://docs.python.org/3/library/json.html)
+#   - Access to dumps function, for the report.
+# - numpy (https://numpy.org/doc/stable/)
+#   - Access to percentile function.
+# - os standard library (https://docs.python.org/3/library/os.html)
+#   - Access to files manipulation functions.
+# - pstats standard library (https://docs.python.org/3/library/profile.html)
+#   - Access to Stats class.
+# - resource standard library (https://docs.python.org/3/library/resource.html)
+#   - Access to getrusage function.
+# - sys standard library (https://docs.python.org/3/library/sys.html)
+#   - Access to argv and platform.
+# - threading standard library (https://docs.python.org/3/library/threading.html)
+#   - Access to Lock class.
+# - time standard library (https://docs.python.org/3/library/time.html)
+#   - Access to perf_counter function.
+#
+# @section notes_profiling Notes
+# - Comments are Doxygen compatible.
+# - The CPU time and the bytes are the ones of the whole process during the stage (all its threads), the CPU time of the am processes being given apart; the bytes are read from /proc/self/io, and are missing on the systems without it.
+# - The hot functions are profiled only when ATMI_PROFILE=1, and only in one thread at a time.
+#
+# @section todo_profiling TODO
+# - None.
+
+import cProfile
+from datetime import datetime
+import functools
+import json
+import numpy as np
+import os
+import pstats
+import resource
+import sys
+import threading
+import time
+
+COLUMNS = ['stage', 'calls', 'items', 'wall', 'cpu', 'cpu_am', 'rss_peak', 'read', 'written']   # columns of the CSV report
+
+_profiler = None   # profiler of the hot functions, while a report with ATMI_PROFILE=1 is open
+_busy = threading.Lock()
+
+## This function gives the resources used by the process so far.
+#
+#  @return The wall time, the CPU time of the process and of its terminated children (the am runs), the peak RSS (bytes) and the bytes read and written (None if unknown).
+def usage():
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    io = {}
+    try:
+        with open('/proc/self/io') as f:
+            io = dict(line.split(': ') for line in f.read().splitlines())
+    except OSError:
+        pass
+    scale = 1 if sys.platform == 'darwin' else 1024   # ru_maxrss in bytes on macOS, in KB elsewhere
+    return {'wall': time.perf_counter(), 'cpu': own.ru_utime + own.ru_stime, 'cpu_am': children.ru_utime + children.ru_stime, 'rss_peak': own.ru_maxrss*scale,
+        'read': int(io['rchar']) if 'rchar' in io else None, 'written': int(io['wchar']) if 'wchar' in io else None}
+
+## This function gives the percentiles of a set of latencies.
+#
+#  @param latencies The latencies (seconds).
+#  @return The number of latencies, their mean, the 50th, 90th and 99th percentiles and the maximum.
+def percentiles(latencies):
+    if len(latencies) == 0:
+        return {'calls': 0}
+    p50, p90, p99 = np.percentile(latencies, [50, 90, 99])
+    return {'calls': len(latencies), 'mean': round(float(np.mean(latencies)), 6), 'p50': round(float(p50), 6), 'p90': round(float(p90), 6), 'p99': round(float(p99), 6), 'max': round(float(np.max(latencies)), 6)}
+
+## This function wraps a hot function, so that its calls are profiled when ATMI_PROFILE=1.
+#
+#  @param function The function.
+#  @return The wrapped function.
+def profiled(function):
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        profiler = _profiler
+        if profiler is None or not _busy.acquire(blocking=False):   # not profiling, or a call already profiled
+            return function(*args, **kwargs)
+        try:
+            return profiler.runcall(function, *args, **kwargs)
+        finally:
+            _busy.release()
+    return wrapper
+
+## This class represents a stage of a script.
+class stage:
+
+    ## The constructor for the class.
+    #
+    #  @param self The object pointer.
+    #  @param name The name of the stage.
+    def __init__(self, name):
+        ## The name of the stage.
+        self.name = name
+        ## The number of times the stage was entered.
+        self.calls = 0
+        ## The number of items processed by the stage.
+        self.items = 0
+        ## The resources used by the stage (see usage), summed over its calls.
+        self.used = {'wall': 0., 'cpu': 0., 'cpu_am': 0., 'rss_peak': 0, 'read': 0, 'written': 0}
+        self._start = None
+
+    ## This method starts the measure of the stage.
+    #
+    #  @param self The object pointer.
+    def __enter__(self):
+        self.calls = self.calls + 1
+        self._start = usage()
+        return self
+
+    ## This method ends the measure of the stage.
+    #
+    #  @param self The object pointer.
+    def __exit__(self, *exc):
+        stop = usage()
+        for k in self.used:
+            if k == 'rss_peak':
+                self.used[k] = max(self.used[k], stop[k])
+            elif self.used[k] is not None and stop[k] is not None:
+                self.used[k] = self.used[k] + stop[k] - self._start[k]
+            else:
+                self.used[k] = None
+        return False
+
+    ## This method gives the row of the stage in the report.
+    #
+    #  @param self The object pointer.
+    def row(self):
+        row = {'stage': self.name, 'calls': self.calls, 'items': int(self.items)}
+        row.update({k: round(v, 6) if isinstance(v, float) else v for k, v in self.used.items()})
+        return row
+
+## This class represents the report of the stages of a script, saved as <path>.profile.json and <path>.profile.csv.
+#
+#  With ATMI_PROFILE=1, the hot functions (see profiled) are profiled while the report is open, and their statistics are saved in <path>.prof and <path>.profile.txt.
+class report:
+
+    ## The constructor for the class.
+    #
+    #  @param self The object pointer.
+    #  @param path The path of the report, without extension.
+    def __init__(self, path):
+        global _profiler
+        ## The path of the report, without extension.
+        self.path = path
+        ## The stages, in the order they were first entered.
+        self.stages = {}
+        ## The latency percentiles of the calls of each kind (see percentiles).
+        self.latencies = {}
+        self._start = usage()
+        self._date = str(datetime.now())
+        self._profiler = cProfile.Profile() if os.environ.get('ATMI_PROFILE', '0') == '1' else None
+        _profiler = self._profiler
+
+    ## This method gives a stage, to be measured with a with statement; a stage entered many times sums its measures.
+    #
+    #  @param self The object pointer.
+    #  @param name The name of the stage.
+    #  @param items The number of items processed, added to the ones of the stage.
+    #  @return The stage.
+    def stage(self, name, items=0):
+        if name not in self.stages:
+            self.stages[name] = stage(name)
+        self.stages[name].items = self.stages[name].items + items
+        return self.stages[name]
+
+    ## This method adds the latencies of a kind of calls.
+    #
+    #  @param self The object pointer.
+    #  @param name The kind of calls.
+    #  @param latencies The latencies (seconds).
+    def latency(self, name, latencies):
+        self.latencies[name] = percentiles(latencies)
+
+    ## This method saves the report, and the profile of the hot functions if any.
+    #
+    #  @param self The object pointer.
+    def save(self):
+        global _profiler
+        total = stage('total')
+        total.calls, total._start = 1, self._start
+        total.__exit__()
+        rows = [s.row() for s in self.stages.values()] + [total.row()]
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with open(self.path+'.profile.json', 'w') as f:
+            f.write(json.dumps({'script': os.path.basename(sys.argv[0]), 'argv': sys.argv[1:], 'date': self._date, 'stages': rows, 'latencies': self.latencies}, indent=1))
+        with open(self.path+'.profile.csv', 'w') as f:
+            f.write(','.join(COLUMNS)+'\n')
+            for row in rows:
+                f.write(','.join('' if row[c] is None else str(row[c]) for c in COLUMNS)+'\n')
+        print('Stages report saved in '+self.path+'.profile.json')
+        if self._profiler is not None:
+            _profiler = None
+            self._profiler.dump_stats(self.path+'.prof')
+            with open(self.path+'.profile.txt', 'w') as f:
+                pstats.Stats(self._profiler, stream=f).sort_stats('cumulative').print_stats(40)
+            print('Profile of the hot functions saved in '+self.path+'.prof')
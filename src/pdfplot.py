@@ -2,16 +2,18 @@
 # @brief Draws the plot of the pdf for the given variable.
 #
 # Python script that plots the probability density function associated with an atmospheric variable at the given time of the year (month/day/hour).
+# Many sites (comma separated latitudes and longitudes) are extracted with a single read of the dataset, and plotted one after the other.
+# The datafile may be replaced by the models of the sites trained by train.py (comma separated .npz files): the pdfs are then read from the models, without the data archive.
 #
 # The file is located under atmi/src.
 
+from lib import atmmodel
 from lib import atmsampling
 from lib import netCDFutils
 import numpy as np
 import os
 import pandas as pd
 import sys
-import xarray as xr
 
 ## Reading the configuration file
 #################################
@@ -25,19 +27,31 @@ with open(config) as f:
 	args = [arg.rstrip('\n') for arg in args]
 datafile, var, month, day, hour, lat, lon, plot = args
 
-print('Datafile\t->\t'+datafile)
-if os.path.exists(datafile) == False:
-	print('Directory not found!')
-	sys.exit()
-	
-data = netCDFutils.data(datafile)   # opening dataset
-names = data.variables()
+trained = datafile.endswith('.npz')   # models of the sites (see train.py)
+models = []
+if trained:
+	for modelfile in datafile.split(','):
+		print('Model\t\t->\t'+modelfile)
+		if os.path.exists(modelfile) == False:
+			print('Directory not found!')
+			sys.exit()
+		models.append(atmmodel.model.load(modelfile))
+	names = list(set.intersection(*[set(model.variables()) for model in models]))
+else:
+	print('Datafile\t->\t'+datafile)
+	if len(netCDFutils.paths(datafile)) == 0:
+		print('Directory not found!')
+		sys.exit()
+
+	names = netCDFutils.metadata(datafile)['variables']   # reading the index of the dataset
 
 print('Varible\t\t->\t'+var)
 if names.count(var) == 0:
 	print('Variable name not valid!')
 	sys.exit()
 	
+data = netCDFutils.load(datafile) if not trained else None   # opening dataset
+
 print('Month\t\t->\t'+month)
 if (float(month) != int(month)) & (float(month) <= 0) & (float(month) > 12):
 	print('Month not valid!')
@@ -54,28 +68,43 @@ if (float(hour) != int(hour)) & (float(hour) < 0) & (float(hour) > 23):
         print('Hour not valid!\n')
         sys.exit()
 
+if trained:   # the sites of the models
+	lat, lon = [','.join(str(model.meta[k]) for model in models) for k in ['latitude', 'longitude']]
 print('Latitude\t->\t'+lat)
 print('Longitude\t->\t'+lon)
-lat, lon = [float(lat), float(lon)]
+try:
+	sites, lats, lons, _ = netCDFutils.sites(lat, lon)
+except ValueError:
+	print('Sites not valid!')
+	sys.exit()
 #################################
 
 ## Calculating the pdf
 ######################
-window = netCDFutils.window(data.start + 1, data.stop - 1, month, day, hour, 4)
-values = data.values(lat, lon, window, var)
-variable = atmsampling.variable(var, values)
+if trained:
+	slot = netCDFutils.slots(month, day, hour)
+	variables = [model.variable(var, slot) for model in models]
+else:
+	window = netCDFutils.window(data.start + 1, data.stop - 1, month, day, hour, 4)
+	data.extract(lats, lons, var)   # all the sites in a single read
+	kde = os.environ.get('ATMI_KDE', 'binned')   # backend of the densities (see lib.atmsampling.variable)
+	variables = [atmsampling.variable(var, data.values(lats[s], lons[s], window, var), backend=kde) for s in range(len(sites))]
 ######################
 
 ## Plotting the pdf
 ###################
-if plot == 'term':
-	print('\nPlotting on a terminal ...\n')
-	variable.termplot_pdf()
-	print('')
-elif plot == 'canvas':
-	print('\nPlotting on a canvas ...\n')
-	variable.plot_pdf()
-else:
+if plot != 'term' and plot != 'canvas':
 	print('Plot option not valid!')
 	sys.exit()
+
+for s in range(len(sites)):
+	if len(sites) > 1:
+		print('\nSite '+str(s+1)+' ('+str(lats[s])+', '+str(lons[s])+')')
+	if plot == 'term':
+		print('\nPlotting on a terminal ...\n')
+		variables[s].termplot_pdf()
+		print('')
+	else:
+		print('\nPlotting on a canvas ...\n')
+		variables[s].plot_pdf()
 ###################
@@ -2,18 +2,23 @@
 # @brief Generator of the statistical resampling for the atmospheric variables.
 #
 # Python script necessary to extract the probability density function from the climatic data and to perform a correlated resampling for the given time period.
+# Many sites (comma separated latitudes and longitudes) are extracted with a single read of each dataset, and each one gets its own samplings (<Filename>_site<N>).
+# The datafiles may be replaced by the models of the sites trained by train.py (comma separated .npz files, one for each site): the samplings are then drawn without the data archive.
+# With ATMI_SEED, the samplings are reproducible, and drawn in chunks by ATMI_JOBS processes.
+# The densities are fitted with the binned KDE, or with the exact scipy gaussian_kde with ATMI_KDE=scipy.
 #
 # The file is located under atmi/src.
 
+from lib import atmmodel
 from lib import atmsampling
 from lib import netCDFutils
+from lib import profiling
 from datetime import datetime
 import numpy as np
 import os
 import pandas as pd
 import sys
 from tqdm import tqdm
-import xarray as xr
 
 with open(os.path.expanduser('~')+'/.atmi') as file:
     DIR = file.readline().strip('\n')   # Global path of the project
@@ -32,14 +37,30 @@ datafiles, var, month1, day1, hour1, month2, day2, hour2, lat, lon, N, filename
 datafiles = datafiles.split(',')
 var = var.split(',')
 
-for i in range(len(datafiles)):
+trained = all(datafile.endswith('.npz') for datafile in datafiles)   # models of the sites (see train.py)
+models = []
+if trained:
+    for modelfile in datafiles:
+        print('Model\t\t->\t'+modelfile)
+        if os.path.exists(modelfile) == False:
+            print('Directory not found!')
+            sys.exit()
+        models.append(atmmodel.model.load(modelfile))
+
+    for i in range(len(var)):
+        print('Varible\t\t->\t'+var[i])
+        if any(model.variables().count(var[i]) == 0 for model in models):
+            print('Variable name not valid!')
+            sys.exit()
+
+for i in range(len(datafiles) if not trained else 0):
     print('Datafile\t->\t'+datafiles[i])
-    if os.path.exists(datafiles[i]) == False:
+    if len(netCDFutils.paths(datafiles[i])) == 0:
 	    print('Directory not found!')
 	    sys.exit()
 	
-    data = netCDFutils.data(datafiles[i])   # opening dataset
-    names = data.variables()
+    meta = netCDFutils.metadata(datafiles[i])   # reading the index of the dataset
+    names = meta['variables']
 
     print('Varible\t\t->\t'+var[i])
     if names.count(var[i]) == 0:
@@ -77,9 +98,16 @@ if (float(hour2) != int(hour2)) or (float(hour2) < 0) or (float(hour2) > 23):
         print('Hour not valid!\n')
         sys.exit()
 
+if trained:   # the sites of the models
+    lat, lon = [','.join(str(model.meta[k]) for model in models) for k in ['latitude', 'longitude']]
 print('Latitude\t->\t'+lat)
 print('Longitude\t->\t'+lon)
-lat, lon = [float(lat), float(lon)]
+try:
+    sites, lats, lons, _ = netCDFutils.sites(lat, lon)
+except ValueError:
+    print('Sites not valid!')
+    sys.exit()
+filenames = [filename+'_'+site for site in sites] if len(sites) > 1 else [filename]   # outputs of each site
 
 print('N° Samplings\t->\t'+N)
 if (float(N) < 0) or (float(N) != int(N)):
@@ -96,51 +124,81 @@ date1 = np.datetime64(str(1981)+'-'+str(month1)+'-'+str(day1)+'T'+str(hour1))
 date2 = np.datetime64(str(1981)+'-'+str(month2)+'-'+str(day2)+'T'+str(hour2))	# arbitrary non-leap year
 hours = (date2 - date1) // np.timedelta64(1,'h')
 
+report = profiling.report(DIR+'/outputs/sampling/'+filename+'.sampling')
 datas = []
-for datafile in datafiles:
-    datas.append(netCDFutils.data(datafile))
-    
-start, stop = np.min([data.start for data in datas]), np.min([data.stop for data in datas])
-
-atmospheres, ms, ds, hs = [], [], [], []
-for h in tqdm(range(hours + 1), desc='Loading ...'):
-    date = date1 + np.timedelta64(h, 'h')
-    mdh = [pd.to_datetime(date).month, pd.to_datetime(date).day, pd.to_datetime(date).hour]
-    for i in range(len(mdh)):
-        if mdh[i] <= 1 or np.log10(mdh[i]) < 1: # controlling the formatting for window function
-            mdh[i] = '0'+str(mdh[i])
-        mdh[i] = str(mdh[i])
-    month, day, hour = mdh
-    ms.append(month), ds.append(day), hs.append(hour)
-
-    window = netCDFutils.window(start + 1, stop - 1, month, day, hour, 4)
-    
-    variables = []
-    for i in range(len(var)):
-        values = datas[i].values(lat, lon, window, var[i])
-        variables.append(atmsampling.variable(var[i], values))
-        
-    atmospheres.append(atmsampling.atmosphere(variables))
-atm = atmsampling.samplings(atmospheres)
+for datafile in (datafiles if not trained else []):
+    datas.append(netCDFutils.load(datafile))
+
+dates = date1 + np.arange(hours + 1).astype('timedelta64[h]')
+months = dates.astype('datetime64[M]').astype(int) % 12 + 1
+days = (dates.astype('datetime64[D]') - dates.astype('datetime64[M]')).astype(int) + 1
+hrs = (dates - dates.astype('datetime64[D]')).astype(int)
+ms, ds, hs = [['%02d' % x for x in X] for X in [months, days, hrs]]
+
+if trained:
+    slots = netCDFutils.slots(months, days, hrs)
+else:
+    with report.stage('extraction', items=(hours + 1)*len(sites)):
+        start, stop = np.min([data.start for data in datas]), np.min([data.stop for data in datas])
+        indexes = [data.climatology(start + 1, stop - 1, 4) for data in datas]   # days windows of each hour of the year
+        slots = indexes[0].slot(months, days, hrs)
+        for i in range(len(var)):
+            datas[i].extract(lats, lons, var[i])   # all the sites in a single read
+        values = [[datas[i].window_values(lats[s], lons[s], var[i], indexes[i], slots) for i in range(len(var))] for s in range(len(sites))]
 #########################################
 
-## Writing the results on a .csv file
-#####################################
-samplings = atm.correlated_sample(N)
-
-n = 0   # counter for the samplings name
-for sampling in samplings:
-    df = pd.DataFrame(sampling, columns=var)
-    df.insert(0, 'Month', ms), df.insert(1, 'Day', ds), df.insert(2, 'Hour', hs)
-
-    if os.path.exists(DIR+'/outputs/sampling/'+filename+str(n)+'.csv') == True:
-	    with open(DIR+'/outputs/sampling/'+filename+str(n)+'.csv', 'r+') as f:
-		    f.truncate(0)
+## Sampling each site and writing the results on a .csv file
+#############################################################
+lag = os.environ.get('ATMI_LAG', '')   # banded temporal correlation for long spans
+if lag == '':
+    lag = None if (hours + 1)*len(var) <= 2232 else 24   # dense copula up to one month of 3 variables
+else:
+    lag = None if int(lag) == 0 else int(lag)
+
+seed = os.environ.get('ATMI_SEED', '')   # reproducible samplings, drawn in chunks
+seeds = np.random.SeedSequence(int(seed)).spawn(len(sites)) if seed != '' else [None]*len(sites)   # an independent stream for each site
+jobs = int(os.environ.get('ATMI_JOBS', '0'))   # processes drawing the chunks (0 = all the available cores)
+
+kde = os.environ.get('ATMI_KDE', 'binned')   # backend of the densities (see lib.atmsampling.variable)
+if kde != 'binned' and kde != 'scipy':
+    print('KDE backend not valid!')
+    sys.exit()
 
-    with open(DIR+'/outputs/sampling/'+filename+str(n)+'.csv', 'a') as f:
-	    f.write('# '+str(datetime.now())+'\n\n')
-	    df.to_csv(f)
-	
-    print('Sampling file saved in '+DIR+'/outputs/sampling'+filename+str(n)+'.csv!')
-    n = n + 1
-#####################################
+for s in range(len(sites)):
+    if trained:
+        with report.stage('model', items=(hours + 1)*len(var)):
+            atm = models[s].realizations(slots, var)   # densities and windows of the model
+    else:
+        with report.stage('kde', items=(hours + 1)*len(var)):
+            pdfs = [atmsampling.binned_kde.batch(values[s][i]) if kde == 'binned' else [None]*(hours + 1) for i in range(len(var))]   # all the hours at once
+
+            atmospheres = []
+            for h in tqdm(range(hours + 1), desc='Loading ...'):
+                variables = []
+                for i in range(len(var)):
+                    variables.append(atmsampling.variable(var[i], values[s][i][h], backend=kde, pdf=pdfs[i][h]))
+
+                atmospheres.append(atmsampling.atmosphere(variables))
+            atm = atmsampling.samplings(atmospheres)
+
+    with report.stage('copula', items=N*(hours + 1)):
+        samplings = atm.correlated_sample(N, lag=lag, seed=seeds[s], jobs=jobs)
+
+    with report.stage('writing', items=len(samplings)):
+        n = 0   # counter for the samplings name
+        for sampling in samplings:
+            df = pd.DataFrame(sampling, columns=var)
+            df.insert(0, 'Month', ms), df.insert(1, 'Day', ds), df.insert(2, 'Hour', hs)
+
+            if os.path.exists(DIR+'/outputs/sampling/'+filenames[s]+str(n)+'.csv') == True:
+                with open(DIR+'/outputs/sampling/'+filenames[s]+str(n)+'.csv', 'r+') as f:
+                    f.truncate(0)
+
+            with open(DIR+'/outputs/sampling/'+filenames[s]+str(n)+'.csv', 'a') as f:
+                f.write('# '+str(datetime.now())+'\n\n')
+                df.to_csv(f)
+
+            print('Sampling file saved in '+DIR+'/outputs/sampling'+filenames[s]+str(n)+'.csv!')
+            n = n + 1
+report.save()
+#############################################################
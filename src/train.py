@@ -0,0 +1,80 @@
+## @file src/train.py
+# @brief Trainer of the climatology model of a site.
+#
+# Python script necessary to fit, once, the probability density function of each variable at each hour of the year and the correlation structure of the hours, and save them as the model of the site.
+# The model is used by the -s and -p methods in place of the datafiles, so that the samplings are drawn without the data archive.
+# Many sites (comma separated latitudes and longitudes) are extracted with a single read of each dataset, and each one gets its own model (<Filename>_site<N>).
+#
+# The file is located under atmi/src.
+
+from lib import atmmodel
+from lib import netCDFutils
+from lib import profiling
+import numpy as np
+import os
+import sys
+
+with open(os.path.expanduser('~')+'/.atmi') as file:
+    DIR = file.readline().strip('\n')   # Global path of the project
+
+## Reading the configuration file
+#################################
+conf_file = sys.argv[1]
+if os.path.exists(conf_file) == False:
+	print('Directory not found!')
+	sys.exit()
+
+with open(conf_file) as f:
+	args = f.readlines()
+	args = [arg.rstrip('\n') for arg in args]
+datafiles, var, lat, lon, filename = args
+datafiles = datafiles.split(',')
+var = var.split(',')
+
+for i in range(len(datafiles)):
+    print('Datafile\t->\t'+datafiles[i])
+    if len(netCDFutils.paths(datafiles[i])) == 0:
+        print('Directory not found!')
+        sys.exit()
+
+    meta = netCDFutils.metadata(datafiles[i])   # reading the index of the dataset
+
+    print('Varible\t\t->\t'+var[i])
+    if meta['variables'].count(var[i]) == 0:
+        print('Variable name not valid!')
+        sys.exit()
+
+print('Latitude\t->\t'+lat)
+print('Longitude\t->\t'+lon)
+try:
+    sites, lats, lons, _ = netCDFutils.sites(lat, lon)
+except ValueError:
+    print('Sites not valid!')
+    sys.exit()
+filenames = [filename+'_'+site for site in sites] if len(sites) > 1 else [filename]   # models of each site
+
+print('Filename\t->\t'+filename+'\n')
+#################################
+
+## Training the models
+######################
+report = profiling.report(DIR+'/outputs/model/'+filename+'.train')
+datas = []
+for datafile in datafiles:
+    datas.append(netCDFutils.load(datafile))
+
+start, stop = np.min([data.start for data in datas]), np.min([data.stop for data in datas])   # as sampling.py
+
+with report.stage('extraction', items=8760*len(sites)):
+    for i in range(len(var)):
+        datas[i].extract(lats, lons, var[i])   # all the sites in a single read
+
+os.makedirs(DIR+'/outputs/model', exist_ok=True)
+for s in range(len(sites)):
+    with report.stage('training', items=8760):
+        model = atmmodel.model.train(datas, var, lats[s], lons[s], start + 1, stop - 1)
+    with report.stage('writing', items=1):
+        model.save(DIR+'/outputs/model/'+filenames[s]+'.npz')
+    print('Model saved in '+DIR+'/outputs/model/'+filenames[s]+'.npz!')
+report.save()
+######################
@@ -6,12 +6,14 @@
 #
 # The file is located under atmi/src.
 
+from lib import amstore
 from lib import amutils
 import os
 import sys
 
 with open(os.path.expanduser('~')+'/.atmi') as file:
     DIR = file.readline().strip('\n')   # Global path of the project
+LAYERING = os.environ.get('ATMI_LAYERING', 'uniform')   # layering of the atmosphere
 
 ## Reading the configuration file
 #################################
@@ -41,11 +43,14 @@ T0, P0, PWV, month, N, freq_start, freq_stop, freq_interval = [float(T0), float(
 
 ## Calculating the vertical profiles
 ####################################
-Z, T, P, pwv = amutils.profiles(paramsfile, T0, P0, PWV, month, N)
+Z, T, P, pwv = amutils.profiles(paramsfile, T0, P0, PWV, month, N, LAYERING)
 ####################################
 
 ## Saving the am configuration file
 ####################################
 amutils.config(freq_start, freq_stop, freq_interval, 2.7, Z, T, P, pwv, DIR+'/am/config/'+filename)
 print('am configuration file saved in '+DIR+'/am/config/'+filename+'.amc!')
+with open(DIR+'/am/config/'+filename+'.txt', 'w') as file:
+    file.write(filename+'\n')
+amstore.store(DIR+'/am/output/'+filename+'.cube', 'w').close()   # new store for the run
 ####################################